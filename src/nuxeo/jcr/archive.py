@@ -0,0 +1,276 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Archive of a JCR subtree.
+
+The archive is written sequentially, one node at a time, so that a
+subtree of any size can be exported without holding it in memory.
+
+Format::
+
+  JCRARCHIVE 1
+  Uuuid name            one record per node, parents before children
+  ^parent-uuid          (absent for a node without parent)
+  Pname                 single-valued property, followed by its value
+  Mname                 multi-valued property, followed by its values
+  M                     end of multi-valued property
+  .                     end of nodes
+  [blob data]
+  B00000000000000001234 offset of blob data in the archive
+
+Values use the same tags as the wire protocol, except that binaries are
+stored out of line, after the nodes, as ``xoffset length`` where offset
+is relative to the start of the blob data. Identical binaries are only
+stored once.
+"""
+
+import sys
+from datetime import datetime
+from tempfile import TemporaryFile
+try:
+    from hashlib import md5
+except ImportError: # Python < 2.5
+    from md5 import new as md5
+
+from nuxeo.capsule.base import Blob
+from nuxeo.capsule.base import Reference
+from nuxeo.jcr.controller import JCR_DATE_RE
+from nuxeo.jcr.interfaces import ProtocolError
+
+HEADER = 'JCRARCHIVE 1\n'
+TRAILER_SIZE = 22 # 'B' + 20 digits + '\n'
+CHUNK_SIZE = 65536
+
+
+class ArchiveWriter(object):
+    """Writes node states into an archive.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._blobs = TemporaryFile()
+        self._blobs_size = 0
+        self._digests = {} # digest -> (offset, length)
+        self._written = 0
+        self.count = 0
+        self._write(HEADER)
+
+    def _write(self, data):
+        self._f.write(data)
+        self._written += len(data)
+
+    def _writeline(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._write(data+'\n')
+
+    def addNode(self, uuid, name, parent_uuid, properties):
+        """Add a node.
+
+        ``properties`` is a sequence of (name, value) as returned by
+        ``IJCRController.getNodeStates``.
+        """
+        self._writeline('U%s %s' % (uuid, name))
+        if parent_uuid is not None:
+            self._writeline('^' + parent_uuid)
+        for key, value in properties:
+            if isinstance(value, list):
+                self._writeline('M' + key)
+                for v in value:
+                    self._writeValue(v)
+                self._writeline('M')
+            else:
+                self._writeline('P' + key)
+                self._writeValue(value)
+        self.count += 1
+
+    def addNodes(self, nodes):
+        """Add the nodes returned by ``IJCRController.exportNodes``.
+
+        If a node can't be written, the remaining ones are still read
+        before the error is raised, so that the end of the answer
+        doesn't stay unread on the connection to the server.
+        """
+        try:
+            for uuid, state in nodes:
+                name, parent_uuid, children, properties, deferred = state
+                if deferred:
+                    # Their values would have to be asked separately
+                    raise ProtocolError("Deferred properties %s of %s "
+                                        "cannot be exported" %
+                                        (', '.join(deferred), uuid))
+                self.addNode(uuid, name, parent_uuid, properties)
+        except:
+            exc = sys.exc_info()
+            try:
+                for node in nodes:
+                    pass
+            except ProtocolError:
+                # The answer was malformed, report the first error
+                pass
+            raise exc[0], exc[1], exc[2]
+
+    def _writeValue(self, value):
+        if isinstance(value, unicode):
+            v = value.encode('utf-8')
+            self._writeline('s%d' % len(v))
+            self._writeline(v)
+        elif isinstance(value, Blob):
+            offset, length = self._addBlob(value.data)
+            self._writeline('x%d %d' % (offset, length))
+        elif isinstance(value, str):
+            # Names and paths
+            self._writeline('n' + value)
+        elif isinstance(value, bool):
+            self._writeline('b' + str(value).lower())
+        elif isinstance(value, (int, long)):
+            self._writeline('l' + str(value))
+        elif isinstance(value, float):
+            self._writeline('f' + repr(value))
+        elif isinstance(value, datetime):
+            v = value.strftime('%Y-%m-%dT%H:%M:%S.%%03dZ')
+            self._writeline('d' + v % (value.microsecond / 1000))
+        elif isinstance(value, Reference):
+            self._writeline('r' + value.getTargetUUID())
+        else:
+            raise TypeError("Illegal value %r of type %s" %
+                            (value, type(value)))
+
+    def _addBlob(self, data):
+        digest = md5(data).digest()
+        info = self._digests.get(digest)
+        if info is None:
+            info = (self._blobs_size, len(data))
+            self._blobs.write(data)
+            self._blobs_size += len(data)
+            self._digests[digest] = info
+        return info
+
+    def close(self):
+        """Finish the archive, copying the blobs after the nodes.
+        """
+        self._write('.\n')
+        blobs_offset = self._written
+        blobs = self._blobs
+        blobs.seek(0)
+        while True:
+            chunk = blobs.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            self._write(chunk)
+        blobs.close()
+        self._write('B%020d\n' % blobs_offset)
+        self._f.flush()
+
+
+class ArchiveReader(object):
+    """Reads node states from an archive.
+
+    The file must be seekable, as binaries are read from the blob data
+    when the node referencing them is read.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._start = f.tell()
+        if f.readline() != HEADER:
+            raise ValueError("Not a JCR archive")
+        f.seek(-TRAILER_SIZE, 2)
+        trailer = f.read(TRAILER_SIZE)
+        if not trailer.startswith('B') or not trailer.endswith('\n'):
+            raise ValueError("Truncated JCR archive")
+        self._blobs_offset = self._start + int(trailer[1:-1])
+        f.seek(self._start + len(HEADER))
+
+    def _readline(self):
+        line = self._f.readline()
+        if not line.endswith('\n'):
+            raise ValueError("Truncated JCR archive")
+        return line[:-1]
+
+    def __iter__(self):
+        """Iterate on the nodes.
+
+        Yields (uuid, name, parent_uuid, properties).
+        """
+        line = self._readline()
+        while line != '.':
+            if not line.startswith('U'):
+                raise ValueError("Bad archive line %r" % line)
+            uuid, name = line[1:].split(' ', 1)
+            parent_uuid = None
+            properties = []
+            while True:
+                line = self._readline()
+                tag = line[:1]
+                if tag == '^':
+                    parent_uuid = line[1:]
+                elif tag == 'P':
+                    properties.append((unicode(line[1:], 'utf-8'),
+                                       self._readValue()))
+                elif tag == 'M':
+                    values = []
+                    while True:
+                        value = self._readValue()
+                        if value is None:
+                            break
+                        values.append(value)
+                    properties.append((unicode(line[1:], 'utf-8'), values))
+                else:
+                    break
+            yield uuid, unicode(name, 'utf-8'), parent_uuid, properties
+
+    def _readValue(self):
+        line = self._readline()
+        tag, rest = line[:1], line[1:]
+        if tag == 'M':
+            return None # end of multi-valued property
+        elif tag == 's':
+            data = self._f.read(int(rest) + 1)
+            if not data.endswith('\n'):
+                raise ValueError("Truncated JCR archive")
+            return unicode(data[:-1], 'utf-8')
+        elif tag == 'n':
+            return rest
+        elif tag == 'x':
+            offset, length = rest.split(' ')
+            return Blob(self._readBlob(int(offset), int(length)))
+        elif tag == 'b':
+            return rest == 'true'
+        elif tag == 'l':
+            return int(rest)
+        elif tag == 'f':
+            return float(rest)
+        elif tag == 'd':
+            m = JCR_DATE_RE.match(rest)
+            if m is None:
+                raise ValueError("Cannot parse date %r" % rest)
+            g = m.groups()
+            return datetime(int(g[0]), int(g[1]), int(g[2]),
+                            int(g[3]), int(g[4]), int(g[5]),
+                            int(g[6])*1000)
+        elif tag == 'r':
+            return Reference(rest)
+        raise ValueError("Bad archive value %r" % line)
+
+    def _readBlob(self, offset, length):
+        f = self._f
+        pos = f.tell()
+        f.seek(self._blobs_offset + offset)
+        data = f.read(length)
+        f.seek(pos)
+        if len(data) != length:
+            raise ValueError("Truncated JCR archive")
+        return data
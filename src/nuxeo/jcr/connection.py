@@ -30,6 +30,8 @@ import sys
 import time
 import logging
 import threading
+from tempfile import TemporaryFile
+from bisect import bisect_left
 from random import randrange
 
 from persistent import Persistent
@@ -49,16 +51,34 @@ from nuxeo.capsule.interfaces import IFrozenDocument
 from nuxeo.capsule.interfaces import IVersion
 from nuxeo.capsule.interfaces import IVersionHistory
 
+from nuxeo.jcr.interfaces import ProtocolError
 from nuxeo.jcr.impl import Document
 from nuxeo.jcr.impl import ObjectBase
 from nuxeo.jcr.impl import ContainerBase
 from nuxeo.jcr.impl import NoChildrenYet
 from nuxeo.jcr.impl import ObjectProperty
+from nuxeo.jcr.archive import ArchiveWriter
 
 
 _MARKER = object()
 
 
+def isOnlyResource(txn):
+    """Tell if a transaction has only one resource manager.
+
+    The transaction package has no API for this, so its private
+    `_resources` list is read. If it's not there, the answer is False,
+    so that the two-phase commit is used, and a warning is logged.
+    """
+    resources = getattr(txn, '_resources', None)
+    if resources is None:
+        logging.getLogger('nuxeo.jcr.connection').warning(
+            "Cannot count the resource managers of %r, "
+            "not committing in one phase", txn)
+        return False
+    return len(resources) == 1
+
+
 class Connection(object):
     """Capsule Connection.
 
@@ -136,11 +156,12 @@ class Connection(object):
         self.connections = {db.database_name: self}
 
         self._needs_to_join = True
+        self._one_phase = False # True if committed without a prepare
         self.transaction_manager = None
 
         self._opened = None # time.time() when DB.open() opened us
-        self._load_count = 0   # Number of objects unghosted XXX
-        self._store_count = 0  # Number of objects stored XXX
+        self._load_count = 0   # Number of objects unghosted
+        self._store_count = 0  # Number of objects stored
 
         controller = db.controller_class(db)
         self.controller = controller
@@ -167,6 +188,16 @@ class Connection(object):
         # Used for removes or reorderings
         self._commands = []
 
+        # With write-behind, savepoints don't wait for the server.
+        # Mapping of temporary oid to added objects that have been sent
+        # but whose final oid is not known yet
+        self._write_behind = getattr(db, 'write_behind', False)
+        self._unresolved = {}
+        # For each batch sent and not yet finished, its added objects
+        self._batches = []
+        # Temporary oids of objects to refetch once resolved
+        self._refetch = set()
+
         # Oid that is being just being marked _p_changed for which
         # we don't want register() to freak out.
         self._manual_register = None
@@ -259,6 +290,10 @@ class Connection(object):
 
         self._opened = None # XXX
 
+        am = self._db.getActivityMonitor()
+        if am is not None:
+            am.closedConnection(self)
+
     def cacheGC(self):
         """Reduce cache size to target size.
 
@@ -266,6 +301,17 @@ class Connection(object):
         """
         self._cache.incrgc()
 
+    def getTransferCounts(self, clear=False):
+        """Returns the number of objects loaded and stored.
+
+        Called by the ActivityMonitor when the connection is closed.
+        """
+        res = self._load_count, self._store_count
+        if clear:
+            self._load_count = 0
+            self._store_count = 0
+        return res
+
     ##################################################
 
     # Capsule API
@@ -378,7 +424,9 @@ class Connection(object):
 
         # XXX should be done by savepoint code
         # Remove from cache
-        del self._cache[oid]
+        if oid in self._unresolved:
+            self._sync()
+        del self._cache[obj._p_oid]
         # Remove link from object to its parent in case it's still live
         obj.__dict__['__parent__'] = None
 
@@ -400,7 +448,11 @@ class Connection(object):
         self.markChanged(obj)
 
         inserts = findInserts(old, new)
-        self._commands.append(('reorder', oid, inserts))
+        if 2 * len(inserts) > len(new):
+            # Big permutation, sending the full order is shorter
+            self._commands.append(('setorder', oid, list(new)))
+        else:
+            self._commands.append(('reorder', oid, inserts))
         self.savepoint()
 
     def _maybeJoin(self):
@@ -542,9 +594,15 @@ class Connection(object):
 
         This is half the 'prepare' phase of the two-phase commit, where
         the bulk of the objects are committed.
+
+        If we're the only resource manager in the transaction, the JCR
+        transaction is directly committed in one phase.
         """
-        self.savepoint()
-        self.controller.prepare()
+        if isOnlyResource(txn):
+            self._one_phase = True
+            self._savepoint('commit')
+        else:
+            self._savepoint('prepare')
 
     def tpc_vote(self, txn):
         """Verify that the transaction can be committed.
@@ -552,6 +610,8 @@ class Connection(object):
         This is the second half of the 'prepare' phase of the two-phase
         commit.
         """
+        if self._one_phase:
+            return
         self.controller.commit()
 
     def tpc_finish(self, txn):
@@ -572,6 +632,7 @@ class Connection(object):
         Also called before tpc_abort in two-phase commit if this
         resource manager has not voted.
         """
+        self._discardBatches()
         self.controller.abort()
         for oid in self._modified:
             self._cache.invalidate(oid)
@@ -580,6 +641,9 @@ class Connection(object):
         for obj in self._added.itervalues():
             del obj._p_jar
             del obj._p_oid
+        for obj in self._unresolved.itervalues():
+            del obj._p_jar
+            del obj._p_oid
         for oid in self._created:
             obj = self._cache[oid]
             del self._cache[oid]
@@ -602,12 +666,15 @@ class Connection(object):
         """
         self._modified = set()
         self._created = set()
+        self._unresolved = {}
+        self._refetch = set()
 
         self._conflicts.clear()
         #if not self._synch:
         #    self._flush_invalidations() # XXX invalidations
 
         self._needs_to_join = True
+        self._one_phase = False
 
         self._cleanup_savepoint()
 
@@ -615,7 +682,30 @@ class Connection(object):
     # Export/Import
 
     def exportFile(self, oid, f=None):
-        raise NotImplementedError
+        """Export the subtree starting at `oid` into an archive.
+
+        `f` is a file or a filename, if None a temporary file is used.
+        The node states are streamed from the server and written as
+        they arrive. Returns the file.
+        """
+        if f is None:
+            f = TemporaryFile()
+        elif isinstance(f, basestring):
+            f = open(f, 'w+b')
+        if self._registered or self._added or self._commands:
+            # The server exports what has been sent to it
+            self._savepoint()
+        else:
+            self._sync()
+        start = time.time()
+        writer = ArchiveWriter(f)
+        writer.addNodes(self.controller.exportNodes(oid))
+        writer.close()
+        elapsed = time.time() - start
+        self._log.info("Exported %d nodes from %s in %.2fs (%d nodes/s)",
+                       writer.count, oid, elapsed,
+                       writer.count / max(elapsed, 0.001))
+        return f
 
     def importFile(self, f, clue='', customImporters=None):
         raise NotImplementedError
@@ -655,6 +745,8 @@ class Connection(object):
         obj = self._cache.get(oid)
         if obj is None:
             obj = self._added.get(oid)
+            if obj is None:
+                obj = self._unresolved.get(oid)
         return obj
 
     def _makeGhost(self, oid, node_type):
@@ -666,6 +758,7 @@ class Connection(object):
         """
         if node_type is None:
             # XXX make sure we rarely call this
+            self._sync()
             node_type = self.controller.getNodeType(oid)
         klass = self._db.getClass(node_type)
         obj = klass.__new__(klass)
@@ -700,6 +793,7 @@ class Connection(object):
     def _setstate(self, obj):
         """Set the state on an object.
         """
+        self._sync() # may change the oid of new objects
         oid = obj._p_oid
         klass = obj.__class__
 
@@ -721,6 +815,7 @@ class Connection(object):
 
         # Put state on the object
         obj.__setstate__(state)
+        self._load_count += 1
 
 
     def _loadNodeState(self, obj, uuid):
@@ -806,6 +901,7 @@ class Connection(object):
         The path is relative to JCR workspace root and translated
         to remove 'ecm:children' components.
         """
+        self._sync()
         path = self.controller.getPath(uuid)
         if path is None:
             return None
@@ -822,6 +918,7 @@ class Connection(object):
         The paths are relative to JCR workspace root and translated
         to remove 'ecm:children' components.
         """
+        self._sync()
         results = self.controller.searchProperty(prop_name, value)
         res = []
         for uuid, path in results:
@@ -831,6 +928,23 @@ class Connection(object):
             res.append((uuid, str(path[1:])))
         return res
 
+    def changesSince(self, seq, limit=0):
+        """Get the changes of the workspace following a sequence number.
+
+        Returns (last_seq, changes) where changes is a list of (seq,
+        kind, uuid, path). The paths are relative to JCR workspace root
+        and translated to remove 'ecm:children' components.
+
+        Raises EventsLostError if the server journal doesn't go back to
+        `seq` anymore, the caller then has to rescan everything.
+        """
+        last, changes = self.controller.changesSince(seq, limit)
+        res = []
+        for change in changes:
+            path = change[3].replace('/ecm:children/', '/')
+            res.append(change[:3] + (path[1:],))
+        return last, res
+
     ##################################################
     # Move / Copy
 
@@ -838,7 +952,7 @@ class Connection(object):
         assert obj._p_jar is self
         assert destination._p_jar is self
         # Make sure all state is saved, and we have final oids
-        self.savepoint()
+        self._savepoint()
         oid = obj._p_oid
         assert oid is not None
         # Find real destination
@@ -861,7 +975,7 @@ class Connection(object):
         assert obj._p_jar is self
         assert destination._p_jar is self
         # Make sure all state is saved, and we have final oids
-        self.savepoint()
+        self._savepoint()
         oid = obj._p_oid
         assert oid is not None
         # Find real destination
@@ -880,7 +994,7 @@ class Connection(object):
 
     def checkpoint(self, obj):
         assert obj._p_jar is self
-        self.savepoint()
+        self._savepoint()
         oid = obj._p_oid
         assert oid is not None
         self.controller.checkpoint(oid)
@@ -895,7 +1009,7 @@ class Connection(object):
 
     def restore(self, obj, versionName):
         assert obj._p_jar is self
-        self.savepoint()
+        self._savepoint()
         oid = obj._p_oid
         assert oid is not None
         uuids = self.controller.restore(oid, versionName)
@@ -936,19 +1050,33 @@ class Connection(object):
         This operation is needed before a commit, or before any JCR
         operation that works on the persistently saved data, like
         copy or move.
+
+        With write-behind, the modifications are sent without waiting
+        for the result, which is only read at the next operation that
+        needs the server.
+        """
+        self._savepoint(wait=not self._write_behind)
+        return NoRollbackSavepoint()
+
+    def _savepoint(self, finish=None, wait=True):
+        """Send the current modifications to the JCR.
+
+        `finish` is passed to the controller to also prepare or commit
+        the transaction in the same round trip.
+
+        If `wait` is true, all the results are read, so that all
+        objects have their final oid.
         """
         self._maybeJoin()
 
         commands = self._saveCommands()
-        map = self.controller.sendCommands(commands)
+        if self.controller.startCommands(commands, finish=finish):
+            self._batches.append(self._added)
 
-        # Replace temporary oids with final ones, and put new objects in cache
-        for toid, obj in self._added.iteritems():
-            oid = map[toid]
-            obj._p_oid = oid
+        # New objects get their final oid when the result is read
+        for obj in self._added.itervalues():
             obj._p_changed = False
-            self._cache[oid] = obj
-            self._created.add(oid)
+        self._unresolved.update(self._added)
 
         # Remember modified objects
         for oid in self._registered.iterkeys():
@@ -958,7 +1086,64 @@ class Connection(object):
 
         self._cleanup_savepoint()
 
-        return NoRollbackSavepoint()
+        if wait:
+            self._sync()
+
+    def _sync(self):
+        """Read the results of the batches sent and not yet finished.
+
+        Replaces temporary oids with final ones, and puts new objects in
+        cache. Raises the first error, if any.
+        """
+        while self._batches:
+            added = self._batches.pop(0)
+            try:
+                map = self.controller.finishCommands()
+            except:
+                # The transaction is doomed, but keep the protocol in step
+                self._discardBatches()
+                raise
+            for toid, obj in added.iteritems():
+                self._resolve(toid, map[toid], obj)
+
+    def _resolve(self, toid, oid, obj):
+        """Give its final oid to a new object.
+        """
+        del self._unresolved[toid]
+        obj._p_oid = oid
+        self._cache[oid] = obj
+        self._created.add(oid)
+        self._modified.discard(toid)
+        # Changes done since it was sent
+        keys = self._registered.pop(toid, None)
+        if keys is not None:
+            self._registered[oid] = keys
+        if toid in self._refetch:
+            self._refetch.remove(toid)
+            if not obj._p_changed:
+                obj._p_deactivate()
+
+    def _discardBatches(self):
+        """Read and ignore the results of the batches not yet finished.
+        """
+        while self._batches:
+            self._batches.pop(0)
+            try:
+                self.controller.finishCommands()
+            except (ProtocolError, ConflictError):
+                pass
+
+    def refetch(self, obj):
+        """Make sure the state of a just saved object will be refetched.
+
+        This gets the properties computed by the JCR on save.
+        """
+        oid = obj._p_oid
+        if oid in self._unresolved:
+            # Wait until we know its oid
+            self._refetch.add(oid)
+        else:
+            obj._p_deactivate()
 
     def _cleanup_savepoint(self):
         self._registered = {}
@@ -974,6 +1159,7 @@ class Connection(object):
         - 'modify', uuid, props_mapping
         - 'remove', uuid
         - 'reorder', uuid, reordering_list
+        - 'setorder', uuid, names_list
         """
         for oid in self._added_order:
             obj = self._added[oid]
@@ -981,10 +1167,12 @@ class Connection(object):
             name = obj.__name__
             node_type = obj.getTypeName()
             props = self._collectSimpleProperties(obj)
+            self._store_count += 1
             yield ('add', puuid, name, node_type, props, oid)
         for oid, keys in self._registered.iteritems():
             obj = self._getFromCache(oid)
             props = self._collectProperties(obj, keys)
+            self._store_count += 1
             yield ('modify', oid, props)
         for command in self._commands:
             yield command
@@ -1028,24 +1216,50 @@ class NoRollbackSavepoint(object):
 
 def findInserts(old, new):
     """Find the 'insertBefore' commands needed to turn `old` into `new`.
+
+    Returns a list of (name, before), to be applied in order. If
+    `before` is None, `name` is moved to the end.
+
+    The names that don't move are a longest increasing subsequence of
+    their old positions taken in the new order, so the number of
+    inserts is minimal. Runs in O(n log n).
     """
-    if set(old) != set(new):
+    if len(old) != len(new) or set(old) != set(new):
         raise ValueError("Names mismatch (%r to %r)" % (old, new))
-    old = list(old)
-    new = list(new)
+    positions = dict((name, i) for i, name in enumerate(old))
+    keep = _longestIncreasing([positions[name] for name in new])
     inserts = []
-    # Change old until it's equal to new
-    # FIXME: stupid quadratic algorithm
-    while old != new:
-        for i, name in enumerate(new):
-            n = old[i]
-            # Find first difference
-            if n != name:
-                # Put name at position i in old
-                inserts.append((name, n)) # insert name before n
-                # Replay that in old
-                assert old.index(name) > i
-                old.remove(name)
-                old.insert(i, name)
-                break
+    # Go backwards, so that the name we insert before is already
+    # at its final place relative to the ones following it
+    before = None
+    for i in xrange(len(new)-1, -1, -1):
+        name = new[i]
+        if i not in keep:
+            inserts.append((name, before))
+        before = name
     return inserts
+
+
+def _longestIncreasing(seq):
+    """Find the indices of a longest increasing subsequence of `seq`.
+    """
+    tails = [] # index of the smallest tail of subsequences of length k+1
+    tail_values = []
+    previous = [None] * len(seq)
+    for i, value in enumerate(seq):
+        k = bisect_left(tail_values, value)
+        if k:
+            previous[i] = tails[k-1]
+        if k == len(tails):
+            tails.append(i)
+            tail_values.append(value)
+        else:
+            tails[k] = i
+            tail_values[k] = value
+    res = set()
+    if tails:
+        i = tails[-1]
+        while i is not None:
+            res.add(i)
+            i = previous[i]
+    return res
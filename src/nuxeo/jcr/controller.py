@@ -32,6 +32,8 @@ from nuxeo.capsule.base import Reference
 from nuxeo.jcr.interfaces import IJCRController
 from nuxeo.jcr.interfaces import ProtocolError
 from nuxeo.jcr.interfaces import ConflictError
+from nuxeo.jcr.interfaces import EventsLostError
+from nuxeo.jcr.monitor import JCRActivityMonitor
 
 
 DEBUG = False
@@ -40,6 +42,45 @@ logger = logging.getLogger('nuxeo.jcr.controller')
 JCR_DATE_RE = re.compile(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})'
                          r'.(\d{3})(.*)')
 
+# Line ending a batch of commands, depending on how it finishes
+BATCH_ENDS = {
+    None: '.',
+    'prepare': 'p', # also prepare the transaction
+    'commit': 'c', # also commit the transaction in one phase
+    }
+
+# Batches started and not finished above which the results of the
+# oldest ones are read ahead. The server stops reading commands while
+# too many of its answers are unread, so neither side could go on.
+MAX_UNREAD_BATCHES = 16
+MAX_UNREAD_BYTES = 262144 # sent since the oldest unread batch
+
+def command(tag):
+    """Decorator timing a command into the activity monitor, if any.
+
+    Commands that don't talk to the server aren't recorded.
+    """
+    def decorator(method):
+        def timed(self, *args, **kw):
+            monitor = self._monitor
+            if monitor is None:
+                return method(self, *args, **kw)
+            start = time.time()
+            sent = self.bytes_sent
+            received = self.bytes_received
+            try:
+                return method(self, *args, **kw)
+            finally:
+                if self.bytes_sent != sent:
+                    monitor.commandDone(tag, time.time() - start,
+                                        self.bytes_sent - sent,
+                                        self.bytes_received - received)
+        timed.__name__ = method.__name__
+        timed.__doc__ = method.__doc__
+        return timed
+    return decorator
+
+
 def unicodeName(name):
     try:
         return unicode(name, 'utf-8')
@@ -57,11 +98,30 @@ class JCRController(object):
     zope.interface.implements(IJCRController)
 
     _sock = None
+    _dirty = False # something was sent in the current transaction
+    _sent = False # something was sent since the last receive
+
+    # Transfer statistics
+    bytes_sent = 0
+    bytes_received = 0
+    round_trips = 0 # waits for the server after sending something
+
+    _session = None # number of the session in the recording
 
     def __init__(self, db):
         # db.server is a ZConfig.datatypes.SocketConnectionAddress
         self._server = db.server
+        self._recorder = getattr(db, 'recorder', None)
         self._unprocessed = []
+        self._pending_batches = [] # (finish, bytes_sent) of unread batches
+        self._finished = [] # (map, exc_info) of batches read ahead
+        self._monitor = None
+        if hasattr(db, 'getActivityMonitor'):
+            monitor = db.getActivityMonitor()
+            if isinstance(monitor, JCRActivityMonitor):
+                self._monitor = monitor
+                # start time and bytes sent of batches not yet read
+                self._batch_starts = []
 
     def connect(self):
         """Connect the controller to the server.
@@ -81,17 +141,46 @@ class JCRController(object):
                 raise
             break
         self._sock = sock
+        if self._recorder is not None:
+            self._session = self._recorder.open()
         self._readline() # XXX Welcome message
 
+    def close(self):
+        """See IJCRController.
+        """
+        if self._sock is None:
+            return
+        self._writeline('q') # quit, no answer
+        self._sock.close()
+        self._sock = None
+        if self._session is not None:
+            self._recorder.closed(self._session)
+            self._session = None
+
     # Note: we don't bother using select and multiplexing reads with
     # writes, as the server side will be sufficiently intelligent to
-    # buffer in both directions and will therefore prevent deadlocks.
+    # buffer in both directions and will therefore prevent deadlocks,
+    # as long as pipelined batches are read regularly (see _readAhead).
 
     def _write(self, data):
         if DEBUG:
             print 'XXX > %r' % data
         self._sock.sendall(data)
         # could get error: (32, 'Broken pipe')
+        self.bytes_sent += len(data)
+        self._sent = True
+        if self._session is not None:
+            self._recorder.sent(self._session, data)
+
+    def _recv(self):
+        chunk = self._sock.recv(8192)
+        self.bytes_received += len(chunk)
+        if self._session is not None:
+            self._recorder.received(self._session, chunk)
+        if self._sent:
+            self._sent = False
+            self.round_trips += 1
+        return chunk
 
     def _writeline(self, data):
         try:
@@ -116,7 +205,7 @@ class JCRController(object):
                 return self._extract(i, todo)
             todo -= length
         while True:
-            chunk = self._sock.recv(8192)
+            chunk = self._recv()
             if not chunk: # EOF
                 raise IOError("JCR server disconnected")
                 # next recv() gets error: (54, 'Connection reset by peer')
@@ -134,7 +223,7 @@ class JCRController(object):
             if pos >= 0:
                 return self._extract(i, pos, 1)
         while True:
-            chunk = self._sock.recv(8192)
+            chunk = self._recv()
             if not chunk: # EOF
                 raise IOError("JCR server disconnected")
             self._unprocessed.append(chunk)
@@ -165,6 +254,7 @@ class JCRController(object):
 
     # API
 
+    @command('L')
     def login(self, workspaceName):
         """See IJCRController.
         """
@@ -175,6 +265,7 @@ class JCRController(object):
         root_uuid = line[1:]
         return root_uuid
 
+    @command('D')
     def getNodeTypeDefs(self):
         """See IJCRController.
         """
@@ -187,6 +278,7 @@ class JCRController(object):
             lines.append(line)
         return '\n'.join(lines)
 
+    @command('T')
     def getNodeType(self, uuid):
         """See IJCRController.
         """
@@ -197,15 +289,31 @@ class JCRController(object):
         node_type = line[1:]
         return node_type
 
+    @command('S')
     def getNodeStates(self, uuids):
         """See IJCRController.
         """
         self._writeline('S' + ' '.join(uuids))
+        infos = {}
+        for node_uuid, info in self._readNodeStates():
+            infos[node_uuid] = info
+        return infos
+
+    def exportNodes(self, uuid):
+        """See IJCRController.
+        """
+        self._writeline('e' + uuid)
+        return self._readNodeStates()
+
+    def _readNodeStates(self):
+        """Generator reading node states up to the final '.'.
+
+        Yields (uuid, (name, parent_uuid, children, properties, deferred)).
+        """
         line = self._readline()
         if line.startswith('!'):
             raise ProtocolError(line)
         self._pushback(line)
-        infos = {}
         while True:
             parent_uuid = None
             children = []
@@ -245,11 +353,10 @@ class JCRController(object):
                     deferred.append(unicodeName(name))
                 else:
                     raise ProtocolError(line)
-            infos[node_uuid] = (unicodeName(node_name), parent_uuid,
-                                children, properties, deferred)
+            yield node_uuid, (unicodeName(node_name), parent_uuid,
+                              children, properties, deferred)
             if tag == '.':
                 break
-        return infos
 
     def _readString(self, line):
         length = int(line)
@@ -328,13 +435,25 @@ class JCRController(object):
             raise ProtocolError(line)
         return reader(self, line[1:])
 
-    def sendCommands(self, commands):
+    def sendCommands(self, commands, finish=None):
         """See IJCRController.
         """
+        if not self.startCommands(commands, finish=finish):
+            return {}
+        return self.finishCommands()
+
+    def startCommands(self, commands, save_every=0, finish=None):
+        """See IJCRController.
+        """
+        start = time.time()
+        sent = self.bytes_sent
         starting = True
         for command in commands:
             if starting:
-                self._writeline('M')
+                if save_every:
+                    self._writeline('M%d' % save_every)
+                else:
+                    self._writeline('M')
                 starting = False
             op = command[0]
             if op == 'add':
@@ -358,21 +477,79 @@ class JCRController(object):
                 uuid, inserts = command[1:]
                 self._writeline('%'+uuid)
                 for name, before in inserts:
+                    if before is None:
+                        before = '' # move to the end
                     try:
                         self._writeline(name+'/'+before)
                     except UnicodeError:
                         raise UnicodeError("Unicode problem with %r + %r" %
                                            (name, before))
                 self._writeline('%')
+            elif op == 'setorder':
+                uuid, names = command[1:]
+                self._writeline('#'+uuid)
+                for name in names:
+                    self._writeline(name)
+                self._writeline('/') # cannot be a name
             else:
                 raise ProtocolError("invalid op %r" % (op,))
 
         if starting:
-            return {}
+            if finish is None or not self._dirty:
+                return False
+            # Nothing to send, but the transaction has to finish
+            self._writeline('M')
 
         # End of commands
-        self._writeline('.')
+        self._writeline(BATCH_ENDS[finish])
+        self._pending_batches.append((finish, sent))
+        if self._monitor is not None:
+            self._batch_starts.append((start, self.bytes_sent - sent))
+        self._dirty = True
+        self._readAhead()
+        return True
+
+    def _readAhead(self):
+        """Read the results of the oldest batches if too many are unread.
+
+        They're kept, errors included, for finishCommands.
+        """
+        pending = self._pending_batches
+        while len(pending) > 1 and (
+            len(pending) > MAX_UNREAD_BATCHES or
+            self.bytes_sent - pending[0][1] > MAX_UNREAD_BYTES):
+            try:
+                map = self._readBatch()
+            except (ProtocolError, ConflictError):
+                self._finished.append((None, sys.exc_info()))
+            else:
+                self._finished.append((map, None))
+
+    def finishCommands(self):
+        """See IJCRController.
+        """
+        if self._finished:
+            map, exc = self._finished.pop(0)
+            if exc is not None:
+                raise exc[0], exc[1], exc[2]
+            return map
+        if not self._pending_batches:
+            raise ProtocolError("No batch of commands to finish")
+        return self._readBatch()
+
+    def _readBatch(self):
+        finish = self._pending_batches.pop(0)[0]
+        if self._monitor is None:
+            return self._finishCommands(finish)
+        start, sent = self._batch_starts.pop(0)
+        received = self.bytes_received
+        try:
+            return self._finishCommands(finish)
+        finally:
+            self._monitor.commandDone('M', time.time() - start, sent,
+                                      self.bytes_received - received)
 
+    def _finishCommands(self, finish):
         # Read tokens -> uuid mapping
         map = {}
         while True:
@@ -383,6 +560,14 @@ class JCRController(object):
                 raise ProtocolError(line)
             token, uuid = line.split(' ')
             map[token] = uuid
+
+        if finish is not None:
+            line = self._readline()
+            if finish == 'commit' or line != '.':
+                # The server started a new transaction
+                self._dirty = False
+            if line != '.':
+                raise ConflictError(line)
         return map
 
     def _sendProp(self, key, value, allow_none=False):
@@ -442,56 +627,111 @@ class JCRController(object):
         """
         raise NotImplementedError('Unused')
 
+    @command('E')
     def getPendingEvents(self):
         """See IJCRController.
         """
-        raise NotImplementedError('Unused')
+        self._writeline('E')
+        events, lost = self._readEvents()
+        if lost:
+            raise EventsLostError(events)
+        return events
+
+    @command('J')
+    def changesSince(self, seq, limit=0):
+        """See IJCRController.
+        """
+        self._writeline('J%d %d' % (seq, limit))
+        line = self._readline()
+        if not line.startswith('J'):
+            raise ProtocolError(line)
+        last = int(line[1:])
+        events, lost = self._readEvents()
+        if lost:
+            raise EventsLostError(events, last)
+        return last, events
+
+    def _readEvents(self):
+        events = []
+        lost = False
+        while True:
+            line = self._readline()
+            if line == '.':
+                break
+            tag = line[:1]
+            if tag == 'v':
+                seq, kind, uuid, path = line[1:].split(' ', 3)
+                if uuid == '-':
+                    uuid = None
+                events.append((int(seq), kind, uuid, unicode(path, 'utf-8')))
+            elif tag == 'o':
+                lost = True
+            else:
+                raise ProtocolError(line)
+        return events, lost
 
+    @command('p')
     def prepare(self):
         """See IJCRController.
         """
+        if not self._dirty:
+            return
         self._writeline('p')
         line = self._readline()
         if line == '.':
             return
+        self._dirty = False # the server rolled back
         raise ConflictError(line)
 
+    @command('c')
     def commit(self):
         """See IJCRController.
         """
+        if not self._dirty:
+            return
+        self._dirty = False
         self._writeline('c')
         line = self._readline()
         if line == '.':
             return
         raise ConflictError(line)
 
+    @command('r')
     def abort(self):
         """See IJCRController.
         """
+        if not self._dirty:
+            return
+        self._dirty = False
         self._writeline('r') # rollback
         line = self._readline()
         if line == '.':
             return
         raise ConflictError(line)
 
+    @command('i')
     def checkpoint(self, uuid):
         """See IJCRController.
         """
+        self._dirty = True
         self._writeline('i'+uuid)
         line = self._readline()
         if line == '.':
             return
         raise ProtocolError(line)
 
+    @command('t')
     def restore(self, uuid, versionName=''):
         """See IJCRController.
         """
+        self._dirty = True
         self._writeline('t'+uuid+' '+versionName)
         line = self._readline()
         if line.startswith('.'):
             return line[1:].split(',')
         raise ProtocolError(line)
 
+    @command('/')
     def getPath(self, uuid):
         """See IJCRController.
         """
@@ -501,6 +741,7 @@ class JCRController(object):
             return None
         return unicode(line, 'utf-8')
 
+    @command('s')
     def searchProperty(self, prop_name, value):
         """See IJCRController.
         """
@@ -517,20 +758,40 @@ class JCRController(object):
             res.append((uuid, path))
         return res
 
+    @command('m')
     def move(self, uuid, dest_uuid, name):
         """See IJCRController.
         """
+        self._dirty = True
         self._writeline('m%s %s %s' % (uuid, dest_uuid, name.encode('utf-8')))
         line = self._readline()
         if line == '.':
             return
         raise ProtocolError(line)
 
+    @command('C')
     def copy(self, uuid, dest_uuid, name):
         """See IJCRController.
         """
+        self._dirty = True
         self._writeline('C%s %s %s' % (uuid, dest_uuid, name.encode('utf-8')))
         line = self._readline()
         if line == '.':
             return
         raise ProtocolError(line)
+
+    @command('I')
+    def getStats(self):
+        """See IJCRController.
+        """
+        self._writeline('I')
+        stats = {}
+        while True:
+            line = self._readline()
+            if line == '.':
+                break
+            if line.startswith('!'):
+                raise ProtocolError(line)
+            name, value = line.split(' ', 1)
+            stats[name] = int(value)
+        return stats
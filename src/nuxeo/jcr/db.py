@@ -34,6 +34,7 @@ from nuxeo.jcr.impl import ObjectProperty
 from nuxeo.jcr.impl import ListProperty
 from nuxeo.jcr.connection import Connection
 from nuxeo.jcr.controller import JCRController
+from nuxeo.jcr.recorder import Recorder
 
 
 class DB(ZODBDB):
@@ -46,6 +47,7 @@ class DB(ZODBDB):
     # this lock protects schema creation
     _schemas_load_lock = None # threading.Lock
     _schema_manager = None # SchemaManager
+    recorder = None # Recorder of the traffic with the server
 
     def __init__(self,
                  database_name='unnamed-jcr',
@@ -54,19 +56,35 @@ class DB(ZODBDB):
                  pool_size=7,
                  server=None,
                  workspace_name='default',
+                 write_behind=False,
+                 record_file=None,
                  ):
         """Create a database which connects to a JCR.
+
+        With `write_behind`, connections send their savepoints without
+        waiting for the server to process them.
+
+        With `record_file`, the traffic of all the connections with the
+        server is recorded into it (see nuxeo.jcr.recorder).
         """
         self._schemas_load_lock = threading.Lock()
 
         self.server = server # ZConfig.datatypes.SocketConnectionAddress
         self.workspace_name = workspace_name
+        self.write_behind = write_behind
+        if record_file is not None:
+            self.recorder = Recorder(record_file)
         super(DB, self).__init__(NoStorage(),
                                  pool_size=pool_size,
                                  cache_size=cache_size,
                                  database_name=database_name,
                                  databases=databases)
 
+    def close(self):
+        super(DB, self).close()
+        if self.recorder is not None:
+            self.recorder.close()
+
     def loadSchemas(self, controller):
         """Load the schemas from the database, and synthesizes
         the needed interfaces and classes.
@@ -202,7 +202,7 @@ class ContainerBase(CapsuleContainerBase):
             self._order.append(name)
         # Save and refetch to update JCR system properties (versioning)
         self._p_jar.savepoint()
-        child._p_deactivate()
+        self._p_jar.refetch(child)
         return child
 
     def removeChild(self, name):
@@ -0,0 +1,358 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Bulk import of nodes.
+
+Creating documents through a Connection does a savepoint for each of
+them. The importer bypasses the Connection and sends the nodes directly
+to the server in batches of 'add' commands, several batches being in
+flight at the same time. The server saves every few thousand nodes, and
+the transaction is committed regularly, so an import is not atomic.
+
+Nodes can come from an archive written by ``Connection.exportFile``, or
+from a tree file with one line per node, parents before children::
+
+  /path<TAB>node-type[<TAB>name=value...]
+
+where the path is relative to the import point. Values are strings,
+UTF-8 encoded, using backslash escapes for tabs and newlines. Empty
+lines and lines starting with '#' are ignored.
+
+Connections that already loaded the import point will only see the new
+nodes once they are invalidated.
+"""
+
+import sys
+import time
+import logging
+import threading
+from Queue import Queue
+
+from nuxeo.jcr.interfaces import ProtocolError
+from nuxeo.jcr.interfaces import ConflictError
+from nuxeo.jcr.archive import ArchiveReader
+
+logger = logging.getLogger('nuxeo.jcr.importer')
+
+QUEUE_SIZE = 5000 # nodes waiting for a worker
+
+
+def archiveNodes(f):
+    """Iterate on the nodes of an archive, for the importer.
+
+    Properties maintained by the JCR itself are not imported.
+    """
+    root_uuid = None
+    for uuid, name, parent_uuid, properties in ArchiveReader(f):
+        if root_uuid is None:
+            root_uuid = uuid
+            parent_uuid = None # the import point
+        node_type = None
+        props = {}
+        for key, value in properties:
+            if key == 'jcr:primaryType':
+                node_type = value
+            elif not key.startswith('jcr:'):
+                props[key] = value
+        yield uuid, parent_uuid, name, node_type, props
+
+
+def treeNodes(f):
+    """Iterate on the nodes of a tree file, for the importer.
+    """
+    for line in f:
+        line = line.rstrip('\r\n')
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        path = fields[0]
+        if len(fields) < 2 or not path.startswith('/'):
+            raise ValueError("Bad tree line %r" % line)
+        parent_path, name = path.rstrip('/').rsplit('/', 1)
+        props = {}
+        for field in fields[2:]:
+            key, value = field.split('=', 1)
+            props[key] = unicode(value.decode('string_escape'), 'utf-8')
+        yield (path, parent_path or None, unicode(name, 'utf-8'),
+               fields[1], props)
+
+
+class ImportSession(object):
+    """Imports nodes through one controller, thus one server session.
+
+    Nodes are identified by a key chosen by the caller, and are added
+    under an already known parent. The key None is the import point.
+    """
+
+    def __init__(self, controller, batch_size=500, save_every=1000,
+                 commit_every=20000, pipeline=4):
+        self.controller = controller
+        self.batch_size = batch_size
+        self.save_every = save_every
+        self.commit_every = commit_every
+        self.pipeline = pipeline # batches in flight
+        self.count = 0
+        self._uuids = {} # key -> uuid, or token if not known yet
+        self._tokens = {} # token -> key
+        self._next_token = 0
+        self._batch = []
+        self._in_flight = 0
+        self._uncommitted = 0
+        self._start = time.time()
+
+    def setUUID(self, key, uuid):
+        """Set the uuid of an existing node.
+        """
+        self._uuids[key] = uuid
+
+    def getUUID(self, key):
+        """Get the uuid of a committed node.
+        """
+        return self._uuids[key]
+
+    def hasUncommitted(self):
+        return self._uncommitted != 0
+
+    def add(self, key, parent_key, name, node_type, properties):
+        """Add a node.
+        """
+        try:
+            parent = self._uuids[parent_key]
+        except KeyError:
+            raise ValueError("Unknown parent %r for %r" % (parent_key, key))
+        self._next_token += 1
+        token = 'I%d' % self._next_token
+        self._uuids[key] = token
+        self._tokens[token] = key
+        self._batch.append(('add', parent, name, node_type, properties,
+                            token))
+        self.count += 1
+        self._uncommitted += 1
+        if len(self._batch) >= self.batch_size:
+            self._send()
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def _send(self, finish=None):
+        batch = self._batch
+        self._batch = []
+        if self.controller.startCommands(batch, self.save_every, finish):
+            self._in_flight += 1
+        while self._in_flight > self.pipeline:
+            self._receive()
+
+    def _receive(self):
+        self._in_flight -= 1
+        map = self.controller.finishCommands()
+        uuids = self._uuids
+        for token, uuid in map.iteritems():
+            uuids[self._tokens.pop(token)] = uuid
+
+    def commit(self):
+        """Commit the nodes added so far.
+        """
+        self._send('commit')
+        while self._in_flight:
+            self._receive()
+        self._uncommitted = 0
+        elapsed = time.time() - self._start
+        logger.info("Committed %d nodes in %.2fs (%d nodes/s)",
+                    self.count, elapsed, self.count / max(elapsed, 0.001))
+
+    def abort(self):
+        """Abort the nodes added since the last commit.
+        """
+        self._batch = []
+        while self._in_flight:
+            try:
+                self._receive()
+            except (ProtocolError, ConflictError):
+                pass
+        self.controller.abort()
+        for key in self._tokens.itervalues():
+            del self._uuids[key]
+        self._tokens.clear()
+        self.count -= self._uncommitted
+        self._uncommitted = 0
+
+
+class ImportWorker(threading.Thread):
+    """Thread importing the nodes it's given into its own session.
+    """
+
+    def __init__(self, session):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.session = session
+        self.queue = Queue(QUEUE_SIZE)
+        self.exc_info = None
+
+    def run(self):
+        session = self.session
+        queue = self.queue
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                key, parent_key, parent_uuid, name, node_type, props = item
+                if parent_uuid is not None:
+                    # New parent committed by the main session, start a
+                    # transaction that sees it
+                    session.commit()
+                    session.setUUID(parent_key, parent_uuid)
+                session.add(key, parent_key, name, node_type, props)
+            session.commit()
+        except:
+            self.exc_info = sys.exc_info()
+            logger.error("Import worker failed", exc_info=True)
+            try:
+                session.abort()
+            except:
+                pass
+            # Consume what's left so that the dispatcher never blocks
+            while item is not None:
+                item = queue.get()
+
+
+class Importer(object):
+    """Bulk importer of nodes under a given node.
+
+    With several `workers`, the nodes down to `split_depth` levels
+    below the import point are created first, then the children of each
+    of the deepest of them are imported by one of the workers, each
+    using its own server session. The nodes must thus come from the
+    source in an order where parents come before their children.
+    """
+
+    def __init__(self, db, parent_uuid, workers=1, split_depth=1,
+                 batch_size=500, save_every=1000, commit_every=20000,
+                 pipeline=4):
+        self.db = db
+        self.parent_uuid = parent_uuid
+        self.workers = workers
+        self.split_depth = split_depth
+        self.batch_size = batch_size
+        self.save_every = save_every
+        self.commit_every = commit_every
+        self.pipeline = pipeline
+
+    def importArchive(self, f):
+        """Import an archive, returns the number of nodes imported.
+        """
+        return self.run(archiveNodes(f))
+
+    def importTree(self, f):
+        """Import a tree file, returns the number of nodes imported.
+        """
+        return self.run(treeNodes(f))
+
+    def _openSession(self):
+        db = self.db
+        controller = db.controller_class(db)
+        controller.connect()
+        controller.login(db.workspace_name)
+        session = ImportSession(controller, self.batch_size,
+                                self.save_every, self.commit_every,
+                                self.pipeline)
+        session.setUUID(None, self.parent_uuid)
+        return session
+
+    def run(self, nodes):
+        """Import the nodes.
+
+        `nodes` is an iterable of (key, parent_key, name, node_type,
+        properties), where the key None is the import point.
+
+        Returns the number of nodes imported.
+        """
+        start = time.time()
+        if self.workers > 1:
+            count = self._runParallel(nodes)
+        else:
+            session = self._openSession()
+            try:
+                try:
+                    for key, parent_key, name, node_type, props in nodes:
+                        session.add(key, parent_key, name, node_type, props)
+                    session.commit()
+                except:
+                    session.abort()
+                    raise
+            finally:
+                session.controller.close()
+            count = session.count
+        elapsed = time.time() - start
+        logger.info("Imported %d nodes in %.2fs (%d nodes/s)",
+                    count, elapsed, count / max(elapsed, 0.001))
+        return count
+
+    def _runParallel(self, nodes):
+        main = self._openSession()
+        workers = []
+        for i in range(self.workers):
+            worker = ImportWorker(self._openSession())
+            worker.start()
+            workers.append(worker)
+        split_depth = self.split_depth
+        depths = {None: 0} # key -> depth, for nodes created by main
+        owners = {} # key -> worker, for the others
+        next_worker = 0
+        try:
+            try:
+                for key, parent_key, name, node_type, props in nodes:
+                    depth = depths.get(parent_key)
+                    if depth is not None and depth < split_depth:
+                        main.add(key, parent_key, name, node_type, props)
+                        depths[key] = depth + 1
+                        continue
+                    worker = owners.get(parent_key)
+                    parent_uuid = None
+                    if depth is not None and worker is None:
+                        # First level handled by workers, the parent's
+                        # uuid goes with its first child only
+                        worker = workers[next_worker % len(workers)]
+                        next_worker += 1
+                        owners[parent_key] = worker
+                        if main.hasUncommitted():
+                            main.commit()
+                        parent_uuid = main.getUUID(parent_key)
+                    elif worker is None:
+                        raise ValueError("Unknown parent %r for %r" %
+                                         (parent_key, key))
+                    if worker.exc_info is not None:
+                        break
+                    owners[key] = worker
+                    worker.queue.put((key, parent_key, parent_uuid,
+                                      name, node_type, props))
+                main.commit()
+            except:
+                main.abort()
+                raise
+        finally:
+            for worker in workers:
+                worker.queue.put(None)
+            for worker in workers:
+                worker.join()
+                worker.session.controller.close()
+            main.controller.close()
+        for worker in workers:
+            if worker.exc_info is not None:
+                t, v, tb = worker.exc_info
+                raise t, v, tb
+        count = main.count
+        for worker in workers:
+            count += worker.session.count
+        return count
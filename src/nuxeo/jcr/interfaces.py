@@ -24,19 +24,39 @@ class ProtocolError(ValueError):
     pass
 
 
+class EventsLostError(Exception):
+    """Some events are not available anymore.
+
+    The events that are still available are in the ``events`` attribute,
+    and ``seq`` is the sequence number of the last event if known.
+    """
+
+    def __init__(self, events, seq=None):
+        Exception.__init__(self, "Events lost")
+        self.events = events
+        self.seq = seq
+
+
 class IJCRController(Interface):
     """Commands between Zope and the JCR bridge.
 
-    All commands are synchronous.
+    All commands are synchronous, except that batches of modification
+    commands can be pipelined using startCommands.
 
-    The commands may also return JCR events, if some have been sent.
-    They are accumulated and can be read by ``getPendingEvents()``.
+    The JCR events of the workspace are accumulated by the server and
+    can be read by ``getPendingEvents()``.
     """
 
     def connect():
         """Connect the controller to the server.
         """
 
+    def close():
+        """Close the connection to the server.
+
+        The current transaction, if any, is rolled back.
+        """
+
     def login(workspaceName):
         """Login to a given workspace.
 
@@ -49,15 +69,24 @@ class IJCRController(Interface):
     def prepare():
         """Prepare the current transaction for commit.
 
+        Nothing is done if nothing was sent to the server during the
+        transaction.
+
         May raise a ConflictError.
         """
 
     def commit():
         """Commit the prepared transaction, start a new one.
+
+        Nothing is done if nothing was sent to the server during the
+        transaction.
         """
 
     def abort():
         """Abort the current transaction, start a new one.
+
+        Nothing is done if nothing was sent to the server during the
+        transaction.
         """
 
     def checkpoint(uuid):
@@ -107,6 +136,17 @@ class IJCRController(Interface):
         An error is returned if there's no such UUID.
         """
 
+    def exportNodes(uuid):
+        """Get the states of all the nodes of a subtree.
+
+        Returns an iterator of (`uuid`, `state`), where `state` is a
+        tuple as returned by ``getNodeStates``. Parents come before
+        their children, and children are in order.
+
+        The states are streamed, the iterator must be exhausted before
+        any other command is sent.
+        """
+
     def getNodeProperties(uuid, names):
         """Get the value of selected properties.
 
@@ -116,26 +156,69 @@ class IJCRController(Interface):
         names doesn't exist as a property.
         """
 
-    def sendCommands(commands):
+    def sendCommands(commands, finish=None):
         """Send a sequence of modification commands to the JCR.
 
         `commands` is an iterable returning tuples of the form:
         - 'add', parent_uuid, name, node_type, props_mapping, token
         - 'modify', uuid, props_mapping
         - 'remove', uuid
-        - 'order' XXX
+        - 'reorder', uuid, inserts (sequence of (name, before_name),
+          where a `before_name` of None means the end)
+        - 'setorder', uuid, names (the full new order of the children)
 
         A JCR save() is done after the commands have been sent.
 
+        If `finish` is 'prepare', the transaction is then prepared, as
+        with prepare(). If it is 'commit', the transaction is committed
+        in one phase and a new one is started. This is all done in one
+        round trip to the server. A ConflictError is raised if the
+        transaction cannot be prepared or committed.
+
         Returns a mapping of token -> uuid, which gives the new UUIDs
         for created nodes.
         """
 
+    def startCommands(commands, save_every=0, finish=None):
+        """Send a sequence of modification commands without waiting.
+
+        `commands` and `finish` are as for sendCommands. The result of the batch
+        must later be read by finishCommands, batches being finished
+        in the order they were started. This allows several batches
+        to be in flight at the same time.
+
+        Tokens stay valid until the end of the transaction, so later
+        batches may refer to nodes created by earlier ones before
+        their result has been read.
+
+        If `save_every` is not 0, the JCR save() is not done at the
+        end of the batch but every `save_every` commands, and before
+        any other command.
+
+        Returns True if a batch was sent, False if there were no
+        commands.
+        """
+
+    def finishCommands():
+        """Read the result of the oldest batch sent by startCommands.
+
+        Returns a mapping of token -> uuid, which gives the new UUIDs
+        for created nodes of that batch.
+        """
+
     def getPendingEvents():
         """Get pending events.
 
-        The pending events are sent asynchronously by the server and
-        accumulated until read by this method.
+        The server accumulates the events of the workspace since the
+        login or the previous call, and returns them in order.
+
+        Returns a list of (seq, kind, uuid, path), where kind is one of
+        NODE_ADDED, NODE_REMOVED, PROPERTY_ADDED, PROPERTY_REMOVED,
+        PROPERTY_CHANGED, and uuid is the one of the node concerned, or
+        None if unknown.
+
+        Raises EventsLostError if the server had to drop some events
+        that weren't read in time.
         """
 
     def getPath(uuid):
@@ -161,3 +244,24 @@ class IJCRController(Interface):
     def copy(uuid, dest_uuid, name):
         """Copy the document to another container.
         """
+
+    def changesSince(seq, limit=0):
+        """Get the changes of the workspace following a sequence number.
+
+        The server keeps a journal of the last events of the workspace.
+        At most `limit` changes are returned, or a server maximum if 0.
+
+        Returns (last_seq, changes) where last_seq is the sequence
+        number of the last change in the journal, and changes is a list
+        of (seq, kind, uuid, path) as for getPendingEvents.
+
+        Raises EventsLostError if changes following `seq` are not in the
+        journal anymore, or if `seq` is past the last change (the journal
+        was started anew since).
+        """
+
+    def getStats():
+        """Get statistics about the server.
+
+        Returns a mapping of names to integers.
+        """
@@ -0,0 +1,155 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Activity monitor of a JCR DB.
+"""
+
+import threading
+
+from ZODB.ActivityMonitor import ActivityMonitor
+
+# Upper bounds of the latency histogram buckets, in milliseconds. The
+# last bucket holds the slower commands.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class CommandStats(object):
+    """Counts, bytes and latency histogram of one protocol command.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    def add(self, elapsed, sent, received):
+        self.count += 1
+        self.seconds += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        self.bytes_sent += sent
+        self.bytes_received += received
+        ms = elapsed * 1000
+        i = 0
+        for bound in BUCKETS:
+            if ms <= bound:
+                break
+            i += 1
+        self.histogram[i] += 1
+
+    def percentile(self, q):
+        """Get the upper bound in ms of the bucket of a percentile.
+
+        None if it's in the last bucket.
+        """
+        todo = self.count * q
+        for i, n in enumerate(self.histogram):
+            todo -= n
+            if todo <= 0 and n:
+                break
+        if i < len(BUCKETS):
+            return BUCKETS[i]
+        return None
+
+    def asDict(self):
+        return {
+            'count': self.count,
+            'seconds': self.seconds,
+            'max': self.max,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'histogram': list(self.histogram),
+            }
+
+
+class JCRActivityMonitor(ActivityMonitor):
+    """Activity monitor also recording the commands sent to the server.
+
+    The loads and stores are the ones of ZODB's ActivityMonitor,
+    counted by the connections. Commands are identified by their
+    protocol letter, batches of modifications being 'M'.
+    """
+
+    def __init__(self, history_length=3600):
+        ActivityMonitor.__init__(self, history_length)
+        self._commands_lock = threading.Lock()
+        self._commands = {}
+
+    def commandDone(self, command, elapsed, sent, received):
+        """Record a command that took `elapsed` seconds.
+        """
+        self._commands_lock.acquire()
+        try:
+            stats = self._commands.get(command)
+            if stats is None:
+                stats = self._commands[command] = CommandStats()
+            stats.add(elapsed, sent, received)
+        finally:
+            self._commands_lock.release()
+
+    def getCommandStats(self, clear=False):
+        """Get the statistics of the commands since the last clear.
+
+        Returns a mapping of command to a dict with the count, the
+        total and max seconds, the bytes sent and received, and the
+        histogram of the latencies (see BUCKETS).
+        """
+        self._commands_lock.acquire()
+        try:
+            res = {}
+            for command, stats in self._commands.iteritems():
+                res[command] = stats.asDict()
+            if clear:
+                self._commands = {}
+            return res
+        finally:
+            self._commands_lock.release()
+
+    def dump(self, clear=False):
+        """Dump the command statistics as text, one line per command.
+
+        Meant for logs and the control panel, for instance::
+
+          S count=1200 avg_ms=1.52 p50_ms=2 p99_ms=20 max_ms=35.10
+            sent=45120 received=8830211 hist=1:310,2:700,5:150,...
+        """
+        self._commands_lock.acquire()
+        try:
+            commands = self._commands.items()
+            if clear:
+                self._commands = {}
+        finally:
+            self._commands_lock.release()
+        commands.sort()
+        lines = []
+        for command, stats in commands:
+            hist = []
+            for i, n in enumerate(stats.histogram):
+                if i < len(BUCKETS):
+                    hist.append('%d:%d' % (BUCKETS[i], n))
+                else:
+                    hist.append('inf:%d' % n)
+            p50 = stats.percentile(0.50)
+            p99 = stats.percentile(0.99)
+            lines.append(
+                '%s count=%d avg_ms=%.2f p50_ms=%s p99_ms=%s max_ms=%.2f '
+                'sent=%d received=%d hist=%s' % (
+                command, stats.count, stats.seconds * 1000 / stats.count,
+                p50 or 'inf', p99 or 'inf', stats.max * 1000,
+                stats.bytes_sent, stats.bytes_received, ','.join(hist)))
+        return '\n'.join(lines)
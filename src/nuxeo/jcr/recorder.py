@@ -0,0 +1,150 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Recording of the traffic between controllers and a JCR server.
+
+All the controllers of a DB write into the same recording, each
+connection to the server being a session.
+
+Format::
+
+  JCRRECORD 1
+  frame*
+
+Each frame is a 17 bytes header followed by its data::
+
+  kind      1 byte, OPEN, SENT, RECEIVED or CLOSE
+  session   4 bytes, unsigned, big endian
+  time      8 bytes, microseconds since the start of the recording
+  length    4 bytes, length of the data
+
+SENT frames hold what was written to the server, RECEIVED frames the
+chunks read from it, in the order they happened.
+"""
+
+import time
+import struct
+import threading
+
+HEADER = 'JCRRECORD 1\n'
+FRAME = '>cIQI'
+FRAME_SIZE = struct.calcsize(FRAME)
+
+OPEN = 'o'
+SENT = '>'
+RECEIVED = '<'
+CLOSE = 'c'
+
+
+class Recorder(object):
+    """Writes timestamped frames of the sessions into a file.
+
+    Used by several threads at once.
+    """
+
+    def __init__(self, f):
+        if isinstance(f, basestring):
+            f = open(f, 'wb')
+        self._f = f
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._next_session = 0
+        self._f.write(HEADER)
+
+    def _record(self, kind, session, data=''):
+        elapsed = int((time.time() - self._start) * 1000000)
+        header = struct.pack(FRAME, kind, session, elapsed, len(data))
+        self._lock.acquire()
+        try:
+            if self._f is None:
+                return
+            self._f.write(header)
+            if data:
+                self._f.write(data)
+        finally:
+            self._lock.release()
+
+    def open(self):
+        """Start a session, returns its number.
+        """
+        self._lock.acquire()
+        try:
+            self._next_session += 1
+            session = self._next_session
+        finally:
+            self._lock.release()
+        self._record(OPEN, session)
+        return session
+
+    def sent(self, session, data):
+        self._record(SENT, session, data)
+
+    def received(self, session, data):
+        self._record(RECEIVED, session, data)
+
+    def closed(self, session):
+        self._record(CLOSE, session)
+
+    def close(self):
+        """Close the recording.
+
+        Frames recorded afterwards are dropped.
+        """
+        self._lock.acquire()
+        try:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+        finally:
+            self._lock.release()
+
+
+def readFrames(f):
+    """Iterate on the (kind, session, time, data) of a recording.
+
+    The time is in seconds since the start of the recording.
+    """
+    if isinstance(f, basestring):
+        f = open(f, 'rb')
+    if f.read(len(HEADER)) != HEADER:
+        raise ValueError("Not a JCR recording")
+    while True:
+        header = f.read(FRAME_SIZE)
+        if not header:
+            break
+        if len(header) < FRAME_SIZE:
+            raise ValueError("Truncated JCR recording")
+        kind, session, elapsed, length = struct.unpack(FRAME, header)
+        data = f.read(length)
+        if len(data) < length:
+            raise ValueError("Truncated JCR recording")
+        yield kind, session, elapsed / 1000000.0, data
+
+
+def readSessions(f):
+    """Read a recording, grouping the frames by session.
+
+    Returns a list of (session, frames) ordered by start of session,
+    where frames are (kind, time, data).
+    """
+    sessions = {}
+    order = []
+    for kind, session, elapsed, data in readFrames(f):
+        frames = sessions.get(session)
+        if frames is None:
+            frames = sessions[session] = []
+            order.append(session)
+        frames.append((kind, elapsed, data))
+    return [(session, sessions[session]) for session in order]
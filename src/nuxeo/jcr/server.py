@@ -44,16 +44,22 @@ DEBUG_RAISE = 0
 import os
 import sys
 import time
+import thread
+import jarray
+from bisect import bisect_left
 from types import ListType
 
 import java.io
 import java.util
+import java.security
 import java.net
 import java.nio
 import java.nio.charset
 import java.nio.channels
 from java.nio.channels import SelectionKey
 from java.lang import IllegalArgumentException
+from EDU.oswego.cs.dl.util.concurrent import PooledExecutor
+from EDU.oswego.cs.dl.util.concurrent import LinkedQueue
 
 import javax.jcr
 from javax.jcr import RepositoryException # toplevel exception
@@ -71,6 +77,7 @@ from javax.transaction.xa import Xid
 from org.apache.jackrabbit.core import TransientRepository
 from org.apache.jackrabbit.core.nodetype.compact import \
      CompactNodeTypeDefReader
+from javax.jcr.observation import EventListener
 from org.apache.jackrabbit.core.observation import SynchronousEventListener
 
 
@@ -82,12 +89,46 @@ NODETYPEDEFS = None
 
 CREDENTIALS = javax.jcr.SimpleCredentials('username', 'password')
 
-CHARSET = java.nio.charset.Charset.forName('ISO-8859-1')
-latinDecoder = CHARSET.newDecoder()
-latinEncoder = CHARSET.newEncoder()
+# Initial size of the input buffer of a session
+INBUF_SIZE = 8192
 
-# Used to hold binary data string on output
-BYTEARRAY = java.nio.ByteBuffer.allocate(16384).array()
+# Size of the reused output buffers of a session, and how many to keep
+OUTBUF_SIZE = 8192
+OUTBUF_SPARE = 4
+
+# Maximum number of buffers written at once
+GATHER_MAX = 64
+
+# Binaries are sent in chunks of this size
+BINARY_CHUNK = 65536
+
+# Children of a node listed at most in one step of its state output
+CHILDREN_STEP = 1000
+
+# Binaries received bigger than this are spooled to a temporary file
+SPOOL_SIZE = 1048576
+
+# Output buffered for a session above which the session stops producing
+# output, reading and processing commands, and below which it resumes
+HIGH_WATER = 1048576
+LOW_WATER = 262144
+
+# Output buffered for all sessions above which sessions are throttled
+# down to LOW_WATER
+OUTPUT_BUDGET = 67108864
+
+# Number of events kept in the journal of a workspace
+EVENT_BUFFER = 100000
+
+# Maximum number of events returned at once
+EVENTS_MAX = 1000
+
+# Size in bytes of the node state cache, and of its biggest entry
+CACHE_SIZE = 33554432
+CACHE_ENTRY_MAX = 262144
+
+# Default number of threads processing the commands
+WORKERS = 8
 
 
 def dumpValueToString(value):
@@ -126,30 +167,628 @@ def dumpNode(node, spaces, output):
 def timestampe():
     return time.strftime("%Y-%m-%d %H:%M:%S")
 
-class Listener(SynchronousEventListener):
+def orderInserts(current, wanted):
+    """Find the minimal (name, before) moves turning `current` into `wanted`.
 
-    strings = {
-        NODE_ADDED: 'NODE_ADDED',
-        NODE_REMOVED: 'NODE_REMOVED',
-        PROPERTY_ADDED: 'PROPERTY_ADDED',
-        PROPERTY_REMOVED: 'PROPERTY_REMOVED',
-        PROPERTY_CHANGED: 'PROPERTY_CHANGED',
-        }
+    A `before` of None means the end. The names that don't move are a
+    longest increasing subsequence of their current positions.
+    """
+    positions = {}
+    for i in range(len(current)):
+        positions[current[i]] = i
+    tails = []
+    tail_values = []
+    previous = [None] * len(wanted)
+    for i in range(len(wanted)):
+        value = positions[wanted[i]]
+        k = bisect_left(tail_values, value)
+        if k:
+            previous[i] = tails[k-1]
+        if k == len(tails):
+            tails.append(i)
+            tail_values.append(value)
+        else:
+            tails[k] = i
+            tail_values[k] = value
+    keep = {}
+    if tails:
+        i = tails[-1]
+        while i is not None:
+            keep[i] = None
+            i = previous[i]
+    inserts = []
+    before = None
+    for i in range(len(wanted)-1, -1, -1):
+        name = wanted[i]
+        if not keep.has_key(i):
+            inserts.append((name, before))
+        before = name
+    return inserts
+
+EVENT_TYPES = (NODE_ADDED | NODE_REMOVED |
+               PROPERTY_ADDED | PROPERTY_REMOVED | PROPERTY_CHANGED)
+
+EVENT_NAMES = {
+    NODE_ADDED: 'NODE_ADDED',
+    NODE_REMOVED: 'NODE_REMOVED',
+    PROPERTY_ADDED: 'PROPERTY_ADDED',
+    PROPERTY_REMOVED: 'PROPERTY_REMOVED',
+    PROPERTY_CHANGED: 'PROPERTY_CHANGED',
+    }
+
+def eventUUID(event):
+    """Get the UUID of the node concerned by an event, if known.
+
+    Only Jackrabbit events have this information.
+    """
+    try:
+        if event.getType() in (NODE_ADDED, NODE_REMOVED):
+            return event.getChildUUID()
+        return event.getParentUUID()
+    except AttributeError:
+        return None
+
+class Journal:
+    """Bounded journal of changes, optionally persisted to a file.
+
+    Entries are (seq, kind, uuid, path), the path being UTF-8 encoded.
+    The last `size` entries are kept in a ring buffer. The file has one
+    line per entry, and is rewritten with only the entries kept when it
+    gets too long.
+    """
+
+    def __init__(self, size, path=None):
+        self.size = size
+        self.buffer = [None] * size # seq % size -> entry
+        self.seq = 0 # Sequence number of the last entry
+        self.lock = thread.allocate_lock()
+        self.path = path
+        self.file = None
+        self.lines = 0 # Lines in the file
+        if path is not None:
+            self.load()
+            self.file = open(path, 'a')
+
+    def load(self):
+        try:
+            f = open(self.path, 'r')
+        except IOError:
+            return
+        try:
+            while 1:
+                line = f.readline()
+                if not line:
+                    break
+                if not line.endswith('\n'):
+                    # Truncated by a crash
+                    break
+                seq, kind, uuid, path = line[:-1].split('\t', 3)
+                if uuid == '-':
+                    uuid = None
+                seq = int(seq)
+                self.buffer[seq % self.size] = (seq, kind, uuid, path)
+                self.seq = seq
+                self.lines = self.lines + 1
+        finally:
+            f.close()
+        if self.lines > self.size:
+            self.rewrite()
+
+    def rewrite(self):
+        """Rewrite the file with only the entries kept.
+        """
+        if self.file is not None:
+            self.file.close()
+        entries, lost = self.getEntries(self.seq - self.size)
+        tmp = self.path + '.tmp'
+        f = open(tmp, 'w')
+        for entry in entries:
+            f.write(self.formatEntry(entry))
+        f.close()
+        os.rename(tmp, self.path)
+        self.lines = len(entries)
+        if self.file is not None:
+            self.file = open(self.path, 'a')
+
+    def formatEntry(self, entry):
+        seq, kind, uuid, path = entry
+        return '%d\t%s\t%s\t%s\n' % (seq, kind, uuid or '-', path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def append(self, entries):
+        """Append entries given as (kind, uuid, path).
+        """
+        self.lock.acquire()
+        try:
+            buffer = self.buffer
+            size = self.size
+            seq = self.seq
+            lines = []
+            for entry in entries:
+                seq = seq + 1
+                entry = (seq,) + entry
+                buffer[seq % size] = entry
+                if self.file is not None:
+                    lines.append(self.formatEntry(entry))
+            self.seq = seq
+            if self.file is not None:
+                self.file.write(''.join(lines))
+                self.file.flush()
+                self.lines = self.lines + len(lines)
+                if self.lines > 2 * size:
+                    self.rewrite()
+        finally:
+            self.lock.release()
+
+    def getEntries(self, seq, limit=0):
+        """Get the entries following seq, at most limit if not 0.
+
+        Returns a list of (seq, kind, uuid, path), and whether entries
+        following seq are not available anymore. They're also lost if
+        seq is past the last entry, as it then comes from a previous
+        journal, not persisted across a restart.
+        """
+        last = self.seq
+        if seq > last:
+            return [], 1
+        first = seq + 1
+        if first < 1:
+            first = 1
+        lost = first <= last - self.size
+        if lost:
+            first = last - self.size + 1
+        if limit and last - first + 1 > limit:
+            last = first + limit - 1
+        buffer = self.buffer
+        size = self.size
+        entries = []
+        for i in range(first, last+1):
+            entries.append(buffer[i % size])
+        return entries, lost
+
+    def getChanges(self, seq, limit=0):
+        """Get the entries following seq, see getEntries.
+        """
+        self.lock.acquire()
+        try:
+            return self.getEntries(seq, limit)
+        finally:
+            self.lock.release()
+
+
+class NodeStateCache:
+    """Cache of the encoded node states, shared by all sessions.
+
+    Keys are 'workspace uuid', values the bytes sent for the node by
+    getNodeStates. The least recently used entries are evicted to stay
+    under a total size in bytes.
+
+    Entries are invalidated synchronously when a change is saved. The
+    generation is incremented for each invalidation, so that a state
+    read from the JCR while an invalidation happened isn't stored.
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.map = java.util.LinkedHashMap(1024, 0.75, True) # LRU order
+        self.bytes = 0
+        self.generation = 0
+        self.lock = thread.allocate_lock()
+        self.stats = {
+            'cache_hits': 0,
+            'cache_misses': 0,
+            'cache_evictions': 0,
+            'cache_invalidations': 0,
+            }
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            data = self.map.get(key)
+            if data is None:
+                self.stats['cache_misses'] = self.stats['cache_misses'] + 1
+            else:
+                self.stats['cache_hits'] = self.stats['cache_hits'] + 1
+            return data
+        finally:
+            self.lock.release()
+
+    def put(self, key, data, generation):
+        """Store data read when the cache was at the given generation.
+        """
+        n = len(data)
+        if n > CACHE_ENTRY_MAX:
+            return
+        self.lock.acquire()
+        try:
+            if generation != self.generation:
+                # Maybe stale
+                return
+            old = self.map.put(key, data)
+            if old is not None:
+                self.bytes = self.bytes - len(old)
+            self.bytes = self.bytes + n
+            if self.bytes > self.size:
+                iter = self.map.entrySet().iterator()
+                while self.bytes > self.size and iter.hasNext():
+                    entry = iter.next()
+                    self.bytes = self.bytes - len(entry.getValue())
+                    iter.remove()
+                    self.stats['cache_evictions'] = (
+                        self.stats['cache_evictions'] + 1)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, workspaceName, uuids):
+        """Invalidate the states of some nodes, or all if uuids is None.
+        """
+        self.lock.acquire()
+        try:
+            self.generation = self.generation + 1
+            if uuids is None:
+                n = self.map.size()
+                self.map.clear()
+                self.bytes = 0
+            else:
+                n = 0
+                for uuid in uuids:
+                    old = self.map.remove(workspaceName + ' ' + uuid)
+                    if old is not None:
+                        self.bytes = self.bytes - len(old)
+                        n = n + 1
+            self.stats['cache_invalidations'] = (
+                self.stats['cache_invalidations'] + n)
+        finally:
+            self.lock.release()
+
+    def getStats(self):
+        self.lock.acquire()
+        try:
+            items = self.stats.items()
+            items.append(('cache_bytes', self.bytes))
+            items.append(('cache_entries', self.map.size()))
+        finally:
+            self.lock.release()
+        return items
 
-    def __init__(self, processor, name):
-        self.processor = processor
-        self.name = name
 
-    def _eventString(self, type):
-        return self.strings.get(type, str(type))
+class CacheInvalidator(SynchronousEventListener):
+    """Invalidates the cached states of the nodes changed by a save.
+
+    It is synchronous so that the cache is up to date when the save or
+    commit returns, but it does very little work.
+    """
+
+    def __init__(self, cache, workspaceName):
+        self.cache = cache
+        self.workspaceName = workspaceName
 
     def onEvent(self, events):
+        uuids = {}
         while events.hasNext():
             event = events.nextEvent()
-            print "XXX %s: event %-16s path %s" % (
-                self.name,
-                self._eventString(event.getType()),
-                event.getPath())
+            try:
+                # The parent's children or properties change
+                uuid = event.getParentUUID()
+                if event.getType() in (NODE_ADDED, NODE_REMOVED):
+                    uuids[event.getChildUUID()] = None
+            except AttributeError:
+                # Not Jackrabbit, don't know what changed
+                uuids = None
+                break
+            uuids[uuid] = None
+        if uuids is not None:
+            uuids = uuids.keys()
+        self.cache.invalidate(self.workspaceName, uuids)
+
+
+class EventHub(EventListener):
+    """Observation listener shared by all the sessions of a workspace.
+
+    Events are delivered asynchronously by the JCR after each save, so
+    saves aren't slowed down by the sessions connected. They are kept
+    in a journal, from which each session reads them starting at its
+    own sequence number.
+    """
+
+    def __init__(self, server, workspaceName):
+        self.server = server
+        path = None
+        if server.journal_dir is not None:
+            path = os.path.join(server.journal_dir,
+                                'journal-%s.log' % workspaceName)
+        self.journal = Journal(EVENT_BUFFER, path)
+        self.session = server.repository.login(CREDENTIALS, workspaceName)
+        om = self.session.getWorkspace().getObservationManager()
+        isDeep = True
+        noLocal = False
+        om.addEventListener(self, EVENT_TYPES, '/',
+                            isDeep, None, None, noLocal)
+        self.invalidator = CacheInvalidator(server.cache, workspaceName)
+        om.addEventListener(self.invalidator, EVENT_TYPES, '/',
+                            isDeep, None, None, noLocal)
+
+    def getSeq(self):
+        """Get the sequence number of the last event.
+        """
+        return self.journal.seq
+
+    def close(self):
+        om = self.session.getWorkspace().getObservationManager()
+        om.removeEventListener(self)
+        om.removeEventListener(self.invalidator)
+        self.session.logout()
+        self.journal.close()
+
+    def onEvent(self, events):
+        entries = []
+        while events.hasNext():
+            event = events.nextEvent()
+            type = event.getType()
+            entries.append((EVENT_NAMES.get(type, str(type)),
+                            eventUUID(event),
+                            event.getPath().encode('utf-8')))
+        self.journal.append(entries)
+        self.server.addStat('events', len(entries))
+
+    def getEvents(self, seq, limit=0):
+        """Get the events following seq, at most limit if not 0.
+
+        Returns a list of (seq, kind, uuid, path), and whether events
+        following seq are not available anymore.
+        """
+        return self.journal.getChanges(seq, limit)
+
+
+class CaptureAborted(Exception):
+    """Output too big to be captured.
+    """
+
+
+class Producer:
+    """Output of a command written in steps, see Processor.produce.
+
+    A step writes a bounded amount of output, possibly pushing other
+    producers whose output comes first, and returns 0 once done.
+    """
+
+    def step(self):
+        return 0
+
+    def close(self):
+        """Release what's held, the output won't be finished.
+        """
+        pass
+
+
+class BinaryProducer(Producer):
+    """Writes a binary, a chunk of BINARY_CHUNK bytes per step.
+    """
+
+    def __init__(self, processor, value, length=-1):
+        self.processor = processor
+        self.value = value
+        self.length = length
+        self.started = 0
+        self.stream = None # InputStream, until closed
+        self.left = 0 # Bytes still to write
+
+    def step(self):
+        processor = self.processor
+        if not self.started:
+            self.started = 1
+            self.stream = self.value.getStream()
+            self.value = None
+            if self.length < 0:
+                # Unknown length, read it all
+                out = java.io.ByteArrayOutputStream()
+                array = jarray.zeros(BINARY_CHUNK, 'b')
+                while 1:
+                    n = self.stream.read(array)
+                    if n == -1:
+                        break
+                    out.write(array, 0, n)
+                processor.writeln('x%d' % out.size())
+                processor.writeBuffer(
+                    java.nio.ByteBuffer.wrap(out.toByteArray()))
+            else:
+                processor.writeln('x%d' % self.length)
+                self.left = self.length
+            return 1
+        left = self.left
+        if left > 0:
+            bbuf = java.nio.ByteBuffer.allocate(min(left, BINARY_CHUNK))
+            n = self.stream.read(bbuf.array())
+            if n == -1:
+                raise ValueError("Binary shorter than %d bytes" %
+                                 self.length)
+            bbuf.limit(n)
+            processor.writeBuffer(bbuf)
+            self.left = left - n
+            return 1
+        processor.writeln('')
+        self.close()
+        return 0
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+
+class NodeStateProducer(Producer):
+    """Writes the state of a node.
+
+    The uuid, parent and children come first, CHILDREN_STEP children at
+    a time, then the properties, up to the next binary one.
+    """
+
+    def __init__(self, processor, node):
+        self.processor = processor
+        self.node = node
+        self.children = None # NodeIterator, once the header is written
+        self.properties = None # PropertyIterator, once children are written
+        self.types = None
+        self.binaries = None # (value, length) left of a multiple property
+
+    def step(self):
+        processor = self.processor
+        node = self.node
+        if self.children is None:
+            # Node UUID and name
+            processor.writeln('U%s %s' % (node.getUUID(), node.getName()))
+            # Parent
+            try:
+                parent_uuid = node.getParent().getUUID()
+            except (ItemNotFoundException,
+                    javax.jcr.UnsupportedRepositoryOperationException):
+                # Parent may not exist
+                # Parent may not be referenceable (rep:versionStorage)
+                pass
+            else:
+                processor.writeln('^%s' % parent_uuid)
+            self.children = node.getNodes()
+            return 1
+        if self.properties is None:
+            # Children
+            children = self.children
+            count = 0
+            while count < CHILDREN_STEP and children.hasNext():
+                subnode = children.nextNode()
+                nodeName = subnode.getName()
+                if nodeName in ('jcr:system', 'jcr:versionLabels'):
+                    # These aren't referenceable
+                    continue
+                try:
+                    subuuid = subnode.getUUID()
+                except javax.jcr.UnsupportedRepositoryOperationException:
+                    print "XXX %s is not referenceable" % subnode.getPath()
+                    continue
+                nodeType = subnode.getPrimaryNodeType().getName()
+                processor.writeln('N%s %s %s' % (subuuid, nodeType, nodeName))
+                count = count + 1
+            if children.hasNext():
+                return 1
+            types = [node.getPrimaryNodeType().getName()]
+            for mixin in node.getMixinNodeTypes():
+                types.append(mixin.getName())
+            self.types = ' '.join(types)
+            self.properties = node.getProperties()
+        if self.binaries is not None:
+            # Values of a multiple binary property
+            if self.binaries:
+                value, length = self.binaries.pop(0)
+                processor.pushProducer(BinaryProducer(processor, value,
+                                                      length))
+                return 1
+            self.binaries = None
+            processor.writeln('M')
+        # Properties
+        properties = self.properties
+        types = self.types
+        while properties.hasNext():
+            prop = properties.nextProperty()
+            name = prop.getName()
+            binary = prop.getType() == javax.jcr.PropertyType.BINARY
+            if processor.isMultiple(types, prop):
+                values = prop.getValues()
+                processor.writeln('M%s' % name)
+                if binary:
+                    lengths = prop.getLengths()
+                    self.binaries = []
+                    for i in range(len(values)):
+                        self.binaries.append((values[i], lengths[i]))
+                    return 1
+                for value in values:
+                    processor.dumpValue(value)
+                processor.writeln('M')
+            else:
+                processor.writeln('P%s' % name)
+                if binary:
+                    processor.pushProducer(BinaryProducer(
+                        processor, prop.getValue(), prop.getLength()))
+                    return 1
+                processor.dumpValue(prop.getValue())
+        return 0
+
+
+class StatesProducer(Producer):
+    """Writes node states, one per step, followed by '.'.
+
+    States are cached encoded states, or nodes captured for the cache
+    if it's given and they're not too big.
+    """
+
+    def __init__(self, processor, states, cache=None):
+        self.processor = processor
+        self.states = states
+        self.cache = cache
+        self.index = 0
+
+    def step(self):
+        processor = self.processor
+        states = self.states
+        if self.index == len(states):
+            processor.writeln('.')
+            return 0
+        state = states[self.index]
+        states[self.index] = None
+        self.index = self.index + 1
+        if hasattr(state, 'getUUID'):
+            data = None
+            if self.cache is not None:
+                data = processor.captureNodeState(state, self.cache)
+            if data is None:
+                # Not cacheable, or too big to be captured
+                processor.pushProducer(NodeStateProducer(processor, state))
+                return 1
+            state = data
+        processor.writeBuffer(java.nio.ByteBuffer.wrap(state))
+        return 1
+
+
+class ExportProducer(Producer):
+    """Writes the states of a subtree followed by '.'.
+
+    The walk is depth-first, parents before their children, keeping only
+    an iterator per level. A state is written per step.
+    """
+
+    def __init__(self, processor, node):
+        self.processor = processor
+        self.node = node
+        self.stack = None
+
+    def step(self):
+        processor = self.processor
+        if self.stack is None:
+            node = self.node
+            self.node = None
+            processor.pushProducer(NodeStateProducer(processor, node))
+            self.stack = [node.getNodes()]
+            return 1
+        stack = self.stack
+        while stack:
+            nodes = stack[-1]
+            if not nodes.hasNext():
+                stack.pop()
+                continue
+            node = nodes.nextNode()
+            if node.getName() in ('jcr:system', 'jcr:versionLabels'):
+                continue
+            try:
+                node.getUUID()
+            except javax.jcr.UnsupportedRepositoryOperationException:
+                continue
+            processor.pushProducer(NodeStateProducer(processor, node))
+            stack.append(node.getNodes())
+            return 1
+        processor.writeln('.')
+        return 0
 
 
 class XidImpl(Xid):
@@ -171,17 +810,82 @@ class Processor:
     root = None
     prepared = False
     xidcounter = 0
+    modified = False # the transaction changed something
+    capture = None # ByteArrayOutputStream capturing the output
+    captured = 0 # bytes captured so far
+
+    # (node types, property name) -> property is multiple
+    # Node types are registered at startup, so this is never invalidated
+    multiple = {}
+    tokens = None # token -> uuid for the current transaction
+    spooled = () # (stream, file) of the spooled binaries of a command
+    save_every = 0 # save every n commands, 0 for each batch
+    unsaved = 0 # commands not yet saved
+    versioned = None # uuid -> None for the states changed by versioning
 
     def __init__(self, io, repository):
         self.io = io
         self.repository = repository
         self.continuations = []
+        self.producers = [] # Producers of the output not written yet
 
     def write(self, s):
-        self.io.write(s)
+        if self.capture is not None:
+            self.countCaptured(len(s))
+            self.capture.write(java.lang.String(s).getBytes('ISO-8859-1'))
+        else:
+            self.io.write(s)
 
     def writeln(self, s):
-        self.io.write(s+'\n')
+        self.write(s+'\n')
+
+    def writeBuffer(self, bbuf):
+        capture = self.capture
+        if capture is not None:
+            self.countCaptured(bbuf.remaining())
+            capture.write(bbuf.array(), bbuf.arrayOffset()+bbuf.position(),
+                          bbuf.remaining())
+            return
+        self.io.writeBuffer(bbuf)
+
+    def pushProducer(self, producer):
+        """Have the output of a producer written before going on.
+        """
+        self.producers.append(producer)
+
+    def produce(self):
+        """Run the producers until their output is complete.
+
+        Returns 0 if it stopped early because the session is paused, the
+        rest is produced once the client has read enough of the output.
+        Captured output is always complete.
+        """
+        producers = self.producers
+        while producers:
+            if self.capture is None and self.io.paused:
+                return 0
+            last = len(producers) - 1
+            if not producers[last].step():
+                del producers[last]
+        return 1
+
+    def discardProducers(self):
+        """Forget the output not produced yet.
+        """
+        producers = self.producers
+        self.producers = []
+        for producer in producers:
+            producer.close()
+
+    def countCaptured(self, n):
+        """Account for n more bytes captured.
+
+        Raises CaptureAborted as soon as the capture is too big to be
+        cached, before copying more of it.
+        """
+        self.captured = self.captured + n
+        if self.captured > CACHE_ENTRY_MAX:
+            raise CaptureAborted
 
 
     def cmdHelp(self, line=None):
@@ -207,24 +911,22 @@ class Processor:
     def login(self, workspaceName):
         session = self.repository.login(CREDENTIALS, workspaceName)
         self.session = session
+        self.workspaceName = workspaceName
         self.xaresource = session.getXAResource()
         self.new()
-
-        om = self.session.getWorkspace().getObservationManager()
-        listener = Listener(self, workspaceName)
-        eventTypes = (NODE_ADDED | NODE_REMOVED |
-                      PROPERTY_ADDED | PROPERTY_REMOVED | PROPERTY_CHANGED)
-        isDeep = True
-        noLocal = False
-        om.addEventListener(listener, eventTypes, '/',
-                            isDeep, None, None, noLocal)
-
+        # Events are read from the time of login
+        self.hub = self.io.server.getEventHub(workspaceName)
+        self.event_seq = self.hub.getSeq()
 
     def new(self, end=None):
         self.xidcounter += 1
         self.xid = XidImpl(self.xidcounter)
         self.xaresource.start(self.xid, XAResource.TMNOFLAGS)
         self.prepared = False
+        self.tokens = {}
+        self.unsaved = 0
+        self.modified = False
+        self.versioned = {}
 
     def _trapXAException(self, func, *args):
         try:
@@ -252,28 +954,45 @@ class Processor:
             return self.writeln("!Already prepared.")
         msg = self._trapXAException(self.xaresource.prepare, self.xid)
         if msg is not None:
-            self.xaresource.end(self.xid, XAResource.TMFAIL)
-            self.rollback()
-            self.new()
+            self.failTransaction()
         else:
             msg = '.'
             self.prepared = True
         self.writeln(msg)
 
+    def failTransaction(self):
+        """Rollback the transaction after a failure, start a new one.
+        """
+        self.xaresource.end(self.xid, XAResource.TMFAIL)
+        self.rollback()
+        self.new()
+
     def cmdCommit(self, line=None):
         if not self.prepared:
             return self.writeln("!Not prepared.")
+        self.commit(False)
+
+    def commit(self, onePhase):
         # End association before commit
         self.xaresource.end(self.xid, XAResource.TMSUCCESS)
-        msg = self._trapXAException(self.xaresource.commit, self.xid, False)
+        msg = self._trapXAException(self.xaresource.commit, self.xid,
+                                    onePhase)
         if msg is not None:
             self.rollback()
         else:
             msg = '.'
+            if self.versioned:
+                # Others may have cached them meanwhile
+                self.io.server.cache.invalidate(self.workspaceName,
+                                                self.versioned.keys())
         self.new()
         self.writeln(msg)
 
     def cmdRollback(self, line=None):
+        if self.unsaved:
+            # Discard transient changes
+            self.unsaved = 0
+            self.session.refresh(False)
         # End association before rollback
         self.xaresource.end(self.xid, XAResource.TMFAIL)
         msg = self.rollback()
@@ -290,6 +1009,7 @@ class Processor:
         self.io.close()
 
     def logout(self):
+        self.releaseSpooled()
         if self.session is not None:
             self._trapXAException(self.rollback)
             self.session.logout()
@@ -297,6 +1017,44 @@ class Processor:
     def cmdStop(self, line=None):
         raise SystemExit
 
+    def cmdEvents(self, line=None):
+        if self.session is None:
+            return self.writeln("!Not logged in.")
+        events, lost = self.hub.getEvents(self.event_seq, EVENTS_MAX)
+        if lost:
+            self.writeln('o')
+        self.writeEvents(events)
+        if events:
+            self.event_seq = events[-1][0]
+        self.writeln('.')
+
+    def writeEvents(self, events):
+        for seq, kind, uuid, path in events:
+            self.writeln('v%d %s %s %s' % (seq, kind, uuid or '-', path))
+
+    def cmdJournal(self, line):
+        if self.session is None:
+            return self.writeln("!Not logged in.")
+        try:
+            seq, limit = line.split(' ')
+            seq = int(seq)
+            limit = int(limit)
+        except ValueError:
+            return self.writeln("!Bad journal request %s" % line)
+        if not limit or limit > EVENTS_MAX:
+            limit = EVENTS_MAX
+        events, lost = self.hub.getEvents(seq, limit)
+        self.writeln('J%d' % self.hub.getSeq())
+        if lost:
+            self.writeln('o')
+        self.writeEvents(events)
+        self.writeln('.')
+
+    def cmdInfo(self, line=None):
+        for name, value in self.io.server.getStats():
+            self.writeln('%s %s' % (name, value))
+        self.writeln('.')
+
     def cmdDump(self, uuid):
         if self.root is None:
             return self.writeln("!Not logged in.")
@@ -324,55 +1082,74 @@ class Processor:
 
     def cmdGetNodeStates(self, line):
         uuids = line.split(' ')
-        # Check all UUIDs exist
+        # The cache has the committed states
+        cache = None
+        if not self.modified:
+            cache = self.io.server.cache
+        # Check that all UUIDs exist before writing anything. Cached
+        # states are kept as is, they're shared with the cache.
+        states = []
         for node_uuid in uuids:
+            if cache is not None:
+                data = cache.get(self.workspaceName + ' ' + node_uuid)
+                if data is not None:
+                    states.append(data)
+                    continue
             try:
                 node = self.session.getNodeByUUID(node_uuid)
                 node.getName() # Could fail if node was just removed
             except (ItemNotFoundException, IllegalArgumentException):
                 return self.writeln("!No uuid '%s'" % node_uuid)
-        # Fetch all info
-        for node_uuid in uuids:
-            node = self.session.getNodeByUUID(node_uuid)
-            # Node UUID and name
-            self.writeln('U%s %s' % (node.getUUID(), node.getName()))
-            # Parent
+            states.append(node)
+        # Only one state at a time is captured for the cache
+        self.pushProducer(StatesProducer(self, states, cache))
+
+    def captureNodeState(self, node, cache=None):
+        """Get the encoded state of a node, and put it in the cache.
+
+        Returns None if it's too big.
+        """
+        if cache is not None:
+            generation = cache.generation
+        producers = self.producers
+        self.producers = [NodeStateProducer(self, node)]
+        self.capture = java.io.ByteArrayOutputStream()
+        self.captured = 0
+        try:
             try:
-                parent_uuid = node.getParent().getUUID()
-            except (ItemNotFoundException,
-                    javax.jcr.UnsupportedRepositoryOperationException):
-                # Parent may not exist
-                # Parent may not be referenceable (rep:versionStorage)
-                pass
-            else:
-                self.writeln('^%s' % parent_uuid)
-            # Children
-            for subnode in node.getNodes():
-                nodeName = subnode.getName()
-                if nodeName in ('jcr:system', 'jcr:versionLabels'):
-                    # These aren't referenceable
-                    continue
-                try:
-                    subuuid = subnode.getUUID()
-                except javax.jcr.UnsupportedRepositoryOperationException:
-                    print "XXX %s is not referenceable" % subnode.getPath()
-                    continue
-                nodeType = subnode.getProperty('jcr:primaryType').getString()
-                self.writeln('N%s %s %s' % (subuuid, nodeType, nodeName))
-            # Properties
-            for prop in node.getProperties():
-                name = prop.getName()
-                definition = prop.getDefinition()
-                if definition.isMultiple():
-                    values = prop.getValues()
-                    self.writeln('M%s' % name)
-                    for value in values:
-                        self.dumpValue(value)
-                    self.writeln('M')
-                else:
-                    self.writeln('P%s' % name)
-                    self.dumpValue(prop.getValue())
-        self.writeln('.')
+                self.produce()
+            except CaptureAborted:
+                return None
+            data = self.capture.toByteArray()
+        finally:
+            self.capture = None
+            self.discardProducers()
+            self.producers = producers
+        if cache is not None:
+            cache.put(self.workspaceName + ' ' + node.getUUID(), data,
+                      generation)
+        return data
+
+    def isMultiple(self, types, prop):
+        """Check if a property is multi-valued, caching the answer.
+        """
+        key = (types, prop.getName())
+        multiple = self.multiple.get(key)
+        if multiple is None:
+            definition = prop.getDefinition()
+            multiple = definition.isMultiple()
+            if definition.getName() != '*':
+                # Residual definitions may be single or multiple
+                self.multiple[key] = multiple
+        return multiple
+
+    def cmdExport(self, uuid):
+        try:
+            node = self.session.getNodeByUUID(uuid)
+            node.getName() # Could fail if node was just removed
+        except (ItemNotFoundException, IllegalArgumentException):
+            return self.writeln("!No uuid '%s'" % uuid)
+        self.pushProducer(ExportProducer(self, node))
 
     def cmdGetNodeProperties(self, line):
         self.writeln('!XXX not implemented')
@@ -381,17 +1158,6 @@ class Processor:
         s = value.getString().encode('utf-8')
         self.writeln('s%d' % len(s))
         self.writeln(s)
-    def dumpBinary(self, value):
-        # Not very memory efficient, should stream the bytes
-        stream = value.getStream() # InputStream
-        ss = []
-        while stream.available():
-            n = stream.read(BYTEARRAY)
-            s = str(java.lang.String(BYTEARRAY, 0, n, 'ISO-8859-1'))
-            ss.append(s)
-        s = ''.join(ss)
-        self.writeln('x%d' % len(s))
-        self.writeln(s)
     def dumpLong(self, value):
         self.writeln('l%s' % value.getString())
     def dumpDouble(self, value):
@@ -407,9 +1173,9 @@ class Processor:
     def dumpReference(self, value):
         self.writeln('r%s' % value.getString())
 
+    # Binaries are written by a BinaryProducer
     valueDumpers = {
         javax.jcr.PropertyType.STRING: dumpString,
-        javax.jcr.PropertyType.BINARY: dumpBinary,
         javax.jcr.PropertyType.LONG: dumpLong,
         javax.jcr.PropertyType.DOUBLE: dumpDouble,
         javax.jcr.PropertyType.DATE: dumpDate,
@@ -423,23 +1189,33 @@ class Processor:
         self.valueDumpers[value.getType()](self, value)
 
     def cmdMultiple(self, line=None):
-        self.commands = [] # parsed Multiple commands
+        self.modified = True
+        if line:
+            self.save_every = int(line)
+        else:
+            self.save_every = 0
+        self.batch_map = {} # tokens of this batch
+        self.batch_error = None # first error of this batch
         self.command = None # current command being parsed
         self.prop_name = None # current prop being parsed
         self.prop_value = None # its value
         self.prop_values = None # its values when multiple
+        self.spooled = []
         self.continuations.append(self.expectMultipleOne)
 
     def expectMultipleOne(self, line):
-        # Store previous command
+        # Execute previous command now that it's complete, the client
+        # may still be sending the next ones. After an error the
+        # remaining commands are just parsed.
         if self.command is not None:
-            self.commands.append(self.command)
+            command = self.command
             self.command = None
-        if line == '.':
-            # end multiple commands
-            commands = self.commands
-            self.commands = None
-            return self.processMultipleCommands(commands)
+            if self.batch_error is None:
+                self.batch_error = self.executeMultipleOne(command)
+            self.releaseSpooled()
+        if line in ('.', 'p', 'c'):
+            # end multiple commands, maybe with prepare or commit
+            return self.endMultiple(line)
         else:
             self.continuations.append(self.expectMultipleOne)
 
@@ -476,8 +1252,16 @@ class Processor:
                 'inserts': [],
                 }
             self.continuations.append(self.expectInserts)
+        elif op == '#': # setorder
+            self.command = {
+                'op': 'setorder',
+                'uuid': rest,
+                'names': [],
+                }
+            self.continuations.append(self.expectOrder)
         else:
             self.continuations = []
+            self.releaseSpooled()
             return self.writeln("!Unknown multiple op '%s'" % op)
 
     def expectProps(self, line):
@@ -542,10 +1326,29 @@ class Processor:
         self._storeValue(value)
 
     def expectBinary(self, bin):
-        input = java.io.ByteArrayInputStream(bin.array(), 0, bin.limit())
-        value = self.createValue(input)
+        if isinstance(bin, java.io.File):
+            # Spooled to a temporary file. The value reads the stream
+            # only when the property is set, so it's kept open until
+            # the command is executed.
+            input = java.io.FileInputStream(bin)
+            self.spooled.append((input, bin))
+            value = self.createValue(input)
+        else:
+            input = java.io.ByteArrayInputStream(bin.array(), 0, bin.limit())
+            value = self.createValue(input)
         self._storeValue(value)
 
+    def releaseSpooled(self):
+        """Close and delete the spooled binaries of the last command.
+        """
+        spooled = self.spooled
+        if not spooled:
+            return
+        self.spooled = []
+        for input, file in spooled:
+            input.close()
+            file.delete()
+
     def _storeValue(self, value):
         # Keep value a single or multiple
         if self.prop_values is not None:
@@ -571,105 +1374,172 @@ class Processor:
         else:
             self.continuations.append(self.expectInserts)
         name, before = unicode(line, 'utf-8').split('/')
+        if not before:
+            before = None # move to the end
         self.command['inserts'].append((name, before))
 
-    def processMultipleCommands(self, commands):
-        map = {}
-        for command in commands:
-            op = command['op']
-            if op == 'add':
-                puuid = command['puuid']
-                if map.has_key(puuid):
-                    puuid = map[puuid]
+    def expectOrder(self, line):
+        if line == '/':
+            return
+        else:
+            self.continuations.append(self.expectOrder)
+        self.command['names'].append(unicode(line, 'utf-8'))
+
+    def savePending(self):
+        """Save the pending transient changes.
+
+        Returns an error line or None.
+        """
+        self.unsaved = 0
+        try:
+            self.root.save()
+        except RepositoryException, e:
+            if DEBUG_RAISE:
+                raise
+            return "!Cannot save: %s" % e
+        return None
+
+    def executeMultipleOne(self, command):
+        """Execute one command of a batch.
+
+        Returns an error line or None.
+        """
+        tokens = self.tokens # tokens of the transaction
+        op = command['op']
+        if op == 'add':
+            puuid = command['puuid']
+            if tokens.has_key(puuid):
+                puuid = tokens[puuid]
+            try:
+                parent = self.session.getNodeByUUID(puuid)
+            except (ItemNotFoundException, IllegalArgumentException):
+                return "!No such uuid '%s'" % puuid
+            try:
+                node = parent.addNode(command['name'],
+                                      command['node_type'])
+            except RepositoryException, e:
+                if DEBUG_RAISE:
+                    raise
+                return "!Cannot add '%s': %s" % (command['name'], e)
+            for key, value in command['props'].items():
                 try:
-                    parent = self.session.getNodeByUUID(puuid)
+                    node.setProperty(key, value)
+                except RepositoryException, e:
+                    # XXX happens when a date is set to ''
+                    print " XXX Ignoring setProperty '%s' to %s: %s" % (
+                        key, value, e)
+            uuid = node.getUUID()
+            self.batch_map[command['token']] = uuid
+            tokens[command['token']] = uuid
+        elif op == 'modify':
+            uuid = command['uuid']
+            if tokens.has_key(uuid):
+                uuid = tokens[uuid]
+            try:
+                node = self.session.getNodeByUUID(uuid)
+            except (ItemNotFoundException, IllegalArgumentException):
+                return "!No such uuid '%s'" % uuid
+            for key, value in command['props'].items():
+                try:
+                    node.setProperty(key, value)
+                except RepositoryException, e:
+                    # XXX happens when a date is set to ''
+                    print " XXX Ignoring setProperty '%s' to %s: %s" % (
+                        key, value, e)
+        elif op == 'remove':
+            uuid = command['uuid']
+            if tokens.has_key(uuid):
+                uuid = tokens[uuid]
+            try:
+                node = self.session.getNodeByUUID(uuid)
+            except (ItemNotFoundException, IllegalArgumentException):
+                return "!No such uuid '%s'" % uuid
+            t = node.getProperty('jcr:primaryType').getString()
+            if t == 'nt:frozenNode':
+                # Removing a frozen, remove the version
+                version = node.getParent()
+                versionName = version.getName()
+                versionUUID = version.getUUID()
+                baseuuid = node.getProperty('jcr:frozenUuid').getString()
+                try:
+                    base = self.session.getNodeByUUID(baseuuid)
                 except (ItemNotFoundException, IllegalArgumentException):
-                    return self.writeln("!No such uuid '%s'" % puuid)
+                    return "!No such uuid '%s'" % baseuuid
                 try:
-                    node = parent.addNode(command['name'],
-                                          command['node_type'])
+                    base.getVersionHistory().removeVersion(versionName)
                 except RepositoryException, e:
                     if DEBUG_RAISE:
                         raise
-                    return self.writeln("!Cannot add '%s': %s" % (command['name'], e))
-                for key, value in command['props'].items():
-                    try:
-                        node.setProperty(key, value)
-                    except RepositoryException, e:
-                        # XXX happens when a date is set to ''
-                        print " XXX Ignoring setProperty '%s' to %s: %s" % (
-                            key, value, e)
-                map[command['token']] = node.getUUID()
-            elif op == 'modify':
-                uuid = command['uuid']
-                if map.has_key(uuid):
-                    uuid = map[uuid]
+                    return "!Cannot remove frozen '%s': %s" % (uuid, e)
+                # The version history lost a child, and the versions
+                # around the removed one changed
+                self.invalidateVersions(base, [versionUUID, uuid])
+            else:
+                # Removing a normal node
                 try:
-                    node = self.session.getNodeByUUID(uuid)
-                except (ItemNotFoundException, IllegalArgumentException):
-                    return self.writeln("!No such uuid '%s'" % uuid)
-                for key, value in command['props'].items():
-                    try:
-                        node.setProperty(key, value)
-                    except RepositoryException, e:
-                        # XXX happens when a date is set to ''
-                        print " XXX Ignoring setProperty '%s' to %s: %s" % (
-                            key, value, e)
-            elif op == 'remove':
-                uuid = command['uuid']
-                if map.has_key(uuid):
-                    uuid = map[uuid]
+                    node.remove()
+                except RepositoryException, e:
+                    if DEBUG_RAISE:
+                        raise
+                    return "!Cannot remove node '%s': %s" % (uuid, e)
+        elif op == 'reorder':
+            uuid = command['uuid']
+            if tokens.has_key(uuid):
+                uuid = tokens[uuid]
+            try:
+                node = self.session.getNodeByUUID(uuid)
+            except (ItemNotFoundException, IllegalArgumentException):
+                return "!No such uuid '%s'" % uuid
+            for name, before in command['inserts']:
                 try:
-                    node = self.session.getNodeByUUID(uuid)
-                except (ItemNotFoundException, IllegalArgumentException):
-                    return self.writeln("!No such uuid '%s'" % uuid)
-                t = node.getProperty('jcr:primaryType').getString()
-                if t == 'nt:frozenNode':
-                    # Removing a frozen, remove the version
-                    versionName = node.getParent().getName()
-                    baseuuid = node.getProperty('jcr:frozenUuid').getString()
-                    try:
-                        base = self.session.getNodeByUUID(baseuuid)
-                    except (ItemNotFoundException, IllegalArgumentException):
-                        return self.writeln("!No such uuid '%s'" % baseuuid)
-                    try:
-                        base.getVersionHistory().removeVersion(versionName)
-                    except RepositoryException, e:
-                        if DEBUG_RAISE:
-                            raise
-                        return self.writeln("!Cannot remove frozen '%s': %s"
-                                            % (uuid, e))
-                    # XXX invalidate the vh as its children changed
-                else:
-                    # Removing a normal node
-                    try:
-                        node.remove()
-                    except RepositoryException, e:
-                        if DEBUG_RAISE:
-                            raise
-                        return self.writeln("!Cannot remove node '%s': %s"
-                                            % (uuid, e))
-            elif op == 'reorder':
-                uuid = command['uuid']
-                if map.has_key(uuid):
-                    uuid = map[uuid]
+                    node.orderBefore(name, before)
+                except RepositoryException, e:
+                    return ("!Cannot reorder '%s', '%s' before '%s': %s" %
+                            (uuid, name, before, e))
+        elif op == 'setorder':
+            uuid = command['uuid']
+            if tokens.has_key(uuid):
+                uuid = tokens[uuid]
+            try:
+                node = self.session.getNodeByUUID(uuid)
+            except (ItemNotFoundException, IllegalArgumentException):
+                return "!No such uuid '%s'" % uuid
+            current = [child.getName() for child in node.getNodes()]
+            names = command['names']
+            wanted = {}
+            for name in names:
+                wanted[name] = None
+            if len(current) != len(names) or len(wanted) != len(names):
+                return "!Cannot set order of '%s': names mismatch" % uuid
+            for name in current:
+                if not wanted.has_key(name):
+                    return ("!Cannot set order of '%s': no child '%s'" %
+                            (uuid, name))
+            # Apply the new order with as few moves as possible
+            for name, before in orderInserts(current, names):
                 try:
-                    node = self.session.getNodeByUUID(uuid)
-                except (ItemNotFoundException, IllegalArgumentException):
-                    return self.writeln("!No such uuid '%s'" % uuid)
-                for name, before in command['inserts']:
-                    try:
-                        node.orderBefore(name, before)
-                    except RepositoryException, e:
-                        return self.writeln("!Cannot reorder '%s', "
-                                            "'%s' before '%s': %s" %
-                                            (uuid, name, before, e))
-        try:
-            self.root.save()
-        except RepositoryException, e:
-            if DEBUG_RAISE:
-                raise
-            return self.writeln("!Cannot save: %s" % e)
+                    node.orderBefore(name, before)
+                except RepositoryException, e:
+                    return ("!Cannot reorder '%s', '%s' before '%s': %s" %
+                            (uuid, name, before, e))
+        self.unsaved += 1
+        if self.save_every and self.unsaved >= self.save_every:
+            return self.savePending()
+        return None
+
+    def endMultiple(self, end):
+        """End a batch, answer with its token map or its first error.
+        """
+        map = self.batch_map
+        msg = self.batch_error
+        self.batch_map = None
+        self.batch_error = None
+        if msg is not None:
+            return self.writeln(msg)
+        if not self.save_every:
+            msg = self.savePending()
+            if msg is not None:
+                return self.writeln(msg)
 
         # Write token map
         for token, uuid in map.items():
@@ -678,7 +1548,39 @@ class Processor:
         # Done!
         self.writeln('.')
 
+        if end != '.' and self.unsaved:
+            msg = self.savePending()
+            if msg is not None:
+                self.session.refresh(False)
+                self.failTransaction()
+                return self.writeln(msg)
+        if end == 'p':
+            self.cmdPrepare()
+        elif end == 'c':
+            # One-phase commit
+            if self.prepared:
+                return self.writeln("!Already prepared.")
+            self.commit(True)
+
+    def invalidateVersions(self, node, uuids=()):
+        """Invalidate the cached states changed by versioning a node.
+
+        Versioning operations don't go through a save of the session, so
+        the cache invalidator doesn't see all of them: the node, its
+        version history and its versions are invalidated now, and again
+        at commit, with the other given uuids.
+        """
+        history = node.getVersionHistory()
+        uuids = [node.getUUID(), history.getUUID()] + list(uuids)
+        versions = history.getAllVersions()
+        while versions.hasNext():
+            uuids.append(versions.nextVersion().getUUID())
+        for uuid in uuids:
+            self.versioned[uuid] = None
+        self.io.server.cache.invalidate(self.workspaceName, uuids)
+
     def cmdCheckpoint(self, uuid):
+        self.modified = True
         try:
             node = self.session.getNodeByUUID(uuid)
         except (ItemNotFoundException, IllegalArgumentException):
@@ -686,11 +1588,13 @@ class Processor:
         try:
             node.checkin()
             node.checkout()
+            self.invalidateVersions(node)
         except RepositoryException, e:
             return self.writeln("!Cannot checkpoint: %s" % e)
         self.writeln('.')
 
     def cmdRestore(self, line):
+        self.modified = True
         uuid, versionName = line.split(' ', 1)
         try:
             node = self.session.getNodeByUUID(uuid)
@@ -746,6 +1650,7 @@ class Processor:
         self.writeln('.')
 
     def cmdMove(self, line):
+        self.modified = True
         # uuid, dest container uuid, name in dest
         uuid, cuuid, name = line.split(' ', 2)
         name = unicode(name, 'utf-8')
@@ -767,6 +1672,7 @@ class Processor:
         self.writeln('.')
 
     def cmdCopy(self, line):
+        self.modified = True
         # uuid, dest container uuid, name in dest
         uuid, cuuid, name = line.split(' ', 2)
         name = unicode(name, 'utf-8')
@@ -791,6 +1697,9 @@ class Processor:
         '?': (cmdHelp, "This help."),
         'q': (cmdQuit, "Quit this connection."),
         'Q': (cmdStop, "Stop the server and all connections."),
+        'I': (cmdInfo, "Get server statistics."),
+        'E': (cmdEvents, "Get the events since the last call."),
+        'J': (cmdJournal, "Get the changes since a sequence number."),
         'd': (cmdDump, "Dump the repository."),
         'L': (cmdLogin, "Login to the given workspace."),
         'p': (cmdPrepare, "Prepare the transaction."),
@@ -800,9 +1709,11 @@ class Processor:
         't': (cmdRestore, "Restore."),
         'T': (cmdGetNodeType, "Get the primary type of a given uuid."),
         'S': (cmdGetNodeStates, "Get the state of the given uuids."),
+        'e': (cmdExport, "Export the states of a subtree."),
         'P': (cmdGetNodeProperties, "Get some properties of a given uuid."),
         'D': (cmdGetNodeTypeDefs, "Get the CND node type definitions."),
-        'M': (cmdMultiple, "Send multiple commands (+/=/-/%)."),
+        'M': (cmdMultiple, "Send multiple commands (+/=/-/%/#), "
+              "Mn saves every n commands."),
         '/': (cmdPath, "Get the path of a UUID."),
         's': (cmdSearch, "Search a property = value."),
         'm': (cmdMove, "Move a document."),
@@ -817,6 +1728,11 @@ class Processor:
         if line.lower() == 'help': # XXX
             line = '?'
         cmd, rest = line[0], line[1:]
+        if self.unsaved and cmd not in 'Mr':
+            # Other commands see the changes of periodically saved batches
+            msg = self.savePending()
+            if msg is not None:
+                return self.writeln(msg)
         info = self._ops.get(cmd)
         if info is not None:
             func = info[0]
@@ -831,146 +1747,543 @@ class Processor:
             continuation = self.cmdCommand
         continuation(line)
 
+class SessionTask(java.lang.Runnable):
+    """Runs the pending input of a session in a worker thread.
+    """
+
+    def __init__(self, io):
+        self.io = io
+
+    def run(self):
+        self.io.processInput()
+
+
 class IO:
     """I/O manager, reads lines and passes them to a processor.
+
+    The selector thread only reads and writes bytes. The data read is
+    handed to a worker thread of the server's pool, which splits it in
+    lines and binaries and passes them to the processor. A session is
+    processed by at most one worker at a time, so its commands are
+    executed in order.
+
+    Input is read into a byte buffer which is scanned in place, only the
+    lines and the binaries are copied out of it.
+
+    When too much output is pending, the session is paused: no more
+    output is produced and no more input is read or processed, without
+    holding a worker, until the selector thread has written enough of it
+    and schedules the session again. Commands with a big output write it
+    through producers that can stop part-way (see Processor.produce).
     """
 
-    def __init__(self, key, repository):
-        self.processor = Processor(self, repository)
+    def __init__(self, key, server):
+        self.processor = Processor(self, server.repository)
+        self.server = server
         self.key = key
         self.channel = key.channel()
-        self.rbbuf = java.nio.ByteBuffer.allocate(8192)
+        self.lock = thread.allocate_lock() # protects the following
+        self.inbuf = java.nio.ByteBuffer.allocate(INBUF_SIZE) # Data read
+        self.inpos = 0 # Start of the data not yet processed in inbuf
+        self.scanned = 0 # Position up to which inbuf has no newline
+        self.eof = False
+        self.closing = False # Close once everything is written
+        self.closed = False
+        self.broken = False # Connection lost, output is dropped
+        self.scheduled = False # A worker is processing our input
+        self.towrite = [] # Byte buffers pending write
+        self.owned = [] # For each of towrite, true if allocated by write()
+        self.pending = 0 # Bytes pending write
+        self.paused = False # Input not read until output drains
+        self.spare = [] # Written buffers to reuse
+        # Only used by the worker thread
+        self.task = SessionTask(self)
+        self.binleft = -1 # Binary bytes still expected, -1 if none
         self.bin = None # A byte buffer for binary data
-        self.strlen = 0 # Length of string to return instead of readline
-        self.unprocessed = [] # Unprocessed data already read
-        self.towrite = [] # Pending data to write
+        self.spool = None # Or a temporary file for big binaries
+        self.spoolchannel = None
+        self.binstring = False # Binary data is returned as a string
 
     def close(self):
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+            self.discardOutput()
+        finally:
+            self.lock.release()
+        self.server.addStat('sessions', -1)
         self.processor.logout()
         self.key.cancel() # remove channel from selector
         self.channel.close() # close socket
+        if self.spool is not None:
+            self.spoolchannel.close()
+            self.spool.delete()
+            self.spool = None
 
     def setBinary(self, l):
         """Next process expects l bytes of data (followed by '\n').
+
+        Binaries bigger than SPOOL_SIZE are spooled to a temporary file.
         """
-        self.bin = java.nio.ByteBuffer.allocate(l+1)
+        if l > SPOOL_SIZE:
+            self.spool = java.io.File.createTempFile('jcrupload', '.bin')
+            self.spool.deleteOnExit()
+            stream = java.io.FileOutputStream(self.spool)
+            self.spoolchannel = stream.getChannel()
+        else:
+            self.bin = java.nio.ByteBuffer.allocate(l)
+        self.binleft = l
+        self.binstring = False
 
     def setString(self, l):
-        self.strlen = l+1
+        """Next process expects a string of l bytes (followed by '\n').
+        """
+        self.bin = java.nio.ByteBuffer.allocate(l)
+        self.binleft = l
+        self.binstring = True
+
+    def makeRoom(self):
+        """Make room in the input buffer, compacting or growing it.
+
+        Called with the lock held.
+        """
+        inbuf = self.inbuf
+        inbuf.flip()
+        inbuf.position(self.inpos)
+        if self.inpos >= inbuf.capacity() / 2:
+            inbuf.compact()
+        else:
+            bigger = java.nio.ByteBuffer.allocate(2 * inbuf.capacity())
+            bigger.put(inbuf)
+            self.inbuf = bigger
+        self.scanned = self.scanned - self.inpos
+        self.inpos = 0
 
     def doRead(self):
         """Called by server when it's possible to read something.
         """
-        # Read binary data
-        if self.bin is not None:
-            n = self.channel.read(self.bin)
-            if DEBUG:
-                print '< (%d bytes)' % n
+        self.lock.acquire()
+        try:
+            if not self.inbuf.hasRemaining():
+                self.makeRoom()
+            n = self.channel.read(self.inbuf)
             if n == -1:
-                # EOF
-                self.close()
-                return
-            if not self.bin.hasRemaining():
-                # Just finished a binary
-                self.processBinary()
+                # EOF, the worker will close us
+                self.eof = True
+                # Don't select a closed channel again
+                self.key.interestOps(self.interestOps())
+            elif DEBUG:
+                print '< (%d bytes)' % n
+            schedule = not self.scheduled
+            self.scheduled = True
+        finally:
+            self.lock.release()
+        if schedule:
+            self.server.execute(self.task)
+
+    def processInput(self):
+        """Process the data received, in a worker thread.
+        """
+        try:
+            self.processData()
+        except SystemExit:
+            self.server.stop()
             return
-
-        # Else read non-binary data
-        n = self.channel.read(self.rbbuf)
-        if n == -1:
-            # EOF
-            self.close()
+        except (ValueError, KeyError, RepositoryException), e:
+            print "XXX Trapped exception: %s" % e
+            self.processor.discardProducers()
+            self.lock.acquire()
+            try:
+                self.discardOutput()
+                # The selector thread closes us once it's written
+                self.closing = True
+            finally:
+                self.lock.release()
+            self.write("!Error: %s\n" % e)
+            if DEBUG_RAISE:
+                self.server.stop(sys.exc_info())
             return
-        # Convert buffer to string
-        self.rbbuf.flip()
-        s = latinDecoder.decode(self.rbbuf).toString()
-        self.rbbuf.clear()
-        self.unprocessed.append(s)
-        if DEBUG:
-            print '< %s' % repr(s)
-
-        # Pass all full lines/binaries to the processor
-        # XXX Not completely memory efficient
-        todo = ''.join(self.unprocessed)
-        while todo:
-            if self.bin is None:
-                if self.strlen:
-                    # Want a string of given length
-                    if len(todo) < self.strlen:
-                        # Not enough data yet
-                        break
-                    pos = self.strlen - 1
-                    self.strlen = 0
+        except:
+            self.server.stop(sys.exc_info())
+            return
+
+    def processData(self):
+        """Pass all full lines/binaries to the processor.
+
+        The output of a command is finished before the next one is read.
+        """
+        processor = self.processor
+        while True:
+            if processor.producers and not self.broken:
+                processor.produce()
+            self.lock.acquire()
+            try:
+                if self.paused and not self.broken:
+                    # Rescheduled by doWrite once the output drained
+                    self.scheduled = False
+                    return
+                producing = processor.producers and not self.broken
+                if self.broken or producing:
+                    data = None
                 else:
-                    pos = todo.find('\n')
-                    if pos == -1:
-                        break
-                line, todo = todo[:pos], todo[pos+1:] # skip '\n'
-                self.processor.process(line)
-            else:
-                remaining = self.bin.remaining()
-                data, todo = todo[:remaining], todo[remaining:]
-                # Put unprocessed data into the bin byte buffer
-                latinEncoder.encode(java.nio.CharBuffer.wrap(data), self.bin,
-                                    True)
-                if self.bin.hasRemaining():
-                    break
-                # Just finished a binary
-                self.processBinary()
+                    data = self.nextData()
+                if data is None and not producing:
+                    eof = self.eof
+                    if not eof:
+                        self.scheduled = False
+                        return
+            finally:
+                self.lock.release()
+            if producing:
+                # Not paused anymore
+                continue
+            if data is None:
+                # EOF
+                processor.discardProducers()
+                self.close()
+                return
+            processor.process(data)
 
-        if todo:
-            self.unprocessed = [todo]
-        else:
-            self.unprocessed = []
+    def nextData(self):
+        """Get the next full line or binary from the input buffer.
 
-    def processBinary(self):
+        Returns None if it's not complete yet.
+        Called with the lock held.
+        """
+        inbuf = self.inbuf
+        array = inbuf.array()
+        end = inbuf.position()
+        if self.binleft >= 0:
+            # Move what's available into the binary
+            n = min(self.binleft, end - self.inpos)
+            if n:
+                if self.spool is not None:
+                    self.spoolchannel.write(
+                        java.nio.ByteBuffer.wrap(array, self.inpos, n))
+                else:
+                    self.bin.put(array, self.inpos, n)
+                self.inpos = self.inpos + n
+                self.binleft = self.binleft - n
+            self.scanned = self.inpos
+            if self.binleft or self.inpos == end:
+                return None
+            # Binary complete, check terminator
+            char = array[self.inpos]
+            self.inpos = self.inpos + 1
+            self.scanned = self.inpos
+            self.binleft = -1
+            if char != 0x0a:
+                raise ValueError("Bad terminator: %d" % char)
+            return self.finishBinary()
+        # Look for a newline in the bytes not scanned yet
+        scanned = self.scanned
+        if scanned == end:
+            return None
+        pos = java.lang.String(array, scanned, end-scanned,
+                               'ISO-8859-1').indexOf('\n')
+        if pos == -1:
+            self.scanned = end
+            return None
+        pos = scanned + pos
+        line = java.lang.String(array, self.inpos, pos-self.inpos,
+                                'ISO-8859-1')
+        self.inpos = pos + 1 # skip '\n'
+        self.scanned = self.inpos
+        line = str(line)
+        if DEBUG:
+            print '< %s' % repr(line)
+        return line
+
+    def finishBinary(self):
+        if self.spool is not None:
+            spool = self.spool
+            self.spool = None
+            self.spoolchannel.close()
+            self.spoolchannel = None
+            return spool
         bin = self.bin
         self.bin = None
-        limit = bin.limit()
-        char = bin.get(limit-1)
-        if char != 0x0a:
-            raise ValueError("Bad terminator: %d" % char)
-        bin.limit(limit-1)
-        bin.position(0)
-        self.processor.process(bin)
+        if self.binstring:
+            return str(java.lang.String(bin.array(), 0, bin.limit(),
+                                        'ISO-8859-1'))
+        bin.flip()
+        return bin
+
+    def interestOps(self):
+        """Compute the interest ops of our key.
+
+        Called with the lock held.
+        """
+        ops = 0
+        if not self.paused and not self.eof:
+            ops = SelectionKey.OP_READ
+        if self.towrite:
+            ops = ops | SelectionKey.OP_WRITE
+        return ops
+
+    def updateInterest(self):
+        """Called by server to apply a change of interest ops.
+        """
+        self.lock.acquire()
+        try:
+            if self.key.isValid():
+                self.key.interestOps(self.interestOps())
+        finally:
+            self.lock.release()
+
+    def abandon(self):
+        """Called by server when the connection is lost.
+
+        The worker is woken up and closes us.
+        """
+        self.lock.acquire()
+        try:
+            self.broken = True
+            self.eof = True
+            self.discardOutput()
+            if self.key.isValid():
+                self.key.interestOps(0)
+            schedule = not self.scheduled
+            self.scheduled = True
+        finally:
+            self.lock.release()
+        if schedule:
+            self.server.execute(self.task)
+
+    def discardOutput(self):
+        """Forget the pending output.
+
+        Called with the lock held.
+        """
+        self.towrite = []
+        self.owned = []
+        self.server.addStat('buffered', -self.pending)
+        self.pending = 0
+        if self.paused:
+            self.paused = False
+            self.server.addStat('paused', -1)
 
     def doWrite(self):
         """Called by server when it's possible to write.
+
+        Pending buffers are written with a gathering write, those
+        partially written keep their position for the next time.
         """
-        # XXX Not memory efficient
-        data = ''.join(self.towrite)
-        l = len(data)
+        schedule = False
+        self.lock.acquire()
         try:
-            bbuf = latinEncoder.encode(java.nio.CharBuffer.wrap(data))
-        except:
-            print 'XXX failing data %s' % repr(data)
-            raise
-        n = self.channel.write(bbuf)
-        if DEBUG:
-            print '- %s' % repr(data[:n])
-        if n != l:
-            #print 'short write! %d written out of %d' % (n, l)
-            self.towrite = [data[n:]]
-        else:
-            self.towrite = []
-            # Set key not interested in writes
-            self.key.interestOps(SelectionKey.OP_READ)
+            closing = self.closing
+            towrite = self.towrite
+            if towrite:
+                buffers = jarray.array(towrite[:GATHER_MAX],
+                                       java.nio.ByteBuffer)
+                n = self.channel.write(buffers)
+                if DEBUG:
+                    print '- (%d bytes)' % n
+                self.pending = self.pending - n
+                self.server.addStat('buffered', -n)
+                while towrite and not towrite[0].hasRemaining():
+                    bbuf = towrite.pop(0)
+                    # Buffers given to writeBuffer belong to the caller
+                    # and may be shared, only ours are reused
+                    if self.owned.pop(0) and len(self.spare) < OUTBUF_SPARE:
+                        self.spare.append(bbuf)
+            if self.paused and self.pending <= LOW_WATER:
+                # Resume reading, and processing the input left
+                self.paused = False
+                self.server.addStat('paused', -1)
+                schedule = not self.scheduled
+                self.scheduled = True
+            self.key.interestOps(self.interestOps())
+        finally:
+            self.lock.release()
+        if schedule:
+            self.server.execute(self.task)
+        if closing and not towrite:
+            self.close()
 
     def write(self, s):
         """Append data to be written.
+
+        The data is encoded right away. Small writes are accumulated in
+        reused buffers of OUTBUF_SIZE bytes.
+
+        Called from the worker thread.
         """
         if not s:
             return
-        was_empty = not len(self.towrite)
-        self.towrite.append(s)
+        data = java.lang.String(s).getBytes('ISO-8859-1')
+        n = len(data)
+        if n > OUTBUF_SIZE:
+            self.writeBuffer(java.nio.ByteBuffer.wrap(data))
+            return
+        self.lock.acquire()
+        try:
+            if self.broken:
+                return
+            towrite = self.towrite
+            was_empty = not towrite
+            tail = None
+            if towrite and self.owned[-1]:
+                tail = towrite[-1]
+                if tail.limit() + n > OUTBUF_SIZE:
+                    tail = None
+            if tail is None:
+                if self.spare:
+                    tail = self.spare.pop()
+                else:
+                    tail = java.nio.ByteBuffer.allocate(OUTBUF_SIZE)
+                tail.position(0)
+                tail.limit(0)
+                towrite.append(tail)
+                self.owned.append(1)
+            limit = tail.limit()
+            java.lang.System.arraycopy(data, 0, tail.array(), limit, n)
+            tail.limit(limit + n)
+            self.added(n, was_empty)
+        finally:
+            self.lock.release()
+
+    def writeBuffer(self, bbuf):
+        """Append a byte buffer to be written, without copying it.
+
+        The buffer must not be modified afterwards. It's not reused
+        for other output once written, as it may be shared.
+
+        Called from the worker thread.
+        """
+        n = bbuf.remaining()
+        if not n:
+            return
+        self.lock.acquire()
+        try:
+            if self.broken:
+                return
+            was_empty = not self.towrite
+            self.towrite.append(bbuf)
+            self.owned.append(0)
+            self.added(n, was_empty)
+        finally:
+            self.lock.release()
+
+    def added(self, n, was_empty):
+        """Account for n bytes added to the output.
+
+        If too much output is pending, pause the session: the output of
+        the current command stops after the current step of its producer,
+        and the rest of it and the following commands wait until the
+        client has read enough of the output.
+
+        Called from the worker thread with the lock held.
+        """
+        self.pending = self.pending + n
+        self.server.addStat('buffered', n)
         if was_empty:
-            # Set key interested in writes
-            self.key.interestOps(SelectionKey.OP_READ | SelectionKey.OP_WRITE)
+            self.server.setInterest(self)
+        if self.pending <= self.server.highWater() or self.paused:
+            return
+        self.paused = True
+        self.server.addStat('paused', 1)
+        self.server.addStat('pauses', 1)
+        self.server.setInterest(self)
 
 
 class Server:
-    def __init__(self, repository):
+    """Server dispatching I/O events in one thread, and processing the
+    commands in a pool of worker threads.
+    """
+
+    def __init__(self, repository, workers=WORKERS, journal_dir=None):
         self.repository = repository
+        self.journal_dir = journal_dir # Where journals are persisted
+        self.selector = None
+        self.lock = thread.allocate_lock() # protects the following
+        self.interests = [] # IOs whose interest ops changed
+        self.stats = {
+            'sessions': 0,
+            'buffered': 0, # output bytes pending for all sessions
+            'buffered_peak': 0,
+            'paused': 0, # sessions waiting for the client to read
+            'pauses': 0,
+            'events': 0,
+            }
+        self.hubs = {} # workspace name -> EventHub
+        self.cache = NodeStateCache()
+        self.budget = OUTPUT_BUDGET
+        self.stopping = False
+        self.executor = PooledExecutor(LinkedQueue(), workers)
+        self.executor.setMinimumPoolSize(workers)
+
+    def execute(self, task):
+        self.executor.execute(task)
+
+    def setInterest(self, io):
+        """Have the interest ops of an IO recomputed.
+
+        Changing them while the selector thread is blocked in select()
+        may block, so the change is queued for the selector thread.
+        """
+        self.lock.acquire()
+        try:
+            self.interests.append(io)
+        finally:
+            self.lock.release()
+        self.selector.wakeup()
+
+    def addStat(self, name, delta):
+        self.lock.acquire()
+        try:
+            stats = self.stats
+            value = stats[name] + delta
+            stats[name] = value
+            if name == 'buffered' and value > stats['buffered_peak']:
+                stats['buffered_peak'] = value
+        finally:
+            self.lock.release()
+
+    def getStats(self):
+        """Get the statistics, as a sorted list of (name, value).
+        """
+        self.lock.acquire()
+        try:
+            items = self.stats.items()
+        finally:
+            self.lock.release()
+        items.append(('budget', self.budget))
+        items.extend(self.cache.getStats())
+        items.sort()
+        return items
+
+    def getEventHub(self, workspaceName):
+        """Get the event hub of a workspace, creating it if needed.
+        """
+        self.lock.acquire()
+        try:
+            hub = self.hubs.get(workspaceName)
+            if hub is None:
+                hub = EventHub(self, workspaceName)
+                self.hubs[workspaceName] = hub
+        finally:
+            self.lock.release()
+        return hub
+
+    def highWater(self):
+        """Output pending above which a session must wait.
+        """
+        if self.stats['buffered'] > self.budget:
+            return LOW_WATER
+        return HIGH_WATER
+
+    def stop(self, exc_info=None):
+        """Stop the server, called from a worker thread.
+
+        If exc_info is given, the exception is reraised by the selector
+        thread.
+        """
+        self.stopping = exc_info or True
+        self.selector.wakeup()
 
     def acceptConnections(self, port):
         selector = java.nio.channels.Selector.open()
@@ -984,43 +2297,59 @@ class Server:
 
         print "%s Listening" % timestampe()
 
-        while selector.select() > 0:
+        while 1:
+            selector.select()
+            stopping = self.stopping
+            if stopping:
+                if stopping is True:
+                    raise SystemExit
+                t, v, tb = stopping
+                raise t, v, tb
+            # Apply interest changes asked by the workers
+            self.lock.acquire()
+            try:
+                interests = self.interests
+                self.interests = []
+            finally:
+                self.lock.release()
+            for io in interests:
+                io.updateInterest()
+
             iter = selector.selectedKeys().iterator()
             while iter.hasNext():
                 key = iter.next()
                 iter.remove()
+                if not key.isValid():
+                    continue
                 if key.isAcceptable():
                     channel = key.channel().accept()
                     channel.configureBlocking(False)
                     newkey = channel.register(selector, SelectionKey.OP_READ)
-                    io = IO(newkey, self.repository)
+                    io = IO(newkey, self)
                     newkey.attach(io)
+                    self.addStat('sessions', 1)
                     io.write("Welcome.\n")
-                elif key.isReadable():
-                    io = key.attachment()
-                    try:
+                    continue
+                io = key.attachment()
+                try:
+                    if key.isReadable():
                         io.doRead()
-                    except (ValueError, KeyError, RepositoryException), e:
-                        io.towrite = []
-                        io.write("!Error: %s\n" % e)
-                        try:
-                            io.doWrite()
-                            io.close()
-                        except:
-                            pass
-                        print "XXX Trapped exception: %s" % e
-                        if DEBUG_RAISE:
-                            raise
-                elif key.isWritable():
-                    key.attachment().doWrite()
+                    if key.isValid() and key.isWritable():
+                        io.doWrite()
+                except java.io.IOException, e:
+                    print "XXX Connection lost: %s" % e
+                    io.abandon()
 
     def closeIO(self):
+        self.executor.shutdownNow()
         iter = self.selector.keys().iterator()
         while iter.hasNext():
             key = iter.next()
             io = key.attachment()
             if io is not None:
                 io.close()
+        for hub in self.hubs.values():
+            hub.close()
 
 
 def checkRepositoryInit(root):
@@ -1045,15 +2374,9 @@ def checkRepositoryInit(root):
         node.checkin()
 
 
-def setupNodeTypes(repository, cndpaths):
-    session = repository.login(CREDENTIALS, 'default')
-    workspace = session.getWorkspace()
-    ntm = workspace.getNodeTypeManager()
-    nsr = workspace.getNamespaceRegistry()
-
-    # read all cnd files into one string
-    global NODETYPEDEFS
-    NODETYPEDEFS = ''
+def readNodeTypeDefs(cndpaths):
+    """Read all cnd files into one string, namespaces first.
+    """
     ns = []
     rest = []
     for cndpath in cndpaths:
@@ -1063,65 +2386,126 @@ def setupNodeTypes(repository, cndpaths):
                 ns.append(line)
             else:
                 rest.append(line)
-    NODETYPEDEFS = '\n'.join(ns) + '\n' + '\n'.join(rest)
+    return '\n'.join(ns) + '\n' + '\n'.join(rest)
 
-    # parse cnd
-    reader = java.io.StringReader(NODETYPEDEFS)
-    try:
-        cndReader = CompactNodeTypeDefReader(reader, 'ALL-CND')
-    except:
-        print '--'
-        i = 0
-        for line in NODETYPEDEFS.split('\n'):
-            i += 1
-            print '%4d %s' % (i, line)
-        print '--'
-        raise
-
-    # register namespaces read
-    nsm = cndReader.getNamespaceMapping()
-    for entry in nsm.getPrefixToURIMapping().entrySet():
-        prefix = entry.getKey()
-        uri = entry.getValue()
+def digestNodeTypeDefs(defs):
+    md = java.security.MessageDigest.getInstance('MD5')
+    digest = md.digest(java.lang.String(defs).getBytes('UTF-8'))
+    return ''.join(['%02x' % (b & 0xff) for b in digest])
+
+def setupNodeTypes(session, register=True):
+    """Register the node types if needed, and initialize the repository.
+    """
+    workspace = session.getWorkspace()
+    ntm = workspace.getNodeTypeManager()
+    nsr = workspace.getNamespaceRegistry()
+
+    if register:
+        # parse cnd
+        reader = java.io.StringReader(NODETYPEDEFS)
         try:
-            nsr.registerNamespace(prefix, uri)
-        except javax.jcr.NamespaceException:
-            # already registered
-            pass
-    # register node types
-    ntr = ntm.getNodeTypeRegistry();
-    ntr.registerNodeTypes(cndReader.getNodeTypeDefs())
+            cndReader = CompactNodeTypeDefReader(reader, 'ALL-CND')
+        except:
+            print '--'
+            i = 0
+            for line in NODETYPEDEFS.split('\n'):
+                i += 1
+                print '%4d %s' % (i, line)
+            print '--'
+            raise
+
+        # register namespaces read
+        nsm = cndReader.getNamespaceMapping()
+        for entry in nsm.getPrefixToURIMapping().entrySet():
+            prefix = entry.getKey()
+            uri = entry.getValue()
+            try:
+                nsr.registerNamespace(prefix, uri)
+            except javax.jcr.NamespaceException:
+                # already registered
+                pass
+        # register node types
+        ntr = ntm.getNodeTypeRegistry();
+        ntr.registerNodeTypes(cndReader.getNodeTypeDefs())
 
     checkRepositoryInit(session.getRootNode())
     session.save()
-    session.logout()
 
 
-def run_server(repoconf, repopath, cndpath, port):
+def run_server(repoconf, repopath, cndpaths, port, workers=WORKERS,
+               journal=False, transient=False):
+    global NODETYPEDEFS
+    NODETYPEDEFS = readNodeTypeDefs(cndpaths)
+    # Only register the node types if they changed since last time
+    digest = digestNodeTypeDefs(NODETYPEDEFS)
+    digestpath = repopath+'/nodetypes.md5'
+    custompath = repopath+'/repository/nodetypes/custom_nodetypes.xml'
     try:
-        # Remove previous nodetypes, we'll reimport them
-        os.remove(repopath+'/repository/nodetypes/custom_nodetypes.xml')
-    except OSError:
-        pass
+        register = open(digestpath).read().strip() != digest
+    except IOError:
+        register = True
+    if not os.path.exists(custompath):
+        register = True
+    if register:
+        try:
+            # Remove previous nodetypes, we'll reimport them
+            os.remove(custompath)
+        except OSError:
+            pass
+    else:
+        print "%s Node types unchanged" % timestampe()
     repository = TransientRepository(repoconf, repopath)
-    setupNodeTypes(repository, cndpath)
+    # This session keeps the repository started even when no client
+    # is connected, unless it's transient
+    session = repository.login(CREDENTIALS, 'default')
+    setupNodeTypes(session, register)
+    if register:
+        f = open(digestpath, 'w')
+        f.write(digest+'\n')
+        f.close()
+    if transient:
+        session.logout()
+        session = None
+    journal_dir = None
+    if journal:
+        journal_dir = repopath
     try:
-        server = Server(repository)
-        server.acceptConnections(port)
+        server = Server(repository, workers, journal_dir)
+        try:
+            server.acceptConnections(port)
+        finally:
+            server.closeIO()
     finally:
-        server.closeIO()
+        if session is not None:
+            session.logout()
 
 
 if __name__ == '__main__':
-    if len(sys.argv) > 0 and sys.argv[1] == '--raise':
-        del sys.argv[1]
-        DEBUG_RAISE = True
+    workers = WORKERS
+    journal = False
+    transient = False
+    while len(sys.argv) > 1 and sys.argv[1].startswith('--'):
+        if sys.argv[1] == '--raise':
+            del sys.argv[1]
+            DEBUG_RAISE = True
+        elif sys.argv[1] == '--workers' and len(sys.argv) > 2:
+            workers = int(sys.argv[2])
+            del sys.argv[1:3]
+        elif sys.argv[1] == '--journal':
+            del sys.argv[1]
+            journal = True
+        elif sys.argv[1] == '--transient':
+            del sys.argv[1]
+            transient = True
+        else:
+            break
     if len(sys.argv) < 4:
-        print >>sys.stderr, "Usage: server.py [--raise] <repopath> <port> <cndpath> <cndpath...>"
+        print >>sys.stderr, "Usage: server.py [--raise] [--workers n] [--journal] [--transient] <repopath> <port> <cndpath> <cndpath...>"
         sys.exit(1)
 
     repopath = sys.argv[1]
     repoconf = repopath+'.xml'
     port = int(sys.argv[2])
     cndpaths = sys.argv[3:]
-    run_server(repoconf, repopath, cndpaths, port)
+    run_server(repoconf, repopath, cndpaths, port, workers, journal,
+               transient)
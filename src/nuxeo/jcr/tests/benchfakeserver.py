@@ -0,0 +1,116 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Micro-benchmark of commits in the fake JCR server.
+
+For repositories of increasing sizes, times a transaction modifying a
+few nodes, committed alone then after a concurrent commit so that a
+merge is needed. Then times getPath on these nodes, an equality
+searchProperty, and a move and copy of a leaf. The times should not
+depend on the repository size.
+
+Usage: python benchfakeserver.py [sizes...]
+"""
+
+import sys
+import time
+
+from nuxeo.jcr.tests.fakeserver import FakeJCRController
+from nuxeo.jcr.tests.fakeserver import STORAGES
+
+CHANGES = 10
+
+
+class FakeDB(object):
+    database_name = 'bench-fakeserver'
+    workspace_name = 'default'
+
+
+def timeit(title, func, *args):
+    times = []
+    for i in range(5):
+        start = time.time()
+        func(*args)
+        times.append(time.time() - start)
+    times.sort()
+    print '%-40s min %8.2fms  median %8.2fms' % (
+        title, times[0] * 1000, times[len(times)//2] * 1000)
+
+
+def populate(controller, root_uuid, size):
+    folders = [root_uuid]
+    commands = []
+    for i in range(size):
+        token = 'T%d' % i
+        commands.append(('add', folders[i // 100], 'node%d' % i,
+                         'nt:unstructured', {'title': u'Node %d' % i},
+                         token))
+        folders.append(token)
+    map = controller.sendCommands(commands, finish='commit')
+    return [map['T%d' % i] for i in range(size)]
+
+
+def modify(controller, uuids, other=None):
+    controller.sendCommands([('modify', uuid, {'count': time.time()})
+                             for uuid in uuids])
+    if other is not None:
+        other.sendCommands([('modify', other.storage.root_uuid,
+                             {'count': time.time()})], finish='commit')
+    controller.prepare()
+    controller.commit()
+
+
+def getPaths(controller, uuids):
+    for uuid in uuids:
+        controller.getPath(uuid)
+
+
+def moveCopy(controller, uuid, dest_uuid):
+    controller.move(uuid, dest_uuid, 'moved')
+    controller.copy(uuid, dest_uuid, 'copied')
+    controller.abort()
+
+
+def main(sizes=(1000, 10000, 100000)):
+    for size in sizes:
+        STORAGES.pop((FakeDB.database_name, FakeDB.workspace_name), None)
+        controller = FakeJCRController(FakeDB())
+        other = FakeJCRController(FakeDB())
+        root_uuid = controller.login(FakeDB.workspace_name)
+        other.login(FakeDB.workspace_name)
+        start = time.time()
+        uuids = populate(controller, root_uuid, size)
+        print 'created %d nodes in %.2fs' % (size, time.time() - start)
+        leaf = uuids[-1]
+        step = size // CHANGES
+        uuids = uuids[::step][:CHANGES]
+        timeit('%d nodes, commit' % size, modify, controller, uuids)
+        timeit('%d nodes, commit with merge' % size, modify, controller,
+               uuids, other)
+        timeit('%d nodes, getPath' % size, getPaths, controller, uuids)
+        timeit('%d nodes, searchProperty' % size,
+               controller.searchProperty, 'title', u'Node %d' % (size-1))
+        timeit('%d nodes, move and copy' % size, moveCopy, controller,
+               leaf, root_uuid)
+        controller.close()
+        other.close()
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    if args:
+        main(args)
+    else:
+        main()
@@ -0,0 +1,430 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Load generator for the whole Zope to JCR stack.
+
+Creates a folder of documents with generator.py, then opens one DB
+connection per thread, each thread running a random mix of operations
+for a given time:
+
+- traverse: get a document from the root by name and read a property,
+- unghostify: the same after ghostifying the document,
+- setprop: set a property of a document and commit,
+- add: add a document to the thread's own folder and commit,
+- move: rename one of the thread's documents and commit,
+- search: search documents by property value,
+- checkpoint: checkpoint one of the thread's documents.
+
+The shared documents are modified concurrently, conflicts are counted
+as errors. For each operation are reported the throughput, the p50,
+p95 and p99 latencies, and the round trips and bytes exchanged with
+the server, per operation.
+
+Usage: python benchload.py [options] host:port
+       python benchload.py [options] --standin cndpath
+
+With --standin, a stand-in server is started for the run.
+
+Options: --workspace name, --threads n, --duration seconds,
+--documents n, --seed n, --mix op=weight,..., --folder-type type,
+--document-type type, --property name.
+"""
+
+import os
+import sys
+import time
+import bisect
+import getopt
+import random
+import signal
+import socket
+import threading
+
+from transaction import TransactionManager
+
+from nuxeo.jcr.db import DB
+from nuxeo.jcr.impl import Document
+from nuxeo.jcr.impl import ObjectProperty
+from nuxeo.jcr.impl import Children
+from nuxeo.jcr.impl import ListProperty
+from nuxeo.jcr.tests.generator import Generator
+from nuxeo.jcr.tests.generator import populate
+
+OPERATIONS = ('traverse', 'unghostify', 'setprop', 'add', 'move',
+              'search', 'checkpoint')
+DEFAULT_MIX = ('traverse=40,unghostify=20,setprop=20,add=10,move=5,'
+               'search=4,checkpoint=1')
+VALUES = 100 # distinct values set, so that searches find something
+
+
+class Address(object):
+    family = socket.AF_INET
+
+    def __init__(self, address):
+        host, port = address.split(':')
+        self.address = (host, int(port))
+
+
+def percentile(values, q):
+    """Get a percentile of sorted values.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values)-1, int(len(values) * q))]
+
+
+class OperationStats(object):
+    """Measures of one operation, merged from all the threads.
+    """
+
+    def __init__(self):
+        self.times = []
+        self.errors = 0
+        self.error = None # last error message
+        self.round_trips = 0
+        self.bytes = 0
+
+    def add(self, elapsed, round_trips, bytes):
+        self.times.append(elapsed)
+        self.round_trips += round_trips
+        self.bytes += bytes
+
+    def addError(self, exc):
+        self.errors += 1
+        self.error = '%s: %s' % (exc.__class__.__name__, exc)
+
+    def merge(self, other):
+        self.times.extend(other.times)
+        self.errors += other.errors
+        self.error = other.error or self.error
+        self.round_trips += other.round_trips
+        self.bytes += other.bytes
+
+
+class LoadThread(threading.Thread):
+    """Runs random operations on its own connection.
+    """
+
+    def __init__(self, bench, number):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.bench = bench
+        self.number = number
+        self.random = random.Random(bench.seed + number)
+        self.stats = dict((op, OperationStats()) for op in OPERATIONS)
+        self.exc_info = None
+        self._names = [] # names of the documents in our folder
+        self._next_name = 0
+
+    def run(self):
+        bench = self.bench
+        self.tm = TransactionManager()
+        self.conn = bench.db.open(transaction_manager=self.tm)
+        controller = self.conn.controller
+        try:
+            try:
+                self._setUp()
+                bench.barrier.wait()
+                choose = bench.chooser(self.random)
+                while time.time() < bench.deadline:
+                    op = choose()
+                    round_trips = getattr(controller, 'round_trips', 0)
+                    bytes = (getattr(controller, 'bytes_sent', 0) +
+                             getattr(controller, 'bytes_received', 0))
+                    start = time.time()
+                    try:
+                        getattr(self, 'op_' + op)()
+                    except Exception, e:
+                        self.tm.abort()
+                        self.stats[op].addError(e)
+                        continue
+                    elapsed = time.time() - start
+                    self.stats[op].add(
+                        elapsed,
+                        getattr(controller, 'round_trips', 0) - round_trips,
+                        getattr(controller, 'bytes_sent', 0) +
+                        getattr(controller, 'bytes_received', 0) - bytes)
+            except:
+                self.exc_info = sys.exc_info()
+                bench.barrier.abort()
+        finally:
+            self.tm.abort()
+            self.conn.close()
+
+    def _setUp(self):
+        bench = self.bench
+        root = self.conn.root()
+        name = u'%s-%d' % (bench.name, self.number)
+        self.folder = root.addChild(name, bench.folder_type)
+        self.tm.commit()
+        self.op_add()
+
+    def _document(self):
+        bench = self.bench
+        folder = self.conn.root()[bench.name]
+        return folder[u'doc%d' % self.random.randrange(bench.documents)]
+
+    def _ownDocument(self):
+        return self.folder[self.random.choice(self._names)]
+
+    def op_traverse(self):
+        self._document().getProperty(self.bench.property)
+
+    def op_unghostify(self):
+        doc = self._document()
+        doc._p_deactivate()
+        doc.getProperty(self.bench.property)
+
+    def op_setprop(self):
+        value = u'value%d' % self.random.randrange(VALUES)
+        self._document().setProperty(self.bench.property, value)
+        self.tm.commit()
+
+    def op_add(self):
+        name = u'added%d' % self._next_name
+        self._next_name += 1
+        self.folder.addChild(name, self.bench.document_type)
+        self.tm.commit()
+        self._names.append(name)
+
+    def op_move(self):
+        i = self.random.randrange(len(self._names))
+        name = u'moved%d' % self._next_name
+        self._next_name += 1
+        self.conn.move(self.folder[self._names[i]], self.folder, name)
+        self.tm.commit()
+        self._names[i] = name
+
+    def op_search(self):
+        value = u'value%d' % self.random.randrange(VALUES)
+        self.conn.searchProperty(self.bench.property, value)
+
+    def op_checkpoint(self):
+        # The versioning properties aren't read back, as stand-ins
+        # don't maintain them
+        self.conn.controller.checkpoint(self._ownDocument().getUUID())
+
+
+class Barrier(object):
+    """Lets the threads start the measures together.
+
+    The last thread to arrive calls `action` before the others resume.
+    """
+
+    def __init__(self, count, action):
+        self.count = count
+        self.action = action
+        self.aborted = False
+        self.condition = threading.Condition()
+
+    def wait(self):
+        self.condition.acquire()
+        try:
+            self.count -= 1
+            if self.count == 0:
+                self.action()
+                self.condition.notifyAll()
+            while self.count > 0 and not self.aborted:
+                self.condition.wait()
+        finally:
+            self.condition.release()
+
+    def abort(self):
+        self.condition.acquire()
+        try:
+            self.aborted = True
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+
+class LoadBench(object):
+    """Runs operations from several threads and reports their measures.
+    """
+
+    def __init__(self, db, threads=4, duration=10, documents=1000,
+                 seed=0, mix=DEFAULT_MIX, folder_type='ecmnt:folder',
+                 document_type='tripreport', property='dc:title'):
+        self.db = db
+        self.threads = threads
+        self.duration = duration
+        self.documents = documents
+        self.seed = seed
+        self.mix = parseMix(mix)
+        self.folder_type = folder_type
+        self.document_type = document_type
+        self.property = property
+        self.name = u'benchload%d' % time.time()
+
+    def chooser(self, r):
+        """Get a function choosing operations according to the mix.
+        """
+        ops = []
+        bounds = []
+        total = 0
+        for op, weight in self.mix:
+            total += weight
+            ops.append(op)
+            bounds.append(total)
+        def choose():
+            return ops[bisect.bisect_right(bounds, r.random() * total)]
+        return choose
+
+    def setUp(self):
+        """Create the shared documents.
+        """
+        db = self.db
+        tm = TransactionManager()
+        conn = db.open(transaction_manager=tm)
+        try:
+            schema_manager = conn.getSchemaManager()
+            setClasses(schema_manager)
+            root_uuid = conn.root_uuid
+        finally:
+            conn.close()
+        controller = db.controller_class(db)
+        controller.connect()
+        controller.login(db.workspace_name)
+        try:
+            generator = Generator(schema_manager, self.folder_type,
+                                  [self.document_type], seed=self.seed,
+                                  depth=0, documents=self.documents)
+            populate(controller, root_uuid, generator, self.name)
+        finally:
+            controller.close()
+
+    def run(self):
+        """Run the threads, returns the merged stats of each operation.
+        """
+        # The setup of the threads isn't measured
+        self.start = None
+        self.deadline = 0
+        self.barrier = Barrier(self.threads, self._begin)
+        threads = [LoadThread(self, i) for i in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.time() - (self.start or 0)
+        stats = dict((op, OperationStats()) for op in OPERATIONS)
+        for thread in threads:
+            if thread.exc_info is not None:
+                t, v, tb = thread.exc_info
+                raise t, v, tb
+            for op, s in thread.stats.iteritems():
+                stats[op].merge(s)
+        return stats
+
+    def _begin(self):
+        self.start = time.time()
+        self.deadline = self.start + self.duration
+
+    def report(self, stats, out=sys.stdout):
+        print >>out, ('%-12s %8s %7s %9s %9s %9s %9s %7s %9s' % (
+            'operation', 'count', 'errors', 'ops/s', 'p50 ms', 'p95 ms',
+            'p99 ms', 'rt/op', 'bytes/op'))
+        total = 0
+        for op in OPERATIONS:
+            s = stats[op]
+            count = len(s.times)
+            if not count and not s.errors:
+                continue
+            total += count
+            times = s.times[:]
+            times.sort()
+            print >>out, (
+                '%-12s %8d %7d %9.1f %9.2f %9.2f %9.2f %7.1f %9d' % (
+                op, count, s.errors, count / self.elapsed,
+                percentile(times, 0.50) * 1000,
+                percentile(times, 0.95) * 1000,
+                percentile(times, 0.99) * 1000,
+                float(s.round_trips) / max(count, 1),
+                s.bytes // max(count, 1)))
+        print >>out, '%d operations in %.2fs, %.1f ops/s, %d threads' % (
+            total, self.elapsed, total / self.elapsed, self.threads)
+        for op in OPERATIONS:
+            if stats[op].error is not None:
+                print >>out, 'last %s error: %s' % (op, stats[op].error)
+
+
+def parseMix(mix):
+    """Parse 'op=weight,...' into a list of (op, weight).
+    """
+    res = []
+    for item in mix.split(','):
+        op, weight = item.split('=')
+        op = op.strip()
+        if op not in OPERATIONS:
+            raise ValueError("Unknown operation %r" % op)
+        res.append((op, float(weight)))
+    return res
+
+
+def setClasses(schema_manager):
+    """Set the base classes, as the ZCML does in Zope.
+    """
+    schema_manager.setClass('ecmnt:document', Document)
+    schema_manager.setClass('ecmnt:schema', ObjectProperty)
+    schema_manager.setClass('ecmnt:children', Children)
+    schema_manager.setClass('IContainer', ListProperty)
+
+
+def main(args):
+    opts, args = getopt.getopt(args, '', [
+        'workspace=', 'threads=', 'duration=', 'documents=', 'seed=',
+        'mix=', 'folder-type=', 'document-type=', 'property=', 'standin='])
+    workspace = 'default'
+    standin = None
+    params = {}
+    for opt, value in opts:
+        key = opt[2:].replace('-', '_')
+        if opt == '--workspace':
+            workspace = value
+        elif opt == '--standin':
+            standin = value
+        elif opt in ('--threads', '--documents', '--seed'):
+            params[key] = int(value)
+        elif opt == '--duration':
+            params[key] = float(value)
+        else:
+            params[key] = value
+    if (standin is None) == (len(args) != 1):
+        print __doc__
+        sys.exit(1)
+
+    process = None
+    if standin is not None:
+        from nuxeo.jcr.tests.standin import spawn
+        process, port = spawn(0, [standin])
+        address = 'localhost:%d' % port
+    else:
+        address = args[0]
+    try:
+        db = DB(server=Address(address), workspace_name=workspace,
+                pool_size=params.get('threads', 4) + 1)
+        bench = LoadBench(db, **params)
+        start = time.time()
+        bench.setUp()
+        print 'created %d documents in %.2fs' % (bench.documents,
+                                                 time.time() - start)
+        bench.report(bench.run())
+    finally:
+        if process is not None:
+            os.kill(process.pid, signal.SIGTERM)
+            process.wait()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,240 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Micro-benchmarks of the controller codec and connection internals.
+
+No server is needed: the controller talks to the FakeSocket of
+test_controller, the connection to a FakeJCRController.
+
+Each benchmark is run `repeat` times, and a tab-separated line is
+written for it with its name, the number of runs, and the minimum,
+median and maximum times in milliseconds. With --compare, the results
+of a previous run are read and the ratio of the medians is added.
+
+Usage: python benchmicro.py [-n repeat] [-o file] [--compare file]
+                            [name-prefix...]
+"""
+
+import os
+import sys
+import time
+import getopt
+from random import Random
+from datetime import datetime
+
+from transaction import TransactionManager
+from nuxeo.capsule.base import Blob
+
+from nuxeo.jcr.cnd import Parser
+from nuxeo.jcr.cnd import InterfaceMaker
+from nuxeo.jcr.controller import JCRController
+from nuxeo.jcr.connection import findInserts
+from nuxeo.jcr.db import DB
+from nuxeo.jcr.impl import Document
+from nuxeo.jcr.impl import ObjectProperty
+from nuxeo.jcr.impl import Children
+from nuxeo.jcr.impl import ListProperty
+from nuxeo.jcr.tests.fakeserver import FakeJCRController
+from nuxeo.jcr.tests.fakeserver import STORAGES
+from nuxeo.jcr.tests.test_controller import FakeSocket
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+
+
+class FakeDB(object):
+    server = None
+
+
+def makeController(data):
+    c = JCRController(FakeDB())
+    c._sock = FakeSocket(data)
+    return c
+
+
+def benchGetNodeStates(children=1000):
+    """Decode the state of a node with many children.
+    """
+    lines = ['Uuuid-folder folder', '^uuid-parent']
+    for i in xrange(children):
+        lines.append('Nuuid-%d ecmnt:document child%d' % (i, i))
+    lines.extend(['Pjcr:primaryType', 'necmnt:children',
+                  'Ptitle', 's6', 'Folder',
+                  '.\n'])
+    data = '\n'.join(lines)
+    def run():
+        c = makeController(data)
+        c.getNodeStates(['uuid-folder'])
+    return run
+
+
+def benchSendCommands(props=500):
+    """Encode a batch modifying many properties of all kinds.
+    """
+    values = [u'caf\xe9 babe', 123456, 3.14, True,
+              datetime(2006, 4, 7, 18, 0, 42, 754000),
+              [u'foo', u'bar', u'baz'], Blob('x' * 100)]
+    properties = {}
+    for i in xrange(props):
+        properties[u'prop%d' % i] = values[i % len(values)]
+    commands = [('modify', 'uuid', properties)]
+    def run():
+        c = makeController('.\n')
+        c.sendCommands(commands)
+    return run
+
+
+def benchFindInserts(size=10000, shuffled=True):
+    """Find the inserts reordering many children.
+    """
+    old = ['name%d' % i for i in xrange(size)]
+    new = old[:]
+    if shuffled:
+        Random(1234).shuffle(new)
+    else:
+        new.insert(10, new.pop(size - 10))
+    def run():
+        findInserts(old, new)
+    return run
+
+
+def readCND(name):
+    return file(os.path.join(testdir, name)).read()
+
+
+def benchParseCND(name='jackrabbit.cnd'):
+    """Parse a CND file.
+    """
+    cnd = readCND(name)
+    def run():
+        Parser(cnd).getData()
+    return run
+
+
+def benchBuildSchemas(name='test_basic.cnd'):
+    """Parse a CND file and build its interfaces and fields.
+    """
+    cnd = readCND(name)
+    def run():
+        InterfaceMaker(cnd)
+    return run
+
+
+def benchLoadNodeState(children=1000):
+    """Load the state of a folder, creating the ghosts of its children.
+
+    Nothing keeps the ghosts, so they are created again each time.
+    """
+    class LoadDB(DB):
+        server = None
+        _nodetypedefs = readCND('test_basic.cnd')
+        controller_class = FakeJCRController
+
+    STORAGES.pop(('benchmicro', 'default'), None)
+    db = LoadDB(database_name='benchmicro')
+    conn = db.open(transaction_manager=TransactionManager())
+    sm = conn.getSchemaManager()
+    sm.setClass('ecmnt:document', Document)
+    sm.setClass('ecmnt:schema', ObjectProperty)
+    sm.setClass('ecmnt:children', Children)
+    sm.setClass('IContainer', ListProperty)
+    commands = [('add', conn.root_uuid, 'folder', 'ecmnt:folder', {}, 'T0'),
+                ('add', 'T0', 'ecm:children', 'ecmnt:children', {}, 'T1')]
+    for i in xrange(children):
+        commands.append(('add', 'T1', 'doc%d' % i, 'tripreport',
+                         {'dc:title': u'Doc %d' % i}, 'T%d' % (i+2)))
+    uuid = conn.controller.sendCommands(commands, finish='commit')['T1']
+    obj = conn.get(uuid, 'ecmnt:children')
+    def run():
+        conn._loadNodeState(obj, uuid)
+    return run
+
+
+BENCHMARKS = [
+    ('getNodeStates-1000-children', benchGetNodeStates, (1000,)),
+    ('sendCommands-500-properties', benchSendCommands, (500,)),
+    ('findInserts-10000-shuffled', benchFindInserts, (10000, True)),
+    ('findInserts-100000-one-move', benchFindInserts, (100000, False)),
+    ('cnd-parse-jackrabbit', benchParseCND, ('jackrabbit.cnd',)),
+    ('cnd-buildSchemas-test_basic', benchBuildSchemas, ('test_basic.cnd',)),
+    ('loadNodeState-1000-children', benchLoadNodeState, (1000,)),
+    ]
+
+
+def measure(func, repeat):
+    """Time `func`, returns the sorted times in seconds.
+    """
+    func() # warm up
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    times.sort()
+    return times
+
+
+def readResults(path):
+    """Read the medians of a previous run, by name.
+    """
+    medians = {}
+    for line in file(path):
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 5 or fields[0] == 'name':
+            continue
+        medians[fields[0]] = float(fields[3])
+    return medians
+
+
+def run(names=(), repeat=20, out=sys.stdout, previous=None):
+    """Run the benchmarks whose name starts with one of `names`.
+    """
+    header = ['name', 'runs', 'min_ms', 'median_ms', 'max_ms']
+    if previous is not None:
+        header.append('ratio')
+    print >>out, '\t'.join(header)
+    for name, setup, args in BENCHMARKS:
+        if names and not [n for n in names if name.startswith(n)]:
+            continue
+        times = measure(setup(*args), repeat)
+        median = times[len(times)//2] * 1000
+        fields = [name, str(repeat), '%.3f' % (times[0] * 1000),
+                  '%.3f' % median, '%.3f' % (times[-1] * 1000)]
+        if previous is not None:
+            old = previous.get(name)
+            if old:
+                fields.append('%.2f' % (median / old))
+            else:
+                fields.append('')
+        print >>out, '\t'.join(fields)
+        out.flush()
+
+
+def main(args):
+    opts, names = getopt.getopt(args, 'n:o:', ['compare='])
+    repeat = 20
+    out = sys.stdout
+    previous = None
+    for opt, value in opts:
+        if opt == '-n':
+            repeat = int(value)
+        elif opt == '-o':
+            out = file(value, 'w')
+        elif opt == '--compare':
+            previous = readResults(value)
+    run(names, repeat, out, previous)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
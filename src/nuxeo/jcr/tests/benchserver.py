@@ -0,0 +1,108 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Micro-benchmark of getNodeStates against a running JCR server.
+
+Creates a folder with 1000 children, then times getNodeStates on the
+folder and on all its children, first when the transaction has changes
+(so the server can't use its cache), then in a new transaction. Then
+times getPath on the children, an equality searchProperty, and a move
+and copy of a child, comparable with benchfakeserver.py.
+
+Usage: python benchserver.py [host:port [workspace [children]]]
+"""
+
+import sys
+import time
+import socket
+
+from nuxeo.jcr.controller import JCRController
+
+
+class Address(object):
+    family = socket.AF_INET
+
+    def __init__(self, address):
+        host, port = address.split(':')
+        self.address = (host, int(port))
+
+
+class FakeDB(object):
+    def __init__(self, address):
+        self.server = Address(address)
+
+
+def timeit(title, func, *args):
+    times = []
+    for i in range(5):
+        start = time.time()
+        func(*args)
+        times.append(time.time() - start)
+    times.sort()
+    print '%-40s min %8.2fms  median %8.2fms' % (
+        title, times[0] * 1000, times[len(times)//2] * 1000)
+
+
+def getPaths(controller, uuids):
+    for uuid in uuids:
+        controller.getPath(uuid)
+
+
+def moveCopy(controller, uuid, dest_uuid):
+    controller.move(uuid, dest_uuid, 'moved')
+    controller.copy(uuid, dest_uuid, 'copied')
+    controller.abort()
+
+
+def main(address='localhost:8181', workspace='default', children=1000):
+    controller = JCRController(FakeDB(address))
+    controller.connect()
+    root_uuid = controller.login(workspace)
+
+    commands = [('add', root_uuid, 'bench%d' % time.time(), 'nt:unstructured',
+                 {}, 'T0')]
+    for i in range(children):
+        commands.append(('add', 'T0', 'child%d' % i, 'nt:unstructured',
+                         {'title': u'Child %d' % i, 'count': i},
+                         'T%d' % (i+1)))
+    start = time.time()
+    map = controller.sendCommands(commands)
+    print 'created %d nodes in %.2fs' % (children+1, time.time() - start)
+    folder = map['T0']
+    uuids = [map['T%d' % (i+1)] for i in range(children)]
+
+    # The transaction has changes, no server cache
+    timeit('folder, uncached', controller.getNodeStates, [folder])
+    timeit('children, uncached', controller.getNodeStates, uuids)
+    controller.commit()
+
+    # Committed, the server cache can be used
+    timeit('folder', controller.getNodeStates, [folder])
+    timeit('children', controller.getNodeStates, uuids)
+
+    timeit('getPath', getPaths, controller, uuids[:10])
+    timeit('searchProperty', controller.searchProperty,
+           'title', u'Child %d' % (children-1))
+    timeit('move and copy', moveCopy, controller, uuids[-1], folder)
+
+    controller.sendCommands([('remove', folder)], finish='commit')
+    controller.close()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) > 2:
+        args[2] = int(args[2])
+    main(*args)
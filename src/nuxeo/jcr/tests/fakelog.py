@@ -0,0 +1,272 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Durable storage for the fake JCR server.
+
+The nodes are kept in a log file, each commit appending the changed
+nodes then a commit marker. Only the offsets of the last records are
+kept in memory, the nodes are read back through a memory map. When
+there are more obsolete records than live ones, the log is compacted
+into a new file that replaces it.
+
+Each record is a 4-byte length followed by a kind, the uuid, a NUL and
+the pickled node. A commit marker has the version and the next uuid
+counter instead. Records following the last commit marker are dropped
+when the log is opened.
+
+To use it with the fake controller::
+
+  STORAGES[(database_name, workspace_name)] = FakeJCRLogStorage(path)
+"""
+
+import os
+import mmap
+import struct
+import cPickle
+
+from nuxeo.jcr.tests.fakeserver import FakeJCRNode
+from nuxeo.jcr.tests.fakeserver import FakeJCRStorage
+
+COMPACT_MIN = 10000 # obsolete records before compaction is considered
+WRITE_CHUNK = 1000 # records written at once when compacting
+
+
+def makeRecord(kind, key, data=''):
+    payload = '%s%s\0%s' % (kind, key, data)
+    return struct.pack('>I', len(payload)) + payload
+
+
+class LogFile(object):
+    """Append-only file read through a memory map.
+
+    Positions given to readRecord() are in the file, the storage's
+    virtual offsets are `base` more.
+    """
+
+    def __init__(self, path, base=0):
+        self.path = path
+        self.base = base
+        self.file = open(path, 'a+b')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = None
+
+    def close(self):
+        self.map = None
+        self.file.close()
+
+    def append(self, records, sync=True):
+        data = ''.join(records)
+        self.file.write(data)
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+        self.size += len(data)
+
+    def truncate(self, size):
+        self.file.truncate(size)
+        self.size = size
+        self.map = None
+
+    def remap(self):
+        self.map = mmap.mmap(self.file.fileno(), self.size,
+                             access=mmap.ACCESS_READ)
+        return self.map
+
+    def readRecord(self, pos):
+        """Read a whole record, with its length.
+        """
+        m = self.map
+        if m is None or pos + 4 > len(m):
+            m = self.remap()
+        length = struct.unpack('>I', m[pos:pos+4])[0]
+        end = pos + 4 + length
+        if end > len(m):
+            m = self.remap()
+        return m[pos:end]
+
+
+class FakeJCRLogStorage(FakeJCRStorage):
+    """Committed state of a fake workspace, kept in a log file.
+
+    Records hold the virtual offset of their node in the log. Virtual
+    offsets keep growing across compactions, so that a reader can still
+    find a node in the previous log file while the new one replaces it.
+    """
+
+    def __init__(self, path):
+        FakeJCRStorage.__init__(self)
+        self.path = path
+        self.logs = [LogFile(path)] # newest first
+        self._obsolete = 0 # records replaced since the last compaction
+        if self.logs[0].size:
+            self._load()
+        else:
+            root = self.records[self.root_uuid][1]
+            offsets = self._write({self.root_uuid: root}, self.version)
+            self.records[self.root_uuid] = (0, offsets[self.root_uuid])
+
+    def close(self):
+        for log in self.logs:
+            log.close()
+        self.logs = []
+
+    def _load(self):
+        log = self.logs[0]
+        records = self.records
+        records.clear()
+        pending = {}
+        pos = 0
+        committed = 0
+        while pos + 4 <= log.size:
+            record = log.readRecord(pos)
+            length = len(record) - 4
+            if struct.unpack('>I', record[:4])[0] != length or length < 2:
+                break # truncated
+            kind = record[4]
+            key = record[5:record.index('\0', 5)]
+            if kind == 'n':
+                pending[key] = pos
+            elif kind == 'r':
+                pending[key] = None
+            elif kind == 'c':
+                version, next_uuid = key.split(' ')
+                for uuid, offset in pending.iteritems():
+                    if uuid in records:
+                        self._obsolete += 1
+                    if offset is None:
+                        records.pop(uuid, None)
+                    else:
+                        records[uuid] = (0, offset)
+                pending = {}
+                self.version = int(version)
+                self._next_uuid = int(next_uuid)
+                committed = pos + 4 + length
+            else:
+                raise ValueError("Bad record at %d in %s" % (pos, log.path))
+            pos += 4 + length
+        if committed < log.size:
+            # Uncommitted or truncated records
+            log.truncate(committed)
+
+    def _getLog(self, offset):
+        for log in self.logs:
+            if offset >= log.base:
+                return log
+        raise ValueError("No log for offset %d" % offset)
+
+    def getNode(self, uuid, version):
+        """Get a node as of a version, or None.
+
+        A record read just before two compactions may point to a log
+        that was closed since, the node is then found again from the
+        new records.
+        """
+        while True:
+            record = self.records.get(uuid)
+            try:
+                return FakeJCRStorage.getNode(self, uuid, version)
+            except ValueError:
+                if self.records.get(uuid) is record:
+                    raise
+
+    def loadNode(self, offset):
+        if offset is None or isinstance(offset, FakeJCRNode):
+            return offset
+        log = self._getLog(offset)
+        record = log.readRecord(offset - log.base)
+        i = record.index('\0', 5)
+        name, type, parent_uuid, children, properties = cPickle.loads(
+            record[i+1:])
+        return FakeJCRNode(name, type, parent_uuid, children, properties)
+
+    def _write(self, changes, version):
+        """Append nodes and a commit marker, returns their offsets.
+        """
+        log = self.logs[0]
+        records = []
+        offsets = {}
+        offset = log.base + log.size
+        for uuid, node in changes.iteritems():
+            if node is None:
+                record = makeRecord('r', uuid)
+                offsets[uuid] = None
+            else:
+                data = cPickle.dumps((node.name, node.type, node.parent_uuid,
+                                      node.children, node.properties), 2)
+                record = makeRecord('n', uuid, data)
+                offsets[uuid] = offset
+            records.append(record)
+            offset += len(record)
+        records.append(makeRecord('c', '%d %d' % (version, self._next_uuid)))
+        log.append(records)
+        return offsets
+
+    def _store(self, changes):
+        version = self.version + 1
+        for uuid in changes:
+            if uuid in self.records:
+                self._obsolete += 1
+        FakeJCRStorage._store(self, self._write(changes, version))
+        if (self._obsolete > COMPACT_MIN and
+            self._obsolete > len(self.records)):
+            self.compact()
+
+    def compact(self):
+        """Rewrite the log with only the last records.
+        """
+        self.lock.acquire()
+        try:
+            old = self.logs[0]
+            # Older versions seen by snapshots are kept in memory
+            history = self.history
+            for uuid, older in history.items():
+                history[uuid] = [(v, self.loadNode(node))
+                                 for v, node in older]
+            oldest = self._oldest()
+            tmp = self.path + '.tmp'
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            new = LogFile(tmp, old.base + old.size)
+            records = []
+            offsets = {}
+            offset = new.base
+            for uuid, (version, node) in self.records.items():
+                if node is None:
+                    if version <= oldest:
+                        # Removed before any snapshot
+                        del self.records[uuid]
+                    continue
+                record = old.readRecord(node - old.base)
+                records.append(record)
+                offsets[uuid] = (version, offset)
+                offset += len(record)
+                if len(records) >= WRITE_CHUNK:
+                    new.append(records, sync=False)
+                    records = []
+            records.append(makeRecord('c', '%d %d' % (self.version,
+                                                      self._next_uuid)))
+            new.append(records)
+            os.rename(tmp, self.path)
+            new.path = self.path
+            # The previous log is still read by current readers, older
+            # ones can't be reached from the records anymore
+            dropped = self.logs[1:]
+            self.logs = [new, old]
+            self.records.update(offsets)
+            self._obsolete = 0
+            for log in dropped:
+                log.close()
+        finally:
+            self.lock.release()
@@ -15,20 +15,56 @@
 # $Id$
 """Fake JCR server.
 
-Does a full copy of the state to simulate transactions.
-Does a 3-way merge when something is committed.
+Committed nodes are kept as versioned records that are never modified.
+A transaction works on a snapshot of one version and copies the nodes it
+modifies, so beginning a transaction is O(1) and committing it is
+O(changes). Does a 3-way merge when something else was committed since
+the transaction began.
 """
 
-from copy import deepcopy
+import threading
 
 import zope.interface
 from nuxeo.jcr.interfaces import IJCRController
 from nuxeo.jcr.interfaces import ProtocolError
 from nuxeo.jcr.interfaces import ConflictError
+from nuxeo.jcr.interfaces import EventsLostError
 
 
 STORAGES = {}
 
+HISTORY_PRUNE = 1000 # history size above which it's pruned
+PATH_CACHE_SIZE = 100000 # paths cached by a storage
+
+
+def indexKeys(value):
+    """Get the strings under which a property value is indexed.
+
+    Values are Python values, or (type letter, data) for the stand-in
+    server. Binaries and dates aren't indexed.
+    """
+    if isinstance(value, list):
+        values = value
+    else:
+        values = [value]
+    keys = []
+    for v in values:
+        if isinstance(v, tuple):
+            tag, data = v
+            if tag == 's':
+                keys.append(unicode(data, 'utf-8'))
+            elif tag != 'x':
+                keys.append(data)
+        elif isinstance(v, basestring):
+            keys.append(v)
+        elif isinstance(v, bool):
+            keys.append(str(v).lower())
+        elif isinstance(v, (int, long, float)):
+            keys.append(str(v))
+        elif hasattr(v, 'getTargetUUID'):
+            keys.append(v.getTargetUUID())
+    return keys
+
 
 class FakeJCRNode(object):
     def __init__(self, name, type, parent_uuid, children, properties):
@@ -39,8 +75,14 @@ class FakeJCRNode(object):
         self.properties = properties
         properties['jcr:primaryType'] = type
 
+    def copy(self):
+        return FakeJCRNode(self.name, self.type, self.parent_uuid,
+                           list(self.children), dict(self.properties))
+
 
 class FakeJCR(object):
+    """In-memory tree of nodes.
+    """
 
     def __init__(self):
         self.root_uuid = 'cafe-babe'
@@ -53,9 +95,16 @@ class FakeJCR(object):
         self._next_uuid += 1
         return uuid
 
+    def getWritable(self, uuid):
+        """Get a node that can be modified.
+
+        Raises KeyError if there's no such node.
+        """
+        return self.data[uuid]
+
     def modifyProperties(self, uuid, props):
         try:
-            node = self.data[uuid]
+            node = self.getWritable(uuid)
         except KeyError:
             raise ProtocolError(uuid)
         for key, value in props.iteritems():
@@ -69,7 +118,7 @@ class FakeJCR(object):
         if uuid in self.data:
             raise ProtocolError("Already has a node %r" % uuid)
         try:
-            parent = self.data[parent_uuid]
+            parent = self.getWritable(parent_uuid)
         except KeyError:
             raise ProtocolError("No parent %r" % parent_uuid)
         # Create node
@@ -84,30 +133,94 @@ class FakeJCR(object):
         except KeyError:
             raise ProtocolError(uuid)
         puuid = node.parent_uuid
-        del self.data[uuid]
+        # Remove the node and its subtree
+        todo = [uuid]
+        while todo:
+            removed = todo.pop()
+            todo.extend([n[1] for n in self.data[removed].children])
+            del self.data[removed]
         # Remove from parent's children
         if puuid is not None:
-            parent = self.data[puuid]
+            parent = self.getWritable(puuid)
             parent.children = [n for n in parent.children
                                if n[1] != uuid]
 
     def reorderChildren(self, uuid, inserts):
         try:
-            children = self.data[uuid].children
+            children = self.getWritable(uuid).children
         except KeyError:
             raise ProtocolError(uuid)
         names = [c[0] for c in children]
         for name, before in inserts:
-            # Move `name` before `before`
+            # Move `name` before `before` (or to the end)
             i = names.index(name)
-            j = names.index(before)
-            assert j < i
             x = children.pop(i)
+            names.pop(i)
+            if before is None:
+                j = len(names)
+            else:
+                j = names.index(before)
             children.insert(j, x)
             # Do that in names too
-            names.pop(i)
             names.insert(j, name)
 
+    def setChildrenOrder(self, uuid, names):
+        try:
+            node = self.getWritable(uuid)
+        except KeyError:
+            raise ProtocolError(uuid)
+        children = dict(node.children)
+        if len(names) != len(children) or set(names) != set(children):
+            raise ProtocolError("Names mismatch for %r" % uuid)
+        node.children = [(name, children[name]) for name in names]
+
+    def move(self, uuid, dest_uuid, name):
+        try:
+            node = self.getWritable(uuid)
+            dest = self.getWritable(dest_uuid)
+        except KeyError, e:
+            raise ProtocolError("No such uuid %r" % e.args[0])
+        if node.parent_uuid is None:
+            raise ProtocolError("Cannot move the root")
+        if name in dict(dest.children):
+            raise ProtocolError("Already has a node %r" %
+                                self.getPath(dest_uuid, name))
+        puuid = dest_uuid
+        while puuid is not None:
+            if puuid == uuid:
+                raise ProtocolError("Cannot move %r under itself" % uuid)
+            puuid = self.data[puuid].parent_uuid
+        parent = self.getWritable(node.parent_uuid)
+        parent.children = [n for n in parent.children if n[1] != uuid]
+        dest.children.append((name, uuid))
+        node.name = name
+        node.parent_uuid = dest_uuid
+
+    def copy(self, uuid, dest_uuid, name):
+        """Copy a node and its subtree, returns the uuid of the copy.
+        """
+        if uuid not in self.data:
+            raise ProtocolError("No such uuid %r" % uuid)
+        try:
+            dest = self.getWritable(dest_uuid)
+        except KeyError:
+            raise ProtocolError("No such uuid %r" % dest_uuid)
+        if name in dict(dest.children):
+            raise ProtocolError("Already has a node %r" %
+                                self.getPath(dest_uuid, name))
+        copy_uuid = self._copyTree(uuid, dest_uuid, name)
+        dest.children.append((name, copy_uuid))
+        return copy_uuid
+
+    def _copyTree(self, uuid, parent_uuid, name):
+        node = self.data[uuid]
+        copy_uuid = self.newUUID()
+        children = [(cname, self._copyTree(cuuid, copy_uuid, cname))
+                    for cname, cuuid in node.children]
+        self.data[copy_uuid] = FakeJCRNode(name, node.type, parent_uuid,
+                                           children, dict(node.properties))
+        return copy_uuid
+
     def getPath(self, uuid, name=None):
         """For error display.
         """
@@ -121,6 +234,329 @@ class FakeJCR(object):
         return '/'.join(reversed(path))
 
 
+class SnapshotData(object):
+    """Mapping of uuid to node seen by a snapshot.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __getitem__(self, uuid):
+        node = self.snapshot.getNode(uuid)
+        if node is None:
+            raise KeyError(uuid)
+        return node
+
+    def get(self, uuid, default=None):
+        node = self.snapshot.getNode(uuid)
+        if node is None:
+            return default
+        return node
+
+    def __contains__(self, uuid):
+        return self.snapshot.getNode(uuid) is not None
+
+    def __setitem__(self, uuid, node):
+        self.snapshot.local[uuid] = node
+
+    def __delitem__(self, uuid):
+        if uuid not in self:
+            raise KeyError(uuid)
+        self.snapshot.local[uuid] = None
+
+
+class FakeJCRSnapshot(FakeJCR):
+    """Transaction view of a storage as of a given version.
+
+    Nodes are copied into `local` the first time they're modified, the
+    committed ones are shared with the storage and the other snapshots.
+    The keys of `local` are thus the uuids touched by the transaction.
+    """
+
+    def __init__(self, storage, version):
+        self.storage = storage
+        self.root_uuid = storage.root_uuid
+        self.version = version
+        self.local = {} # uuid -> node, or None if removed
+        self.data = SnapshotData(self)
+        self.moved = False # some node was moved or renamed
+
+    def newUUID(self):
+        return self.storage.newUUID()
+
+    def move(self, uuid, dest_uuid, name):
+        FakeJCR.move(self, uuid, dest_uuid, name)
+        self.moved = True
+
+    def getPath(self, uuid, name=None):
+        """Get the path of a node, the root's being ''.
+
+        Committed paths are cached by the storage.
+        """
+        cache = None
+        if not self.moved:
+            cache = self.storage.getPathCache(self.version)
+        chain = []
+        path = None
+        while uuid is not None:
+            if cache is not None:
+                path = cache.get(uuid)
+                if path is not None:
+                    break
+            node = self.data[uuid]
+            chain.append((uuid, node))
+            uuid = node.parent_uuid
+        local = self.local
+        for uuid, node in reversed(chain):
+            if node.parent_uuid is None:
+                path = ''
+            else:
+                path = path + '/' + node.name
+            if cache is not None and uuid not in local:
+                cache[uuid] = path
+        if name is not None:
+            path = path + '/' + name
+        return path
+
+    def searchProperty(self, name, value):
+        """Get the uuids of the nodes with a property having a value.
+        """
+        # The storage index is for the last version, the nodes changed
+        # since ours are in its history
+        uuids = self.storage.searchProperty(name, value)
+        uuids.update(self.storage.history.keys())
+        uuids.update(self.local.keys())
+        res = []
+        for uuid in uuids:
+            node = self.getNode(uuid)
+            if node is None:
+                continue
+            if value in indexKeys(node.properties.get(name)):
+                res.append(uuid)
+        return res
+
+    def getNode(self, uuid):
+        """Get a node, or None. The node must not be modified.
+        """
+        try:
+            return self.local[uuid]
+        except KeyError:
+            return self.storage.getNode(uuid, self.version)
+
+    def getWritable(self, uuid):
+        if uuid in self.local:
+            node = self.local[uuid]
+        else:
+            node = self.storage.getNode(uuid, self.version)
+            if node is not None:
+                node = node.copy()
+                self.local[uuid] = node
+        if node is None:
+            raise KeyError(uuid)
+        return node
+
+
+class FakeJCRStorage(object):
+    """Committed state of a fake workspace, shared by its connections.
+
+    Each node has a last (version, node) record, the node being None
+    once removed. When a commit replaces a record that snapshots may
+    still see, the old one goes to the node's history, which only keeps
+    what the oldest snapshot needs.
+    """
+
+    def __init__(self):
+        self.root_uuid = 'cafe-babe'
+        root = FakeJCRNode('', 'rep:root', None, [], {})
+        self.records = {self.root_uuid: (0, root)} # uuid -> last record
+        self.history = {} # uuid -> list of older records, oldest first
+        self.version = 0
+        self.lock = threading.RLock()
+        self._next_uuid = 1
+        self._snapshots = {} # version -> number of snapshots using it
+        self._history_limit = HISTORY_PRUNE
+        self.index = None # (name, value) -> set of uuids, built if needed
+        self.paths = {} # uuid -> path, for versions >= paths_version
+        self.paths_version = 0
+
+    def close(self):
+        pass
+
+    def getPathCache(self, version):
+        """Get the path cache usable by a snapshot, or None.
+        """
+        paths = self.paths
+        if version < self.paths_version:
+            return None
+        if len(paths) > PATH_CACHE_SIZE:
+            paths = self.paths = {}
+        return paths
+
+    def searchProperty(self, name, value):
+        """Get the uuids having a property with a value, last version.
+        """
+        self.lock.acquire()
+        try:
+            if self.index is None:
+                self._buildIndex()
+            return set(self.index.get((name, value), ()))
+        finally:
+            self.lock.release()
+
+    def _buildIndex(self):
+        self.index = {}
+        for uuid, (version, node) in self.records.items():
+            self._indexNode(uuid, self.loadNode(node), True)
+
+    def _indexNode(self, uuid, node, add):
+        if node is None:
+            return
+        index = self.index
+        for name, value in node.properties.iteritems():
+            for key in indexKeys(value):
+                if add:
+                    index.setdefault((name, key), set()).add(uuid)
+                else:
+                    uuids = index.get((name, key))
+                    if uuids is not None:
+                        uuids.discard(uuid)
+                        if not uuids:
+                            del index[(name, key)]
+
+    def newUUID(self):
+        self.lock.acquire()
+        try:
+            uuid = 'cafe-%04d' % self._next_uuid
+            self._next_uuid += 1
+        finally:
+            self.lock.release()
+        return uuid
+
+    def loadNode(self, node):
+        """Get the node stored in a record.
+        """
+        return node
+
+    def getNode(self, uuid, version):
+        """Get a node as of a version, or None.
+        """
+        record = self.records.get(uuid)
+        if record is None:
+            return None
+        if record[0] <= version:
+            return self.loadNode(record[1])
+        older = self.history.get(uuid, ())
+        i = len(older) - 1
+        while i >= 0:
+            v, node = older[i]
+            if v <= version:
+                return self.loadNode(node)
+            i -= 1
+        return None
+
+    def snapshot(self):
+        """Get a snapshot of the last committed version.
+        """
+        self.lock.acquire()
+        try:
+            version = self.version
+            self._snapshots[version] = self._snapshots.get(version, 0) + 1
+        finally:
+            self.lock.release()
+        return FakeJCRSnapshot(self, version)
+
+    def release(self, snapshot):
+        """Release a snapshot, its version may not be kept anymore.
+        """
+        self.lock.acquire()
+        try:
+            version = snapshot.version
+            count = self._snapshots[version] - 1
+            if count:
+                self._snapshots[version] = count
+            else:
+                del self._snapshots[version]
+                if not self._snapshots:
+                    self.history = {}
+        finally:
+            self.lock.release()
+
+    def commit(self, snapshot):
+        """Commit the changes made in a snapshot.
+
+        If something else was committed since the snapshot was taken,
+        the changes are merged, which may raise a ConflictError.
+        """
+        self.lock.acquire()
+        try:
+            if snapshot.version == self.version:
+                changes = snapshot.local
+            else:
+                initial = FakeJCRSnapshot(self, snapshot.version)
+                new = FakeJCRSnapshot(self, self.version)
+                Merger(initial, snapshot, new).merge(snapshot.local)
+                changes = new.local
+            if snapshot.moved:
+                # Cached paths of this version on are invalid
+                self.paths_version = self.version + 1
+                self.paths = {}
+            self._store(changes)
+        finally:
+            self.lock.release()
+
+    def _oldest(self):
+        """Version of the oldest snapshot. Called with the lock held.
+        """
+        if self._snapshots:
+            return min(self._snapshots)
+        return self.version
+
+    def _store(self, changes):
+        """Store the changes as a new version. Called with the lock held.
+        """
+        version = self.version + 1
+        records = self.records
+        history = self.history
+        if self.index is not None:
+            for uuid, node in changes.iteritems():
+                old = records.get(uuid)
+                if old is not None:
+                    self._indexNode(uuid, self.loadNode(old[1]), False)
+                self._indexNode(uuid, self.loadNode(node), True)
+        keep = bool(self._snapshots)
+        if keep:
+            oldest = self._oldest()
+        for uuid, node in changes.iteritems():
+            old = records.get(uuid)
+            if keep and old is not None:
+                # Readers look at history after records
+                history[uuid] = self._prune(history.get(uuid, []) + [old],
+                                            oldest)
+            records[uuid] = (version, node)
+        self.version = version
+        if len(history) > self._history_limit:
+            self._pruneHistory()
+
+    def _prune(self, older, oldest):
+        # Keep the last record seen by the oldest snapshot, and after
+        i = len(older) - 1
+        while i > 0 and older[i][0] > oldest:
+            i -= 1
+        return older[i:]
+
+    def _pruneHistory(self):
+        """Drop the history no snapshot needs anymore.
+        """
+        oldest = self._oldest()
+        history = self.history
+        for uuid, older in history.items():
+            if self.records[uuid][0] <= oldest:
+                del history[uuid]
+            else:
+                history[uuid] = self._prune(older, oldest)
+        self._history_limit = max(HISTORY_PRUNE, 2 * len(history))
+
+
 class Merger(object):
     """3-way merge of storages.
     """
@@ -129,25 +565,78 @@ class Merger(object):
         self.current = current
         self.new = new
 
-    def merge(self):
-        self._merge(self.initial.root_uuid)
+    def merge(self, uuids=None):
+        """Merge the changes.
 
-    def _merge(self, uuid):
-        try:
-            ini = self.initial.data[uuid]
-            cur = self.current.data[uuid]
-            new = self.new.data[uuid]
-        except KeyError:
-            raise # XXX
-        self._mergeProperties(uuid, ini.properties, cur.properties,
-                              new.properties)
-        self._mergeChildren(uuid, ini.children, cur.children, new.children)
+        If `uuids`, the nodes changed in current, is given only they are
+        visited, otherwise the whole tree is.
+        """
+        if uuids is None:
+            self._merge(self.initial.root_uuid, True)
+            return
+        removed = []
+        for uuid in uuids:
+            if uuid not in self.initial.data:
+                # Added, moved with its parent
+                continue
+            if uuid not in self.current.data:
+                removed.append(uuid)
+                continue
+            self._merge(uuid, False)
+        for uuid in removed:
+            self._checkRemoved(uuid)
+        for uuid in removed:
+            if uuid in self.new.data:
+                del self.new.data[uuid]
+
+    def _checkRemoved(self, uuid):
+        """Check that a node removed in current is unchanged in new.
+
+        Its subtree is checked too, as children added to it in new would
+        be lost.
+        """
+        ini = self.initial.data[uuid]
+        new = self.new.data.get(uuid)
+        if new is None:
+            return
+        if (new.name != ini.name or new.parent_uuid != ini.parent_uuid or
+            new.properties != ini.properties or
+            new.children != ini.children):
+            raise ConflictError("Remove/change of node %r" %
+                                self.initial.getPath(uuid))
+        for name, child_uuid in ini.children:
+            self._checkRemoved(child_uuid)
+
+    def _merge(self, uuid, recurse):
+        ini = self.initial.data[uuid]
+        cur = self.current.data[uuid]
+        new = self.new.data.get(uuid)
+        moved = ini.name != cur.name or ini.parent_uuid != cur.parent_uuid
+        if (moved or ini.properties != cur.properties or
+            ini.children != cur.children):
+            if new is None:
+                raise ConflictError("Change/remove of node %r" %
+                                    self.current.getPath(uuid))
+            new = self.new.getWritable(uuid)
+            if moved:
+                if ((new.name, new.parent_uuid) not in
+                    ((ini.name, ini.parent_uuid), (cur.name, cur.parent_uuid))):
+                    raise ConflictError("Moves of node %r" %
+                                        self.current.getPath(uuid))
+                new.name = cur.name
+                new.parent_uuid = cur.parent_uuid
+            self._mergeProperties(uuid, ini.properties, cur.properties,
+                                  new.properties)
+            self._mergeChildren(uuid, ini.children, cur.children,
+                                new.children)
+        if not recurse or new is None:
+            return
 
         # Recurse to merge children
         for name, child_uuid in new.children:
             if child_uuid in self.initial.data:
                 # Node existed before, merge needed
-                self._merge(child_uuid)
+                self._merge(child_uuid, True)
 
     def _mergeProperties(self, uuid, ini, cur, new):
         # No changes in cur, keep new
@@ -192,6 +681,12 @@ class Merger(object):
         if ini == cur:
             return
 
+        # Children removed in cur must be unchanged in new
+        cur_uuids = set(i[1] for i in cur)
+        for name, child_uuid in ini:
+            if child_uuid not in cur_uuids:
+                self._checkRemoved(child_uuid)
+
         # No changes in new, use cur as new
         if ini == new:
             # Move added uuids from cur to new
@@ -201,20 +696,42 @@ class Merger(object):
             new[:] = cur[:]
             return
 
-        # Only adds in cur and new, merge them
-        lini = len(ini)
-        if cur[:lini] == ini and new[:lini] == ini:
-            # Check disjoint names added
-            added_cur = set(i[0] for i in cur[lini:])
-            added_new = set(i[0] for i in new[lini:])
-            conflicts = added_cur & added_new
-            if conflicts:
-                raise ConflictError("Adds of child %r" %
-                                self.current.getPath(uuid, conflicts.pop()))
+        # Removes, renames and adds on each side, merge them. Children
+        # removed from new must have been moved, not deleted.
+        ini_uuids = set(i[1] for i in ini)
+        cur_names = dict((u, n) for n, u in cur)
+        new_names = dict((u, n) for n, u in new)
+        added_cur = [(n, u) for n, u in cur if u not in ini_uuids]
+        added_new = [(n, u) for n, u in new if u not in ini_uuids]
+        if (cur == [(cur_names[u], u) for n, u in ini if u in cur_names]
+            + added_cur and
+            new == [(new_names[u], u) for n, u in ini if u in new_names]
+            + added_new):
+            merged = []
+            for name, child_uuid in ini:
+                if child_uuid not in new_names:
+                    if child_uuid not in self.new.data:
+                        raise ConflictError("Change/remove of child %r" %
+                                            self.current.getPath(uuid, name))
+                    continue
+                if child_uuid not in cur_names:
+                    continue
+                cur_name = cur_names[child_uuid]
+                if cur_name == name:
+                    cur_name = new_names[child_uuid]
+                merged.append((cur_name, child_uuid))
+            merged.extend(added_new)
+            merged.extend(added_cur)
+            names = set()
+            for name, child_uuid in merged:
+                if name in names:
+                    raise ConflictError("Adds of child %r" %
+                                        self.current.getPath(uuid, name))
+                names.add(name)
             # Move added from cur to new
-            for name, child_uuid in cur[lini:]:
+            for name, child_uuid in added_cur:
                 self._moveUUID(child_uuid, self.current, self.new)
-                new.append((name, child_uuid))
+            new[:] = merged
             return
 
         raise ConflictError("Unknown children merge situation")
@@ -222,7 +739,11 @@ class Merger(object):
 
     def _moveUUID(self, uuid, src, dst):
         """Move uuid and its children recursively from src to dst storages.
+
+        Nodes that existed before were moved, they're merged separately.
         """
+        if uuid in self.initial.data:
+            return
         if uuid in dst.data:
             raise ValueError("UUID %r already in destination", uuid)
         dst.data[uuid] = src.data[uuid]
@@ -230,6 +751,48 @@ class Merger(object):
             self._moveUUID(uuid, src, dst)
 
 
+def runCommands(storage, tokens, commands):
+    """Run the commands of a batch on a storage.
+
+    `tokens` is the token -> uuid map of the transaction, it's updated.
+    Returns the token -> uuid map of the nodes added by the batch.
+    """
+    map = {} # token -> uuid
+    for command in commands:
+        op = command[0]
+        if op == 'add':
+            puuid, name, node_type, props, token = command[1:]
+            if puuid in tokens:
+                puuid = tokens[puuid]
+            uuid = storage.newUUID()
+            storage.addChild(puuid, uuid, name, node_type, [], props)
+            map[token] = uuid
+            tokens[token] = uuid
+        elif op == 'modify':
+            uuid, props = command[1:]
+            if uuid in tokens:
+                uuid = tokens[uuid]
+            storage.modifyProperties(uuid, props)
+        elif op == 'remove':
+            uuid = command[1]
+            if uuid in tokens:
+                uuid = tokens[uuid]
+            storage.removeNode(uuid)
+        elif op == 'reorder':
+            uuid, inserts = command[1:]
+            if uuid in tokens:
+                uuid = tokens[uuid]
+            storage.reorderChildren(uuid, inserts)
+        elif op == 'setorder':
+            uuid, names = command[1:]
+            if uuid in tokens:
+                uuid = tokens[uuid]
+            storage.setChildrenOrder(uuid, names)
+        else:
+            raise ProtocolError("invalid op %r" % (op,))
+    return map
+
+
 class FakeJCRController(object):
     """Fake JCR Controller.
     """
@@ -237,9 +800,9 @@ class FakeJCRController(object):
 
     def __init__(self, db=None):
         self.db = db
-        key = self._getKey()
-        if key not in STORAGES:
-            STORAGES[key] = FakeJCR()
+        self._batches = [] # results of started batches
+        self.storage = None # current snapshot
+        STORAGES.setdefault(self._getKey(), FakeJCRStorage())
 
     def _getKey(self):
         return (self.db.database_name, self.db.workspace_name)
@@ -251,6 +814,11 @@ class FakeJCRController(object):
     def connect(self):
         pass
 
+    def close(self):
+        if self.storage is not None:
+            self.real_storage.release(self.storage)
+            self.storage = None
+
     def login(self, workspaceName):
         key = self._getKey()
         self.real_storage = STORAGES[key]
@@ -258,23 +826,18 @@ class FakeJCRController(object):
         return self.storage.root_uuid
 
     def _begin(self):
-        # Would be synchronized in real life but we're single threaded here
-        self.initial_storage = deepcopy(self.real_storage)
-        self.storage = deepcopy(self.real_storage)
+        if self.storage is not None:
+            self.real_storage.release(self.storage)
+        self.storage = self.real_storage.snapshot()
+        self._tokens = {} # token -> uuid for the transaction
 
     def prepare(self):
         # Apply all changes, may raise a conflict error
-        # Would be synchronized in real life but we're single threaded here
-        initial = self.initial_storage
-        current = self.storage
-        new = self.real_storage
-        # Apply to `new` the changes from `initial` to `current`
-        # This is really a 3-way merge
-        Merger(initial, current, new).merge()
+        self.real_storage.commit(self.storage)
         self._begin()
 
     def commit(self):
-        # Each storage is single-threaded, prepare did all the work
+        # The storage is locked during prepare, which did all the work
         pass
 
     def abort(self):
@@ -302,62 +865,84 @@ class FakeJCRController(object):
     def getNodeStates(self, uuids):
         infos = {}
         for uuid in uuids:
-            try:
-                node = self.storage.data[uuid]
-            except KeyError:
-                raise ProtocolError(uuid)
-            children = [(name, cuuid, self.storage.data[cuuid].type)
-                        for name, cuuid in node.children]
-            infos[uuid] = (node.name, node.parent_uuid,
-                           children,
-                           node.properties.items(),
-                           [])
+            infos[uuid] = self._getNodeState(uuid)
         return infos
 
-    def sendCommands(self, commands):
-        map = {} # token -> uuid
-        for command in commands:
-            op = command[0]
-            if op == 'add':
-                puuid, name, node_type, props, token = command[1:]
-                if puuid in map:
-                    puuid = map[puuid]
-                uuid = self.newUUID()
-                self.storage.addChild(puuid, uuid, name, node_type, [], props)
-                map[token] = uuid
-            elif op == 'modify':
-                uuid, props = command[1:]
-                if uuid in map:
-                    uuid = map[uuid]
-                self.storage.modifyProperties(uuid, props)
-            elif op == 'remove':
-                uuid = command[1]
-                if uuid in map:
-                    uuid = map[uuid]
-                self.storage.removeNode(uuid)
-            elif op == 'reorder':
-                uuid, inserts = command[1:]
-                if uuid in map:
-                    uuid = map[uuid]
-                self.storage.reorderChildren(uuid, inserts)
-            else:
-                raise ProtocolError("invalid op %r" % (op,))
-        return map
+    def _getNodeState(self, uuid):
+        try:
+            node = self.storage.data[uuid]
+        except KeyError:
+            raise ProtocolError(uuid)
+        children = [(name, cuuid, self.storage.data[cuuid].type)
+                    for name, cuuid in node.children]
+        return (node.name, node.parent_uuid,
+                children,
+                node.properties.items(),
+                [])
+
+    def exportNodes(self, uuid):
+        yield uuid, self._getNodeState(uuid)
+        stack = [iter(self.storage.data[uuid].children)]
+        while stack:
+            try:
+                name, uuid = stack[-1].next()
+            except StopIteration:
+                stack.pop()
+                continue
+            yield uuid, self._getNodeState(uuid)
+            stack.append(iter(self.storage.data[uuid].children))
+
+    def sendCommands(self, commands, finish=None):
+        if not self.startCommands(commands, finish=finish):
+            return {}
+        return self.finishCommands()
+
+    def startCommands(self, commands, save_every=0, finish=None):
+        commands = list(commands)
+        if not commands and finish is None:
+            return False
+        map = self._runCommands(commands)
+        if finish is not None:
+            # prepare does all the work of a commit
+            self.prepare()
+        self._batches.append(map)
+        return True
+
+    def finishCommands(self):
+        if not self._batches:
+            raise ProtocolError("No batch of commands to finish")
+        return self._batches.pop(0)
+
+    def _runCommands(self, commands):
+        return runCommands(self.storage, self._tokens, commands)
 
     def getNodeProperties(self, uuid, names):
         raise NotImplementedError('Unused')
 
     def getPendingEvents(self):
-        raise NotImplementedError('Unused')
+        return []
+
+    def changesSince(self, seq, limit=0):
+        if seq:
+            raise EventsLostError([], 0)
+        return 0, []
 
     def getPath(self, uuid):
-        raise NotImplementedError
+        if uuid not in self.storage.data:
+            return None
+        return self.storage.getPath(uuid) or u'/'
 
     def searchProperty(self, prop_name, value):
-        raise NotImplementedError
+        res = [(self.storage.getPath(uuid), uuid)
+               for uuid in self.storage.searchProperty(prop_name, value)]
+        res.sort()
+        return [(uuid, path) for path, uuid in res]
 
     def move(self, uuid, dest_uuid, name):
-        raise NotImplementedError
+        self.storage.move(uuid, dest_uuid, name)
 
     def copy(self, uuid, dest_uuid, name):
-        raise NotImplementedError
+        self.storage.copy(uuid, dest_uuid, name)
+
+    def getStats(self):
+        return {}
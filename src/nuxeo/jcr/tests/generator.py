@@ -0,0 +1,307 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Generator of synthetic repositories for benchmarks.
+
+Builds trees shaped like CPS ones: folders nested `depth` levels deep,
+each with `width` subfolders and `documents` documents in its
+ecm:children node, and optionally a folder 'wide' at the top with
+`wide` documents. The properties of the documents are filled according
+to the schemas of their node types, complex properties and list items
+becoming child nodes as they do with a Connection. The same seed and
+parameters always give the same repository.
+
+The nodes go either directly into a FakeJCR, or to any server through
+batches of 'add' commands. Versions are made by checkpointing the
+documents, which needs a server supporting it.
+
+Usage: python generator.py [options] host:port folder-type doc-type...
+
+Options: --workspace name, --seed n, --depth n, --width n,
+--documents n, --wide n, --list-items n, --blob-size n, --versions n.
+The node types are the ones of the server.
+"""
+
+import sys
+import time
+import getopt
+import socket
+import random
+from datetime import datetime
+from datetime import timedelta
+
+import zope.schema
+from zope.schema.interfaces import IField
+from zope.schema.interfaces import IList
+from zope.schema.interfaces import IBool
+from zope.schema.interfaces import IInt
+from zope.schema.interfaces import IFloat
+from zope.schema.interfaces import IDatetime
+from zope.schema.interfaces import IText
+
+from nuxeo.capsule.base import Blob
+from nuxeo.capsule.field import ListPropertyField
+from nuxeo.capsule.field import ObjectPropertyField
+from nuxeo.capsule.field import BlobField
+from nuxeo.capsule.field import ReferenceField
+
+from nuxeo.jcr.importer import ImportSession
+from nuxeo.jcr.schema import SchemaManager
+
+WORDS = (u'report trip city name place date title description summary '
+         u'project meeting budget caf\xe9 r\xe9sum\xe9 na\xefve \xe9t\xe9 '
+         u'document folder section workspace review draft final '
+         u'public private member manager editor').split()
+MAX_NESTING = 3 # levels of complex properties inside a node
+BLOB_POOL = 1 << 16 # random bytes blobs are taken from
+
+
+def schemaFields(schema):
+    """Get the (name, field) defined by the CND of a node type.
+
+    The fields of the predefined interfaces are not included. Sorted
+    by name, so that the generation doesn't depend on dict order.
+    """
+    fields = {}
+    for iface in schema.__iro__:
+        if iface.__module__ != 'nuxeo.jcr.dynamic':
+            continue
+        for name in iface.names():
+            field = iface[name]
+            if IField.providedBy(field) and name not in fields:
+                fields[name] = field
+    fields = fields.items()
+    fields.sort()
+    return fields
+
+
+class Generator(object):
+    """Generates the nodes of a synthetic repository.
+
+    `document_types` are chosen at random for the documents, the
+    folders are of `folder_type`.
+    """
+
+    def __init__(self, schema_manager, folder_type, document_types,
+                 seed=0, depth=3, width=5, documents=20, wide=0,
+                 list_items=3, blob_size=10000, versions=0):
+        self.schema_manager = schema_manager
+        self.folder_type = folder_type
+        self.document_types = list(document_types)
+        self.seed = seed
+        self.depth = depth
+        self.width = width
+        self.documents = documents
+        self.wide = wide
+        self.list_items = list_items
+        self.blob_size = blob_size
+        self.versions = versions
+        self.versionable = [] # keys of the documents, once generated
+
+    def nodes(self, name=u'generated'):
+        """Iterate on the nodes, parents before children.
+
+        Yields (key, parent_key, name, node_type, properties) as the
+        Importer expects, the key None being the generation point.
+        """
+        self.random = random.Random(self.seed)
+        self._blob_pool = ''.join([chr(self.random.randrange(256))
+                                   for i in xrange(BLOB_POOL)])
+        self._next_key = 0
+        self.versionable = []
+        # parent key, name, depth, documents
+        stack = [(None, name, self.depth, self.documents)]
+        while stack:
+            parent_key, name, depth, count = stack.pop()
+            key = None
+            for node in self._document(parent_key, name, self.folder_type):
+                if key is None:
+                    key = node[0]
+                yield node
+            children_key = self._newKey()
+            yield (children_key, key, u'ecm:children', 'ecmnt:children', {})
+            for i in xrange(count):
+                node_type = self.random.choice(self.document_types)
+                for node in self._document(children_key, u'doc%d' % i,
+                                           node_type):
+                    yield node
+            if depth > 0:
+                folders = [(children_key, u'folder%d' % i, depth-1,
+                            self.documents) for i in xrange(self.width)]
+                folders.reverse()
+                stack.extend(folders)
+            if parent_key is None and self.wide:
+                stack.append((children_key, u'wide', 0, self.wide))
+
+    def _newKey(self):
+        self._next_key += 1
+        return self._next_key
+
+    def _document(self, parent_key, name, node_type):
+        nodes = []
+        key = self._node(nodes, parent_key, name, node_type, 0)
+        self.versionable.append(key)
+        return nodes
+
+    def _node(self, nodes, parent_key, name, node_type, nesting):
+        """Generate a node and its complex properties into `nodes`.
+        """
+        key = self._newKey()
+        props = {}
+        nodes.append((key, parent_key, name, node_type, props))
+        schema = self.schema_manager.getInterface(node_type)
+        for prop_name, field in schemaFields(schema):
+            if prop_name == 'ecm:children':
+                continue
+            if isinstance(field, ListPropertyField):
+                if nesting < MAX_NESTING:
+                    self._list(nodes, key, prop_name, field.schema, nesting)
+            elif isinstance(field, ObjectPropertyField):
+                if nesting < MAX_NESTING:
+                    self._node(nodes, key, prop_name,
+                               field.schema.getName(), nesting+1)
+            else:
+                value = self.makeValue(field)
+                if value is not None:
+                    props[prop_name] = value
+        return key
+
+    def _list(self, nodes, parent_key, name, schema, nesting):
+        key = self._newKey()
+        nodes.append((key, parent_key, name, schema.getName(), {}))
+        precondition = schema['__setitem__'].getTaggedValue('precondition')
+        item_type = precondition.types[0].getName()
+        for i in xrange(self.random.randint(0, self.list_items)):
+            self._node(nodes, key, u'%d' % i, item_type, nesting+1)
+
+    def makeValue(self, field):
+        """Make a random value for a simple field, or None.
+        """
+        r = self.random
+        if isinstance(field, BlobField):
+            size = r.randint(self.blob_size // 2, self.blob_size * 3 // 2)
+            return Blob(self._blobData(size))
+        if isinstance(field, ReferenceField):
+            return None
+        if IList.providedBy(field):
+            values = [self.makeValue(field.value_type)
+                      for i in xrange(r.randint(0, self.list_items))]
+            return [v for v in values if v is not None]
+        if IBool.providedBy(field):
+            return r.random() < 0.5
+        if IInt.providedBy(field):
+            return r.randrange(100000)
+        if IFloat.providedBy(field):
+            return r.random() * 1000
+        if IDatetime.providedBy(field):
+            return datetime(2000, 1, 1) + timedelta(
+                seconds=r.randrange(200000000))
+        if IText.providedBy(field) or type(field) is zope.schema.Field:
+            return u' '.join([r.choice(WORDS)
+                              for i in xrange(r.randint(1, 10))])
+        return None
+
+    def _blobData(self, size):
+        pool = self._blob_pool
+        chunks = []
+        while size > 0:
+            start = self.random.randrange(len(pool))
+            chunk = pool[start:start+size]
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+
+def populateFake(jcr, parent_uuid, nodes):
+    """Add the nodes directly to a FakeJCR or one of its snapshots.
+
+    Returns the key -> uuid map.
+    """
+    uuids = {None: parent_uuid}
+    for key, parent_key, name, node_type, props in nodes:
+        uuid = jcr.newUUID()
+        jcr.addChild(uuids[parent_key], uuid, name, node_type, [], props)
+        uuids[key] = uuid
+    return uuids
+
+
+def populate(controller, parent_uuid, generator, name=u'generated',
+             batch_size=500, save_every=1000, commit_every=20000):
+    """Add the generated nodes through a controller, and version them.
+
+    Returns the number of nodes created.
+    """
+    session = ImportSession(controller, batch_size, save_every,
+                            commit_every)
+    session.setUUID(None, parent_uuid)
+    try:
+        for node in generator.nodes(name):
+            session.add(*node)
+        session.commit()
+    except:
+        session.abort()
+        raise
+    for i in xrange(generator.versions):
+        for key in generator.versionable:
+            controller.checkpoint(session.getUUID(key))
+    return session.count
+
+
+class Address(object):
+    family = socket.AF_INET
+
+    def __init__(self, address):
+        host, port = address.split(':')
+        self.address = (host, int(port))
+
+
+class FakeDB(object):
+    def __init__(self, address):
+        self.server = Address(address)
+
+
+def main(args):
+    from nuxeo.jcr.controller import JCRController
+    opts, args = getopt.getopt(args, '', [
+        'workspace=', 'seed=', 'depth=', 'width=', 'documents=', 'wide=',
+        'list-items=', 'blob-size=', 'versions='])
+    if len(args) < 3:
+        print __doc__
+        sys.exit(1)
+    workspace = 'default'
+    params = {}
+    for opt, value in opts:
+        if opt == '--workspace':
+            workspace = value
+        else:
+            params[opt[2:].replace('-', '_')] = int(value)
+    address, folder_type, document_types = args[0], args[1], args[2:]
+
+    controller = JCRController(FakeDB(address))
+    controller.connect()
+    root_uuid = controller.login(workspace)
+    schema_manager = SchemaManager()
+    schema_manager.addCND(controller.getNodeTypeDefs())
+    generator = Generator(schema_manager, folder_type, document_types,
+                          **params)
+    start = time.time()
+    count = populate(controller, root_uuid, generator,
+                     u'generated%d' % time.time())
+    print 'created %d nodes in %.2fs' % (count, time.time() - start)
+    controller.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,451 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Replay of recorded sessions against a JCR server.
+
+Each session of the recording gets its own thread and connection, and
+sends what was recorded at the same times, divided by the speed. The
+recorded traffic is parsed into commands and their answers. Before
+sending, a session reads the answers that had been received before that
+point in the recording, so that requests still wait for the answers
+they depended on, and write-behind batches are still pipelined.
+
+The uuids the server assigns to added nodes, given by the token map of
+the batch answers, and the root uuid given at login, are mapped to the
+ones of the replay and replaced in the following commands. A replayed
+answer that differs from the recorded one once mapped counts as a
+mismatch, except for the server statistics. A session waiting for an
+answer that never comes gives up after the timeout.
+
+The server should hold the same repository as the recorded one for the
+other uuids to make sense, for instance a stand-in restarted from a copy
+of its log. When each session is replayed once, the sessions share the
+uuid mapping, so that a session can use a node added by another one.
+
+Usage: python replay.py [--speed n] [--copies n] [--timeout s]
+                        host:port recording
+
+A speed of 0 replays as fast as possible. With --copies, each recorded
+session is replayed that many times concurrently.
+"""
+
+import re
+import sys
+import time
+import getopt
+import socket
+import threading
+from StringIO import StringIO
+
+from nuxeo.jcr.recorder import OPEN
+from nuxeo.jcr.recorder import SENT
+from nuxeo.jcr.recorder import RECEIVED
+from nuxeo.jcr.recorder import CLOSE
+from nuxeo.jcr.recorder import readSessions
+
+# A value line followed by that many bytes of data and a newline
+COUNTED = re.compile(r'^[sx](\d+)$')
+
+# Commands answered by lines up to a '.'
+DOTTED = ('D', 'S', 'e', 'E', 'J', 's', 'I')
+
+# Commands without answer
+SILENT = ('q', 'Q')
+
+# Commands whose answers aren't expected to be replayed identically
+UNCOMPARED = ('I',)
+
+
+def percentile(values, q):
+    """Get a percentile of sorted values.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values)-1, int(len(values) * q))]
+
+
+class Reader(object):
+    """Reads lines and data from a file, keeping track of the position.
+
+    Raises EOFError at the end of the file.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.pos = 0
+
+    def readline(self):
+        line = self.f.readline()
+        if not line.endswith('\n'):
+            raise EOFError("Truncated line %r" % line)
+        self.pos += len(line)
+        return line[:-1]
+
+    def read(self, n):
+        data = self.f.read(n)
+        if len(data) != n:
+            raise EOFError("Truncated data")
+        self.pos += n
+        return data
+
+    def readCounted(self, match):
+        """Read the data following a counted value line, and its newline.
+        """
+        return self.read(int(match.group(1)) + 1)[:-1]
+
+
+def readCommand(reader, counted):
+    """Read a command sent to the server.
+
+    Returns its first line, followed by the end of a batch ('.', 'p' or
+    'c') for a batch. The positions of the counted data of the batch
+    are appended to `counted`.
+    """
+    line = reader.readline()
+    if not line.startswith('M'):
+        return line
+    end = None
+    while True:
+        line = reader.readline()
+        if line in ('.', 'p', 'c'):
+            return 'M' + line
+        op = line[:1]
+        if op in ('+', '/'):
+            end = ','
+        elif op == '%':
+            end = '%'
+        elif op == '#':
+            end = '/'
+        else:
+            continue
+        while True:
+            line = reader.readline()
+            if line == end:
+                break
+            match = end == ',' and COUNTED.match(line)
+            if match:
+                start = reader.pos
+                reader.readCounted(match)
+                counted.append((start, reader.pos))
+
+
+def readAnswer(reader, command):
+    """Read the answer to a command, as a list of lines.
+
+    Counted data follow their value line. Returns None for a command
+    without answer.
+    """
+    tag = command[:1]
+    if tag in SILENT:
+        return None
+    line = reader.readline()
+    lines = [line]
+    if line.startswith('!'):
+        return lines
+    if tag == 'M':
+        while line != '.':
+            line = reader.readline()
+            lines.append(line)
+        if command[1:] in ('p', 'c'):
+            lines.append(reader.readline())
+    elif tag in DOTTED:
+        while line != '.':
+            if tag in ('S', 'e'):
+                match = COUNTED.match(line)
+                if match:
+                    lines.append(reader.readCounted(match))
+            line = reader.readline()
+            lines.append(line)
+    return lines
+
+
+def split(data, offset, counted):
+    """Split sent data into (chunk, is counted data) pieces.
+
+    The data starts at offset in the stream, counted has the positions
+    of the counted data in the stream.
+    """
+    pieces = []
+    pos = offset
+    end = offset + len(data)
+    for start, stop in counted:
+        if stop <= pos or start >= end:
+            continue
+        if start > pos:
+            pieces.append((data[pos-offset:start-offset], False))
+            pos = start
+        stop = min(stop, end)
+        pieces.append((data[pos-offset:stop-offset], True))
+        pos = stop
+    if pos < end:
+        pieces.append((data[pos-offset:], False))
+    return pieces
+
+
+def exchanges(frames):
+    """Turn the frames of a session into (time, pieces, answers).
+
+    The pieces (see split) are sent at time, after the answers have
+    been read. answers is a list of (command, recorded answer lines).
+    A final exchange with pieces None closes the session.
+    """
+    sent = ''.join([data for kind, elapsed, data in frames
+                    if kind == SENT])
+    received = ''.join([data for kind, elapsed, data in frames
+                        if kind == RECEIVED])
+    counted = []
+    commands = [''] # the welcome message
+    reader = Reader(StringIO(sent))
+    try:
+        while reader.pos < len(sent):
+            commands.append(readCommand(reader, counted))
+    except EOFError:
+        pass # truncated recording
+    # (end in the received data, command, lines)
+    answers = []
+    reader = Reader(StringIO(received))
+    try:
+        for command in commands:
+            lines = readAnswer(reader, command)
+            if lines is not None:
+                answers.append((reader.pos, command, lines))
+    except EOFError:
+        pass # not all answered before the end of the recording
+    res = []
+    sent_pos = received_pos = 0
+    done = 0
+    for kind, elapsed, data in frames:
+        if kind == RECEIVED:
+            received_pos += len(data)
+            continue
+        if kind not in (SENT, CLOSE):
+            continue
+        todo = done
+        while todo < len(answers) and answers[todo][0] <= received_pos:
+            todo += 1
+        wait = [(command, lines) for pos, command, lines
+                in answers[done:todo]]
+        done = todo
+        if kind == SENT:
+            res.append((elapsed, split(data, sent_pos, counted), wait))
+            sent_pos += len(data)
+        else:
+            res.append((elapsed, None, wait))
+    return res
+
+
+class SessionReplay(threading.Thread):
+    """Replays one session.
+    """
+
+    def __init__(self, replay, start, exchanges, uuids=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.replay = replay
+        self.start_time = start
+        self.exchanges = exchanges
+        if uuids is None:
+            uuids = {}
+        self.uuids = uuids # recorded uuid -> replayed uuid
+        self.pattern = None
+        self.pattern_size = 0
+        self.latencies = [] # from a send to the reception of its answer
+        self.lags = [] # how late sends were compared to the recording
+        self.mismatches = 0
+        self.error = None
+
+    def wait(self, elapsed):
+        speed = self.replay.speed
+        if not speed:
+            return
+        delay = self.replay.start + elapsed / speed - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def run(self):
+        try:
+            self._run()
+        except socket.timeout:
+            # The answers are out of step, give up
+            self.mismatches += 1
+            self.error = "Timeout waiting for an answer"
+        except EOFError:
+            self.error = "JCR server disconnected"
+        except (socket.error, IOError), e:
+            self.error = str(e)
+
+    def _run(self):
+        self.wait(self.start_time)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.replay.timeout)
+        sock.connect(self.replay.address)
+        reader = Reader(sock.makefile('rb'))
+        try:
+            sent_at = None
+            for elapsed, pieces, answers in self.exchanges:
+                for command, recorded in answers:
+                    self.check(command, recorded,
+                               readAnswer(reader, command))
+                if sent_at is not None and answers:
+                    self.latencies.append(time.time() - sent_at)
+                if pieces is None:
+                    break
+                self.wait(elapsed)
+                if self.replay.speed:
+                    self.lags.append(max(0.0, time.time() - self.replay.start
+                                         - elapsed / self.replay.speed))
+                data = []
+                for chunk, counted in pieces:
+                    if not counted:
+                        chunk = self.remap(chunk)
+                    data.append(chunk)
+                sock.sendall(''.join(data))
+                sent_at = time.time()
+        finally:
+            sock.close()
+
+    def remap(self, s):
+        """Replace the recorded uuids by the replayed ones.
+        """
+        uuids = self.uuids
+        if not uuids:
+            return s
+        if self.pattern_size != len(uuids):
+            keys = uuids.keys()
+            self.pattern = re.compile(r'\b(?:%s)\b' %
+                                      '|'.join(map(re.escape, keys)))
+            self.pattern_size = len(keys)
+        return self.pattern.sub(lambda m: uuids[m.group(0)], s)
+
+    def check(self, command, recorded, lines):
+        """Learn the uuids of an answer, and compare it to the recording.
+        """
+        tag = command[:1]
+        if lines[0].startswith('!') or recorded[0].startswith('!'):
+            if lines[0][:1] != recorded[0][:1]:
+                self.mismatches += 1
+            return
+        if tag == 'L':
+            self.learn(recorded[0][1:], lines[0][1:])
+        elif tag == 'M':
+            tokens = dict([line.split(' ', 1) for line in lines
+                           if ' ' in line])
+            for line in recorded:
+                if ' ' in line:
+                    token, uuid = line.split(' ', 1)
+                    if token in tokens:
+                        self.learn(uuid, tokens[token])
+            # The token map isn't ordered
+            lines = sorted(lines)
+            recorded = sorted(recorded)
+        if tag in UNCOMPARED:
+            return
+        mapped = []
+        counted = False
+        for line in recorded:
+            if not counted:
+                line = self.remap(line)
+            mapped.append(line)
+            counted = tag in ('S', 'e') and COUNTED.match(line) is not None
+        if mapped != lines:
+            self.mismatches += 1
+
+    def learn(self, recorded, replayed):
+        if recorded != replayed:
+            self.uuids[recorded] = replayed
+
+
+class Replay(object):
+    """Replays the sessions of a recording against a server.
+    """
+
+    def __init__(self, address, sessions, speed=1.0, copies=1, timeout=30.0):
+        self.address = address
+        self.sessions = sessions
+        self.speed = speed
+        self.copies = copies
+        self.timeout = timeout
+
+    def run(self):
+        """Replay all the sessions, returns their SessionReplay.
+        """
+        threads = []
+        uuids = None
+        if self.copies == 1:
+            uuids = {} # shared by the sessions
+        for session, frames in self.sessions:
+            start = frames[0][1]
+            for kind, elapsed, data in frames:
+                if kind == OPEN:
+                    start = elapsed
+                    break
+            for i in xrange(self.copies):
+                threads.append(SessionReplay(self, start, exchanges(frames),
+                                             uuids))
+        self.start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.time() - self.start
+        return threads
+
+    def report(self, threads, out=sys.stdout):
+        latencies = []
+        lags = []
+        mismatches = 0
+        errors = [thread.error for thread in threads
+                  if thread.error is not None]
+        for thread in threads:
+            latencies.extend(thread.latencies)
+            lags.extend(thread.lags)
+            mismatches += thread.mismatches
+        latencies.sort()
+        lags.sort()
+        print >>out, ('%d sessions, %d exchanges in %.2fs, %.1f exchanges/s'
+                      % (len(threads), len(latencies), self.elapsed,
+                         len(latencies) / self.elapsed))
+        print >>out, 'latency ms: p50 %.2f p95 %.2f p99 %.2f' % (
+            percentile(latencies, 0.50) * 1000,
+            percentile(latencies, 0.95) * 1000,
+            percentile(latencies, 0.99) * 1000)
+        if self.speed:
+            print >>out, 'lag ms: p50 %.2f p99 %.2f max %.2f' % (
+                percentile(lags, 0.50) * 1000,
+                percentile(lags, 0.99) * 1000,
+                percentile(lags, 1.0) * 1000)
+        print >>out, '%d mismatches, %d errors' % (mismatches, len(errors))
+        if errors:
+            print >>out, 'last error: %s' % errors[-1]
+
+
+def main(args):
+    opts, args = getopt.getopt(args, '', ['speed=', 'copies=', 'timeout='])
+    if len(args) != 2:
+        print __doc__
+        sys.exit(1)
+    params = {}
+    for opt, value in opts:
+        if opt == '--copies':
+            params['copies'] = int(value)
+        else:
+            params[opt[2:]] = float(value)
+    host, port = args[0].split(':')
+    replay = Replay((host, int(port)), readSessions(args[1]), **params)
+    replay.report(replay.run())
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,645 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Stand-in JCR server, in pure Python.
+
+Speaks the protocol of server.py (see doc/PROTOCOL.txt) over the storage
+of the fake server, so that the real controller and connection can be
+tested and benchmarked without a JVM. Each connection is served by its
+own thread and works on its own snapshot of the workspace.
+
+Property values are kept as they were sent, as (type letter, data), and
+returned as is. There are no versions: a checkpoint keeps a copy of the
+properties of the node, that restore puts back. There are no events
+either, getPendingEvents and changesSince always return nothing, the
+changes since a sequence number other than 0 being lost. The
+'P' command (get some properties) isn't provided, as it's not
+implemented by server.py and the controller never sends it: it's
+answered as an unknown command.
+
+The server can be started in-process::
+
+  server = StandinServer(('localhost', 0))
+  port = server.start()
+  ...
+  server.stop()
+
+or in a subprocess with ``spawn()``, or from the command line. With a
+data directory, each workspace is kept in a log file there and survives
+restarts.
+
+Usage: python standin.py [--data dir] <port> [cndpath...]
+"""
+
+import os
+import sys
+import socket
+import logging
+import threading
+import SocketServer
+
+from nuxeo.jcr.interfaces import ProtocolError
+from nuxeo.jcr.interfaces import ConflictError
+from nuxeo.jcr.tests.fakeserver import FakeJCRStorage
+from nuxeo.jcr.tests.fakeserver import runCommands
+from nuxeo.jcr.tests.fakelog import FakeJCRLogStorage
+
+logger = logging.getLogger('nuxeo.jcr.standin')
+
+BUFFER_SIZE = 65536
+
+
+class StandinHandler(SocketServer.StreamRequestHandler):
+    """Serves one connection.
+    """
+    rbufsize = BUFFER_SIZE
+    wbufsize = BUFFER_SIZE
+
+    workspaceName = None
+    storage = None # FakeJCRStorage of the workspace
+    snapshot = None # FakeJCRSnapshot of the transaction
+    prepared = False
+    tokens = None # token -> uuid for the current transaction
+
+    def handle(self):
+        self.server.addStat('sessions', 1)
+        try:
+            try:
+                self.write('Welcome.\n')
+                while not self.server.stopped:
+                    self.wfile.flush()
+                    line = self.readline()
+                    if line is None or line == 'q':
+                        break
+                    if line == 'Q':
+                        self.server.stop()
+                        break
+                    try:
+                        self.cmdCommand(line)
+                    except (ProtocolError, ValueError), e:
+                        self.writeln('!%s' % e)
+                self.wfile.flush()
+            except (socket.error, EOFError), e:
+                logger.debug("Connection lost: %s", e)
+        finally:
+            self.server.addStat('sessions', -1)
+            if self.snapshot is not None:
+                self.storage.release(self.snapshot)
+                self.snapshot = None
+
+    def finish(self):
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error, e:
+            # Output left when the client went away
+            logger.debug("Connection lost: %s", e)
+
+    def readline(self):
+        """Read a line, or None at the end of the input.
+        """
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if line.endswith('\n'):
+            line = line[:-1]
+        return line
+
+    def nextLine(self):
+        """Read the next line of a command.
+        """
+        line = self.readline()
+        if line is None:
+            raise EOFError("Connection closed in a command")
+        return line
+
+    def readData(self, length):
+        data = self.rfile.read(length + 1)
+        if len(data) != length + 1:
+            raise EOFError("Connection closed while reading data")
+        if data[-1] != '\n':
+            raise ProtocolError("Bad terminator %r" % data[-1])
+        return data[:-1]
+
+    def write(self, s):
+        self.wfile.write(s)
+
+    def writeln(self, s):
+        self.wfile.write(s+'\n')
+
+    def new(self):
+        if self.snapshot is not None:
+            self.storage.release(self.snapshot)
+        self.snapshot = self.storage.snapshot()
+        self.prepared = False
+        self.tokens = {}
+
+    def cmdHelp(self, line=None):
+        self.writeln("Available commands:")
+        keys = self._ops.keys()
+        keys.sort()
+        for cmd in keys:
+            func, desc = self._ops[cmd]
+            self.writeln("  %s: %s" % (cmd, desc))
+
+    def cmdLogin(self, workspaceName):
+        if self.snapshot is not None:
+            return self.writeln("!Already logged in.")
+        self.workspaceName = workspaceName
+        self.storage = self.server.getStorage(workspaceName)
+        self.new()
+        self.writeln('^'+self.storage.root_uuid)
+
+    def cmdPrepare(self, line=None):
+        # The changes are committed to the storage at prepare time, so
+        # a later rollback doesn't undo them.
+        if self.prepared:
+            return self.writeln("!Already prepared.")
+        try:
+            self.storage.commit(self.snapshot)
+        except ConflictError, e:
+            self.server.addStat('conflicts', 1)
+            self.new()
+            return self.writeln('!%s' % e)
+        self.server.addStat('commits', 1)
+        self.prepared = True
+        self.writeln('.')
+
+    def cmdCommit(self, line=None):
+        if not self.prepared:
+            return self.writeln("!Not prepared.")
+        self.new()
+        self.writeln('.')
+
+    def commit(self):
+        # One-phase commit
+        msg = '.'
+        try:
+            self.storage.commit(self.snapshot)
+        except ConflictError, e:
+            self.server.addStat('conflicts', 1)
+            msg = '!%s' % e
+        else:
+            self.server.addStat('commits', 1)
+        self.new()
+        self.writeln(msg)
+
+    def cmdRollback(self, line=None):
+        self.new()
+        self.writeln('.')
+
+    def cmdEvents(self, line=None):
+        self.writeln('.')
+
+    def cmdJournal(self, line):
+        seq = int(line.split(' ')[0])
+        self.writeln('J0')
+        if seq:
+            self.writeln('o')
+        self.writeln('.')
+
+    def cmdInfo(self, line=None):
+        for name, value in self.server.getStats():
+            self.writeln('%s %s' % (name, value))
+        self.writeln('.')
+
+    def cmdGetNodeTypeDefs(self, line):
+        self.write(self.server.nodetypedefs)
+        self.writeln('\n.')
+
+    def cmdGetNodeType(self, uuid):
+        node = self.snapshot.data.get(uuid)
+        if node is None:
+            return self.writeln("!No uuid '%s'" % uuid)
+        self.writeln('T%s' % node.type)
+
+    def cmdGetNodeStates(self, line):
+        data = self.snapshot.data
+        nodes = []
+        for uuid in line.split(' '):
+            node = data.get(uuid)
+            if node is None:
+                return self.writeln("!No such uuid '%s'" % uuid)
+            nodes.append((uuid, node))
+        for uuid, node in nodes:
+            self.writeNodeState(uuid, node)
+        self.writeln('.')
+
+    def cmdExport(self, uuid):
+        data = self.snapshot.data
+        node = data.get(uuid)
+        if node is None:
+            return self.writeln("!No uuid '%s'" % uuid)
+        self.writeNodeState(uuid, node)
+        stack = [iter(node.children)]
+        while stack:
+            try:
+                name, uuid = stack[-1].next()
+            except StopIteration:
+                stack.pop()
+                continue
+            node = data[uuid]
+            self.writeNodeState(uuid, node)
+            stack.append(iter(node.children))
+        self.writeln('.')
+
+    def writeNodeState(self, uuid, node):
+        data = self.snapshot.data
+        self.writeln('U%s %s' % (uuid, node.name.encode('utf-8')))
+        if node.parent_uuid is not None:
+            self.writeln('^%s' % node.parent_uuid)
+        for name, cuuid in node.children:
+            self.writeln('N%s %s %s' % (cuuid, data[cuuid].type,
+                                        name.encode('utf-8')))
+        for name, value in node.properties.iteritems():
+            name = name.encode('utf-8')
+            if isinstance(value, list):
+                self.writeln('M%s' % name)
+                for v in value:
+                    self.writeValue(v)
+                self.writeln('M')
+            else:
+                self.writeln('P%s' % name)
+                self.writeValue(value)
+
+    def writeValue(self, value):
+        if isinstance(value, tuple):
+            tag, data = value
+        else:
+            # jcr:primaryType, set by the storage
+            tag, data = 'n', value
+        if tag in 'sx':
+            self.write('%s%d\n%s\n' % (tag, len(data), data))
+        else:
+            self.writeln(tag + data)
+
+    def cmdMultiple(self, line=None):
+        # Changes are always visible to the session, saving every n
+        # commands is meaningless here.
+        commands = []
+        while True:
+            line = self.nextLine()
+            if line in ('.', 'p', 'c'):
+                break
+            commands.append(self.readCommand(line))
+        try:
+            map = runCommands(self.snapshot, self.tokens, commands)
+        except (ProtocolError, ValueError, KeyError), e:
+            return self.writeln('!%s' % e)
+        for token, uuid in map.items():
+            self.writeln('%s %s' % (token, uuid))
+        self.writeln('.')
+        if line == 'p':
+            self.cmdPrepare()
+        elif line == 'c':
+            if self.prepared:
+                return self.writeln("!Already prepared.")
+            self.commit()
+
+    def readCommand(self, line):
+        """Read a command of a batch, in the form used by runCommands.
+        """
+        op, rest = line[0], line[1:]
+        if op == '+': # add
+            puuid, node_type, token, name = rest.split(' ', 3)
+            return ('add', puuid, unicode(name, 'utf-8'), node_type,
+                    self.readProps(), token)
+        elif op == '/': # modify
+            return ('modify', rest, self.readProps())
+        elif op == '-': # remove
+            return ('remove', rest)
+        elif op == '%': # reorder
+            inserts = []
+            while True:
+                line = self.nextLine()
+                if line == '%':
+                    break
+                name, before = unicode(line, 'utf-8').split('/')
+                if not before:
+                    before = None # move to the end
+                inserts.append((name, before))
+            return ('reorder', rest, inserts)
+        elif op == '#': # setorder
+            names = []
+            while True:
+                line = self.nextLine()
+                if line == '/':
+                    break
+                names.append(unicode(line, 'utf-8'))
+            return ('setorder', rest, names)
+        else:
+            raise ProtocolError("Unknown multiple op '%s'" % op)
+
+    def readProps(self):
+        props = {}
+        while True:
+            line = self.nextLine()
+            if line == ',':
+                return props
+            op, name = line[0], unicode(line[1:], 'utf-8')
+            if op == 'P':
+                props[name] = self.readValue(self.nextLine())
+            elif op == 'M':
+                values = []
+                while True:
+                    line = self.nextLine()
+                    if line == 'M':
+                        break
+                    values.append(self.readValue(line))
+                props[name] = values
+            elif op == 'D':
+                props[name] = None
+            else:
+                raise ProtocolError("Unknown props op '%s'" % op)
+
+    def readValue(self, line):
+        tag, rest = line[0], line[1:]
+        if tag in 'sx':
+            return (tag, self.readData(int(rest)))
+        if tag not in 'blfdr':
+            raise ProtocolError("Unknown op '%s'" % tag)
+        return (tag, rest)
+
+    def cmdCheckpoint(self, uuid):
+        node = self.snapshot.data.get(uuid)
+        if node is None:
+            return self.writeln("!No such uuid '%s'" % uuid)
+        self.server.addVersion(self.workspaceName, uuid, node.properties)
+        self.writeln('.')
+
+    def cmdRestore(self, line):
+        uuid, versionName = line.split(' ', 1)
+        try:
+            node = self.snapshot.getWritable(uuid)
+        except KeyError:
+            return self.writeln("!No such uuid '%s'" % uuid)
+        properties = self.server.getVersion(self.workspaceName, uuid,
+                                            versionName)
+        if properties is None:
+            return self.writeln("!Cannot restore: no version '%s' of '%s'"
+                                % (versionName, uuid))
+        node.properties = dict(properties)
+        data = self.snapshot.data
+        uuids = []
+        stack = [cuuid for name, cuuid in node.children]
+        while stack:
+            uuid = stack.pop()
+            uuids.append(uuid)
+            stack.extend([cuuid for name, cuuid in data[uuid].children])
+        self.writeln('.'+','.join(uuids))
+
+    def cmdPath(self, uuid):
+        if uuid not in self.snapshot.data:
+            return self.writeln("!No such uuid '%s'" % uuid)
+        path = self.snapshot.getPath(uuid) or '/'
+        self.writeln(path.encode('utf-8'))
+
+    def cmdSearch(self, line):
+        prop_name, value = line.split(' ', 1)
+        prop_name = unicode(prop_name, 'utf-8')
+        value = unicode(value, 'utf-8')
+        snapshot = self.snapshot
+        res = [(snapshot.getPath(uuid) or '/', uuid)
+               for uuid in snapshot.searchProperty(prop_name, value)]
+        res.sort()
+        for path, uuid in res:
+            self.writeln('u%s %s' % (uuid, path.encode('utf-8')))
+        self.writeln('.')
+
+    def cmdMove(self, line):
+        # uuid, dest container uuid, name in dest
+        uuid, cuuid, name = line.split(' ', 2)
+        try:
+            self.snapshot.move(uuid, cuuid, unicode(name, 'utf-8'))
+        except ProtocolError, e:
+            return self.writeln("!Move exception: %s" % e)
+        self.writeln('.')
+
+    def cmdCopy(self, line):
+        # uuid, dest container uuid, name in dest
+        uuid, cuuid, name = line.split(' ', 2)
+        try:
+            self.snapshot.copy(uuid, cuuid, unicode(name, 'utf-8'))
+        except ProtocolError, e:
+            return self.writeln("!Copy exception: %s" % e)
+        self.writeln('.')
+
+    _ops = {
+        '?': (cmdHelp, "This help."),
+        'I': (cmdInfo, "Get server statistics."),
+        'E': (cmdEvents, "Get the events since the last call."),
+        'J': (cmdJournal, "Get the changes since a sequence number."),
+        'L': (cmdLogin, "Login to the given workspace."),
+        'p': (cmdPrepare, "Prepare the transaction."),
+        'c': (cmdCommit, "Commit the prepared transaction."),
+        'r': (cmdRollback, "Rollback the transaction."),
+        'i': (cmdCheckpoint, "Checkpoint."),
+        't': (cmdRestore, "Restore."),
+        'T': (cmdGetNodeType, "Get the primary type of a given uuid."),
+        'S': (cmdGetNodeStates, "Get the state of the given uuids."),
+        'e': (cmdExport, "Export the states of a subtree."),
+        'D': (cmdGetNodeTypeDefs, "Get the CND node type definitions."),
+        'M': (cmdMultiple, "Send multiple commands (+/=/-/%/#)."),
+        '/': (cmdPath, "Get the path of a UUID."),
+        's': (cmdSearch, "Search a property = value."),
+        'm': (cmdMove, "Move a document."),
+        'C': (cmdCopy, "Copy a document."),
+        }
+
+    # Commands that don't need a login
+    _anonymous = ('?', 'I', 'L', 'D')
+
+    def cmdCommand(self, line):
+        if not line:
+            return
+        cmd, rest = line[0], line[1:]
+        info = self._ops.get(cmd)
+        if info is None:
+            return self.writeln("!Unknown command '%s'" % cmd)
+        if self.snapshot is None and cmd not in self._anonymous:
+            return self.writeln("!Not logged in.")
+        func = info[0]
+        func(self, rest)
+
+
+class StandinServer(SocketServer.ThreadingTCPServer):
+    """Stand-in JCR server, one thread per connection.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, nodetypedefs='', directory=None):
+        SocketServer.ThreadingTCPServer.__init__(self, address,
+                                                 StandinHandler)
+        self.nodetypedefs = nodetypedefs
+        self.directory = directory # for the workspace logs
+        self.storages = {} # workspace name -> FakeJCRStorage
+        self.versions = {} # (workspace name, uuid) -> list of properties
+        self.stats = {'sessions': 0, 'commits': 0, 'conflicts': 0}
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.thread = None
+
+    def getStorage(self, workspaceName):
+        self.lock.acquire()
+        try:
+            storage = self.storages.get(workspaceName)
+            if storage is None:
+                if self.directory is None:
+                    storage = FakeJCRStorage()
+                else:
+                    path = os.path.join(self.directory,
+                                        '%s.log' % workspaceName)
+                    storage = FakeJCRLogStorage(path)
+                self.storages[workspaceName] = storage
+        finally:
+            self.lock.release()
+        return storage
+
+    def addVersion(self, workspaceName, uuid, properties):
+        self.lock.acquire()
+        try:
+            versions = self.versions.setdefault((workspaceName, uuid), [])
+            versions.append(dict(properties))
+        finally:
+            self.lock.release()
+
+    def getVersion(self, workspaceName, uuid, versionName=''):
+        """Get the properties of a version, by default the last one.
+
+        Versions are named 1.0, 1.1, and so on.
+        """
+        self.lock.acquire()
+        try:
+            versions = self.versions.get((workspaceName, uuid), ())
+            if not versionName:
+                if not versions:
+                    return None
+                return versions[-1]
+            for i in range(len(versions)):
+                if versionName == '1.%d' % i:
+                    return versions[i]
+            return None
+        finally:
+            self.lock.release()
+
+    def addStat(self, name, delta):
+        self.lock.acquire()
+        try:
+            self.stats[name] = self.stats.get(name, 0) + delta
+        finally:
+            self.lock.release()
+
+    def getStats(self):
+        self.lock.acquire()
+        try:
+            stats = self.stats.items()
+        finally:
+            self.lock.release()
+        stats.sort()
+        return stats
+
+    def server_close(self):
+        SocketServer.ThreadingTCPServer.server_close(self)
+        self.lock.acquire()
+        try:
+            for storage in self.storages.itervalues():
+                storage.close()
+            self.storages.clear()
+        finally:
+            self.lock.release()
+
+    def serve(self):
+        """Serve connections until stopped.
+        """
+        while not self.stopped:
+            self.handle_request()
+
+    def start(self):
+        """Serve connections in a background thread, returns the port.
+        """
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self.server_address[1]
+
+    def stop(self):
+        """Stop serving, the open connections end after their command.
+        """
+        if self.stopped:
+            return
+        self.stopped = True
+        # Wake up the accept
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.server_address)
+        except socket.error:
+            pass
+        sock.close()
+        if (self.thread is not None and
+            self.thread is not threading.currentThread()):
+            self.thread.join()
+        self.server_close()
+
+
+def spawn(port=0, cndpaths=(), directory=None, python=sys.executable):
+    """Start a stand-in server in a subprocess.
+
+    Returns the process and the port. The server stops when sent a 'Q'
+    command, or when killed.
+    """
+    import subprocess
+    path = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    args = [python, path]
+    if directory is not None:
+        args.extend(['--data', directory])
+    args.append(str(port))
+    args.extend(cndpaths)
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, env=env)
+    line = process.stdout.readline()
+    if not line.startswith('Listening on port '):
+        raise IOError("Stand-in server failed to start: %r" % line)
+    return process, int(line.split()[-1])
+
+
+def main(args):
+    directory = None
+    if args[:1] == ['--data']:
+        directory = args[1]
+        del args[:2]
+    if not args:
+        print >>sys.stderr, ("Usage: standin.py [--data dir] <port> "
+                             "[cndpath...]")
+        sys.exit(1)
+    port = int(args[0])
+    defs = []
+    for path in args[1:]:
+        f = open(path)
+        try:
+            defs.append(f.read())
+        finally:
+            f.close()
+    server = StandinServer(('localhost', port), '\n'.join(defs), directory)
+    print 'Listening on port %d' % server.server_address[1]
+    sys.stdout.flush()
+    try:
+        server.serve()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,137 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Archive tests.
+"""
+
+import unittest
+from tempfile import TemporaryFile
+from datetime import datetime
+
+from nuxeo.capsule.base import Blob
+from nuxeo.capsule.base import Reference
+
+from nuxeo.jcr.archive import ArchiveWriter
+from nuxeo.jcr.archive import ArchiveReader
+from nuxeo.jcr.controller import JCRController
+from nuxeo.jcr.interfaces import ProtocolError
+from nuxeo.jcr.tests.test_controller import FakeSocket
+from nuxeo.jcr.tests.test_controller import FakeDB
+
+
+class FullFile(object):
+    """File where only the archive header fits.
+    """
+    def write(self, data):
+        if data != 'JCRARCHIVE 1\n':
+            raise IOError("No space left on device")
+
+
+class ArchiveTests(unittest.TestCase):
+
+    def test_roundtrip(self):
+        f = TemporaryFile()
+        writer = ArchiveWriter(f)
+        writer.addNode('uuid1', u'caf\xe9', None, [
+            (u'jcr:primaryType', 'ecmnt:folder'),
+            (u'title', u'Some\ntitle'),
+            (u'file', Blob('abc\n\x00def')),
+            ])
+        writer.addNode('uuid2', u'doc', 'uuid1', [
+            (u'count', 12),
+            (u'ratio', 0.5),
+            (u'flag', True),
+            (u'date', datetime(2006, 04, 07, 18, 0, 42, 754000)),
+            (u'ref', Reference('uuid1')),
+            (u'same', Blob('abc\n\x00def')),
+            (u'multi', [u'a', u'b']),
+            (u'empty', []),
+            ])
+        writer.close()
+        self.assertEquals(writer.count, 2)
+
+        f.seek(0)
+        nodes = list(ArchiveReader(f))
+        self.assertEquals([n[:3] for n in nodes], [
+            ('uuid1', u'caf\xe9', None),
+            ('uuid2', u'doc', 'uuid1'),
+            ])
+        props = dict(nodes[0][3])
+        self.assertEquals(props[u'jcr:primaryType'], 'ecmnt:folder')
+        self.assertEquals(props[u'title'], u'Some\ntitle')
+        self.assertEquals(props[u'file'].data, 'abc\n\x00def')
+        props = dict(nodes[1][3])
+        self.assertEquals(props[u'count'], 12)
+        self.assertEquals(props[u'ratio'], 0.5)
+        self.assertEquals(props[u'flag'], True)
+        self.assertEquals(props[u'date'],
+                          datetime(2006, 04, 07, 18, 0, 42, 754000))
+        self.assertEquals(props[u'ref'].getTargetUUID(), 'uuid1')
+        self.assertEquals(props[u'same'].data, 'abc\n\x00def')
+        self.assertEquals(props[u'multi'], [u'a', u'b'])
+        self.assertEquals(props[u'empty'], [])
+
+    def test_blobs_stored_once(self):
+        f = TemporaryFile()
+        writer = ArchiveWriter(f)
+        for i in range(10):
+            writer.addNode('uuid%d' % i, u'n', None,
+                           [(u'file', Blob('x' * 1000))])
+        writer.close()
+        f.seek(0, 2)
+        self.assert_(f.tell() < 2000, f.tell())
+
+    def test_addNodes_error(self):
+        # The rest of the export is read even if writing fails
+        c = JCRController(FakeDB())
+        c._sock = FakeSocket('Uuuid1 foo\n'
+                             'Ptitle\ns3\nbar\n'
+                             'Uuuid2 baz\n'
+                             '^uuid1\n'
+                             '.\n'
+                             '/foo\n')
+        writer = ArchiveWriter(FullFile())
+        self.assertRaises(IOError, writer.addNodes, c.exportNodes('uuid1'))
+        self.assertEquals(c._sock.sent, 'euuid1\n')
+        self.assertEquals(c.getPath('uuid1'), u'/foo')
+
+    def test_addNodes_deferred(self):
+        c = JCRController(FakeDB())
+        c._sock = FakeSocket('Uuuid1 foo\n'
+                             'Dtitle\n'
+                             'Uuuid2 baz\n'
+                             '^uuid1\n'
+                             '.\n'
+                             '/foo\n')
+        writer = ArchiveWriter(TemporaryFile())
+        self.assertRaises(ProtocolError, writer.addNodes,
+                          c.exportNodes('uuid1'))
+        self.assertEquals(writer.count, 0)
+        self.assertEquals(c.getPath('uuid1'), u'/foo')
+
+    def test_not_an_archive(self):
+        f = TemporaryFile()
+        f.write('foo\nbar\n' * 10)
+        f.seek(0)
+        self.assertRaises(ValueError, ArchiveReader, f)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(ArchiveTests),
+        ))
+
+if __name__ == '__main__':
+    unittest.TextTestRunner().run(test_suite())
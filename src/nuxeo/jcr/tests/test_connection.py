@@ -16,7 +16,21 @@
 """Connection tests.
 """
 import unittest
+from random import Random
+from transaction import TransactionManager
 from nuxeo.jcr.connection import findInserts
+from nuxeo.jcr.connection import isOnlyResource
+from nuxeo.jcr.connection import Connection
+
+def applyInserts(old, inserts):
+    res = list(old)
+    for name, before in inserts:
+        res.remove(name)
+        if before is None:
+            res.append(name)
+        else:
+            res.insert(res.index(before), name)
+    return res
 
 class FindInsertTests(unittest.TestCase):
 
@@ -29,23 +43,91 @@ class FindInsertTests(unittest.TestCase):
         old = list('abcd')
         new = list('cdab')
         self.assertEquals(findInserts(old, new),
-                          [('c', 'a'), ('d', 'a')])
+                          [('d', 'a'), ('c', 'd')])
 
     def test_findInserts_2(self):
         old = list('abcd')
         new = list('dcba')
         self.assertEquals(findInserts(old, new),
-                          [('d', 'a'), ('c', 'a'), ('b', 'a')])
+                          [('b', 'a'), ('c', 'b'), ('d', 'c')])
 
     def test_findInserts_3(self):
         old = list('abcd')
         new = list('adcb')
         self.assertEquals(findInserts(old, new),
-                          [('d', 'b'), ('c', 'b')])
+                          [('c', 'b'), ('d', 'c')])
+
+    def test_findInserts_to_end(self):
+        old = list('abcd')
+        new = list('bcda')
+        self.assertEquals(findInserts(old, new), [('a', None)])
+
+    def test_findInserts_mismatch(self):
+        self.assertRaises(ValueError, findInserts, list('abc'), list('abd'))
+        self.assertRaises(ValueError, findInserts, list('abc'), list('abcc'))
+
+    def test_findInserts_random(self):
+        rnd = Random(1234)
+        for n in range(30):
+            old = range(n)
+            new = old[:]
+            rnd.shuffle(new)
+            inserts = findInserts(old, new)
+            self.assertEquals(applyInserts(old, inserts), new)
+
+    def test_findInserts_minimal(self):
+        # Only the displaced item moves
+        old = range(1000)
+        new = old[:]
+        new.insert(10, new.pop(900))
+        self.assertEquals(findInserts(old, new), [(900, 10)])
+
+class DummyResource(object):
+    def sortKey(self):
+        return 'dummy'
+
+class SavepointConnection(Connection):
+    # Only records how the commit finishes the savepoint
+    def __init__(self):
+        self.finishes = []
+        self._one_phase = False
+    def sortKey(self):
+        return 'conn'
+    def _savepoint(self, finish=None, wait=True):
+        self.finishes.append(finish)
+
+class OnePhaseTests(unittest.TestCase):
+
+    def test_isOnlyResource(self):
+        txn = TransactionManager().get()
+        txn.join(DummyResource())
+        self.assert_(isOnlyResource(txn))
+        txn.join(DummyResource())
+        self.failIf(isOnlyResource(txn))
+        # Unknown transaction implementation
+        self.failIf(isOnlyResource(object()))
+
+    def test_one_phase(self):
+        conn = SavepointConnection()
+        txn = TransactionManager().get()
+        txn.join(conn)
+        conn.commit(txn)
+        self.assertEquals(conn.finishes, ['commit'])
+        self.assert_(conn._one_phase)
+
+    def test_two_phase(self):
+        conn = SavepointConnection()
+        txn = TransactionManager().get()
+        txn.join(conn)
+        txn.join(DummyResource())
+        conn.commit(txn)
+        self.assertEquals(conn.finishes, ['prepare'])
+        self.failIf(conn._one_phase)
 
 def test_suite():
     return unittest.TestSuite((
         unittest.makeSuite(FindInsertTests),
+        unittest.makeSuite(OnePhaseTests),
         ))
 
 if __name__ == '__main__':
@@ -24,6 +24,11 @@ from nuxeo.capsule.base import Blob
 from nuxeo.capsule.base import Reference
 
 from nuxeo.jcr.controller import JCRController
+from nuxeo.jcr.controller import MAX_UNREAD_BATCHES
+from nuxeo.jcr.controller import MAX_UNREAD_BYTES
+from nuxeo.jcr.interfaces import ProtocolError
+from nuxeo.jcr.interfaces import ConflictError
+from nuxeo.jcr.interfaces import EventsLostError
 
 
 class fakedict(object):
@@ -105,6 +110,17 @@ class ProtocolTest(unittest.TestCase):
 
     # API tests
 
+    def test_transfer_counts(self):
+        c = self.makeOne('^cafe-babe\n.\n')
+        c._writeline('Lfoo')
+        c._readline()
+        c._writeline('r')
+        c._write('x')
+        c._readline()
+        self.assertEquals(c.bytes_sent, 8)
+        self.assertEquals(c.bytes_received, 13)
+        self.assertEquals(c.round_trips, 1)
+
     def test_login(self):
         c = self.makeOne('^some-uuid\n')
         uuid = c.login('foo')
@@ -240,6 +256,30 @@ class ProtocolTest(unittest.TestCase):
         self.assertEqual(deferred, [])
 
 
+    def test_exportNodes(self):
+        c = self.makeOne('\n'.join((
+            'Uuuid1 foo',
+            '^parent-uuid',
+            'Nuuid2 type2 bar',
+            'Ptitle', 's3', 'Foo',
+            'Uuuid2 bar',
+            '^uuid1',
+            'Pabin', 'x3', 'abc',
+            '.\n')))
+        nodes = c.exportNodes('uuid1')
+        self.assertEqual(c._sock.sent, 'euuid1\n')
+        uuid, state = nodes.next()
+        self.assertEqual(uuid, 'uuid1')
+        self.assertEqual(state, (u'foo', 'parent-uuid',
+                                 [(u'bar', 'uuid2', 'type2')],
+                                 [(u'title', u'Foo')], []))
+        uuid, state = nodes.next()
+        self.assertEqual(uuid, 'uuid2')
+        self.assertEqual(state[1], 'uuid1')
+        self.assertEqual(state[3][0][1].data, 'abc')
+        self.assertRaises(StopIteration, nodes.next)
+        self.assertEqual(c._unprocessed, [])
+
     def test_sendCommands(self):
         commands = [
             ('add', 'puuid1', u'fo\xe9', 'folder', fakedict(
@@ -307,6 +347,148 @@ class ProtocolTest(unittest.TestCase):
             ('t1', 'uuid1'),
             ])
 
+    def test_sendCommands_order(self):
+        commands = [
+            ('reorder', 'uuid1', (
+                (u'a', u'b'),
+                (u'b', None),
+                )),
+            ('setorder', 'uuid2', [u'c', u'b\xe9', u'a']),
+            ]
+        expect_sent = '\n'.join((
+            'M',
+            '%uuid1',
+            'a/b',
+            'b/',
+            '%',
+            '#uuid2',
+            'c',
+            'b\xc3\xa9',
+            'a',
+            '/',
+            '.\n'))
+        c = self.makeOne('.\n')
+        map = c.sendCommands(commands)
+        self.assertEqual(c._sock.sent, expect_sent)
+        self.assertEqual(c._unprocessed, [])
+        self.assertEqual(map, {})
+
+    def test_startCommands(self):
+        c = self.makeOne('t1 uuid1\n.\nt2 uuid2\n.\n')
+        self.failIf(c.startCommands([]))
+        self.assert_(c.startCommands([('remove', 'uuid0')], save_every=100))
+        self.assert_(c.startCommands([('remove', 'uuid3')]))
+        self.assertEqual(c._sock.sent, 'M100\n-uuid0\n.\nM\n-uuid3\n.\n')
+        self.assertEqual(c.finishCommands(), {'t1': 'uuid1'})
+        self.assertEqual(c.finishCommands(), {'t2': 'uuid2'})
+        self.assertRaises(ProtocolError, c.finishCommands)
+
+    def test_startCommands_readAhead(self):
+        # Write-behind batches are read once too many are unread
+        answers = ['t%d uuid%d\n.\n' % (i, i) for i in range(40)]
+        answers[3] = '!No uuid\n'
+        c = self.makeOne(''.join(answers))
+        for i in range(40):
+            c.startCommands([('remove', 'uuid%d' % i)])
+            self.assert_(len(c._pending_batches) <= MAX_UNREAD_BATCHES)
+        self.assertEqual(len(c._finished), 40 - MAX_UNREAD_BATCHES)
+        for i in range(40):
+            if i == 3:
+                self.assertRaises(ProtocolError, c.finishCommands)
+            else:
+                self.assertEqual(c.finishCommands(),
+                                 {'t%d' % i: 'uuid%d' % i})
+        self.assertRaises(ProtocolError, c.finishCommands)
+        self.assertEqual(c._unprocessed, [])
+
+    def test_startCommands_readAhead_bytes(self):
+        big = u'x' * (MAX_UNREAD_BYTES / 2)
+        c = self.makeOne('.\n' * 3)
+        for i in range(3):
+            c.startCommands([('modify', 'uuid', {'title': big})])
+        # The oldest batches are read, the last one isn't
+        self.assertEqual(len(c._finished), 2)
+        self.assertEqual(len(c._pending_batches), 1)
+
+    def test_nothing_sent(self):
+        c = self.makeOne()
+        self.assertEqual(c.sendCommands([], finish='prepare'), {})
+        c.prepare()
+        c.commit()
+        c.abort()
+        self.assertEqual(c._sock.sent, '')
+
+    def test_sendCommands_prepare(self):
+        c = self.makeOne('.\n.\n.\n')
+        c.sendCommands([('remove', 'uuid1')], finish='prepare')
+        c.commit()
+        self.assertEqual(c._sock.sent, 'M\n-uuid1\np\nc\n')
+        self.assertEqual(c._unprocessed, [])
+
+    def test_sendCommands_commit(self):
+        c = self.makeOne('t1 uuid1\n.\n.\n')
+        map = c.sendCommands([('remove', 'uuid0')], finish='commit')
+        self.assertEqual(map, {'t1': 'uuid1'})
+        # New transaction, nothing more to do
+        c.abort()
+        self.assertEqual(c._sock.sent, 'M\n-uuid0\nc\n')
+
+    def test_sendCommands_commit_previous(self):
+        c = self.makeOne('.\n.\n.\n')
+        c.sendCommands([('remove', 'uuid0')])
+        c.sendCommands([], finish='commit')
+        self.assertEqual(c._sock.sent, 'M\n-uuid0\n.\nM\nc\n')
+
+    def test_sendCommands_conflict(self):
+        c = self.makeOne('.\n!Conflict\n')
+        self.assertRaises(ConflictError, c.sendCommands,
+                          [('remove', 'uuid0')], finish='commit')
+        # The server already rolled back
+        c.abort()
+        self.assertEqual(c._sock.sent, 'M\n-uuid0\nc\n')
+
+    def test_getPendingEvents(self):
+        c = self.makeOne('v7 NODE_ADDED uuid1 /a b\n'
+                         'v8 PROPERTY_CHANGED - /a b/title\n.\n')
+        self.assertEqual(c.getPendingEvents(), [
+            (7, 'NODE_ADDED', 'uuid1', u'/a b'),
+            (8, 'PROPERTY_CHANGED', None, u'/a b/title'),
+            ])
+        self.assertEqual(c._sock.sent, 'E\n')
+        self.assertEqual(c._unprocessed, [])
+
+    def test_getPendingEvents_lost(self):
+        c = self.makeOne('o\nv9 NODE_REMOVED uuid1 /a\n.\n')
+        try:
+            c.getPendingEvents()
+        except EventsLostError, e:
+            self.assertEqual(e.events, [(9, 'NODE_REMOVED', 'uuid1', u'/a')])
+        else:
+            self.fail("Expected EventsLostError")
+
+    def test_changesSince(self):
+        c = self.makeOne('J12\nv11 NODE_REMOVED uuid1 /a\n.\n')
+        self.assertEqual(c.changesSince(10, 1),
+                         (12, [(11, 'NODE_REMOVED', 'uuid1', u'/a')]))
+        self.assertEqual(c._sock.sent, 'J10 1\n')
+        self.assertEqual(c._unprocessed, [])
+
+    def test_changesSince_truncated(self):
+        c = self.makeOne('J500\no\nv400 NODE_ADDED uuid1 /a\n.\n')
+        try:
+            c.changesSince(10)
+        except EventsLostError, e:
+            self.assertEqual(e.seq, 500)
+            self.assertEqual(e.events, [(400, 'NODE_ADDED', 'uuid1', u'/a')])
+        else:
+            self.fail("Expected EventsLostError")
+
+    def test_getStats(self):
+        c = self.makeOne('buffered 12\nsessions 2\n.\n')
+        self.assertEqual(c.getStats(), {'buffered': 12, 'sessions': 2})
+        self.assertEqual(c._sock.sent, 'I\n')
+        self.assertEqual(c._unprocessed, [])
+
 
 def test_suite():
     return unittest.TestSuite((
@@ -16,12 +16,20 @@
 """Tests for fake server.
 """
 
+import os
+import shutil
+import tempfile
 import unittest
 from zope.interface.verify import verifyClass
 
 from copy import deepcopy
 from nuxeo.jcr.tests.fakeserver import FakeJCR
 from nuxeo.jcr.tests.fakeserver import Merger
+from nuxeo.jcr.tests.fakeserver import FakeJCRStorage
+from nuxeo.jcr.tests.fakeserver import FakeJCRController
+from nuxeo.jcr.tests.fakeserver import STORAGES
+from nuxeo.jcr.tests import fakelog
+from nuxeo.jcr.tests.fakelog import FakeJCRLogStorage
 from nuxeo.jcr.interfaces import ConflictError
 
 
@@ -144,6 +152,12 @@ class MergerTests(unittest.TestCase):
                                   new_remove=['0'])
         self.assertRaises(ConflictError, merge)
 
+    def test_children_remove_add_grandchild(self):
+        # The child added in new would be orphaned
+        merge = self.makeChildren([('x', '0')], [], [], cur_remove=['0'])
+        self.new.addChild('0', '1', 'a', 'type', [], {})
+        self.assertRaises(ConflictError, merge)
+
     def test_children_reorder_cur(self):
         merge = self.makeChildren([('x', '0'), ('a', '1')], [], [])
         self.cur.data[self.cur.root_uuid].children[:] = [
@@ -159,11 +173,396 @@ class MergerTests(unittest.TestCase):
         self.assertEquals(self.children, [('a', '1'), ('x', '0')])
 
 
+class StorageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = FakeJCRStorage()
+        self.root_uuid = self.storage.root_uuid
+
+    def addChild(self, snapshot, name):
+        uuid = snapshot.newUUID()
+        snapshot.addChild(self.root_uuid, uuid, name, 'nt:unstructured',
+                          [], {})
+        return uuid
+
+    def test_snapshot_isolation(self):
+        s1 = self.storage.snapshot()
+        s2 = self.storage.snapshot()
+        uuid = self.addChild(s1, 'a')
+        s1.modifyProperties(self.root_uuid, {'title': 'foo'})
+        self.assert_(uuid not in s2.data)
+        root = s2.data[self.root_uuid]
+        self.assertEquals(root.children, [])
+        self.assert_('title' not in root.properties)
+        self.storage.commit(s1)
+        # Still not seen by s2, seen by new snapshots
+        self.assert_(uuid not in s2.data)
+        s3 = self.storage.snapshot()
+        self.assertEquals(s3.data[self.root_uuid].children, [('a', uuid)])
+        self.assertEquals(s3.data[self.root_uuid].properties['title'],
+                          'foo')
+
+    def test_commit_merge(self):
+        s1 = self.storage.snapshot()
+        s2 = self.storage.snapshot()
+        uuid1 = self.addChild(s1, 'a')
+        uuid2 = self.addChild(s2, 'b')
+        self.storage.commit(s1)
+        self.storage.commit(s2)
+        s3 = self.storage.snapshot()
+        self.assertEquals(s3.data[self.root_uuid].children,
+                          [('a', uuid1), ('b', uuid2)])
+
+    def test_commit_conflict(self):
+        s1 = self.storage.snapshot()
+        s2 = self.storage.snapshot()
+        s1.modifyProperties(self.root_uuid, {'title': 'foo'})
+        s2.modifyProperties(self.root_uuid, {'title': 'bar'})
+        self.storage.commit(s1)
+        self.assertRaises(ConflictError, self.storage.commit, s2)
+
+    def test_commit_merge_remove(self):
+        s = self.storage.snapshot()
+        uuid = self.addChild(s, 'a')
+        self.storage.commit(s)
+        s1 = self.storage.snapshot()
+        s2 = self.storage.snapshot()
+        s1.modifyProperties(self.root_uuid, {'title': 'foo'})
+        s2.removeNode(uuid)
+        self.storage.commit(s1)
+        self.storage.commit(s2)
+        s3 = self.storage.snapshot()
+        root = s3.data[self.root_uuid]
+        self.assertEquals(root.children, [])
+        self.assertEquals(root.properties['title'], 'foo')
+        self.assert_(uuid not in s3.data)
+
+    def test_commit_conflict_removed(self):
+        s = self.storage.snapshot()
+        uuid = self.addChild(s, 'a')
+        self.storage.commit(s)
+        s1 = self.storage.snapshot()
+        s2 = self.storage.snapshot()
+        s1.removeNode(uuid)
+        s2.modifyProperties(uuid, {'title': 'foo'})
+        self.storage.commit(s1)
+        self.assertRaises(ConflictError, self.storage.commit, s2)
+
+    def test_commit_conflict_remove_added(self):
+        s = self.storage.snapshot()
+        uuid = self.addChild(s, 'a')
+        self.storage.commit(s)
+        s1 = self.storage.snapshot()
+        s2 = self.storage.snapshot()
+        child_uuid = s1.newUUID()
+        s1.addChild(uuid, child_uuid, 'b', 'nt:unstructured', [], {})
+        s2.removeNode(uuid)
+        self.storage.commit(s1)
+        self.assertRaises(ConflictError, self.storage.commit, s2)
+        s3 = self.storage.snapshot()
+        self.assertEquals(s3.data[uuid].children, [('b', child_uuid)])
+
+    def test_commit_conflict_remove_changed(self):
+        s = self.storage.snapshot()
+        uuid = self.addChild(s, 'a')
+        self.storage.commit(s)
+        s1 = self.storage.snapshot()
+        s2 = self.storage.snapshot()
+        s1.modifyProperties(uuid, {'title': 'foo'})
+        s2.removeNode(uuid)
+        self.storage.commit(s1)
+        self.assertRaises(ConflictError, self.storage.commit, s2)
+
+    def test_remove(self):
+        s1 = self.storage.snapshot()
+        uuid = self.addChild(s1, 'a')
+        self.storage.commit(s1)
+        self.storage.release(s1)
+        s2 = self.storage.snapshot()
+        s2.removeNode(uuid)
+        s3 = self.storage.snapshot()
+        self.storage.commit(s2)
+        self.assert_(uuid in s3.data)
+        self.assert_(uuid not in self.storage.snapshot().data)
+
+    def test_remove_subtree(self):
+        s = self.storage.snapshot()
+        f = self.addChild(s, 'f')
+        g = s.newUUID()
+        s.addChild(f, g, 'g', 'nt:unstructured', [], {'foo': 'bar'})
+        self.storage.commit(s)
+        s = self.storage.snapshot()
+        # Fill the index and the path cache
+        self.assertEquals(s.searchProperty('foo', 'bar'), [g])
+        self.assertEquals(s.getPath(g), '/f/g')
+        s.removeNode(f)
+        self.assert_(g not in s.data)
+        self.storage.commit(s)
+        s = self.storage.snapshot()
+        self.assert_(g not in s.data)
+        self.assertEquals(s.searchProperty('foo', 'bar'), [])
+        # Same with cold caches
+        self.storage.index = None
+        self.storage.paths = {}
+        self.assertEquals(s.searchProperty('foo', 'bar'), [])
+
+    def test_old_records_dropped(self):
+        for i in range(5):
+            s = self.storage.snapshot()
+            s.modifyProperties(self.root_uuid, {'count': i})
+            self.storage.commit(s)
+            self.storage.release(s)
+        self.assertEquals(self.storage.history, {})
+        # An active snapshot keeps its version
+        old = self.storage.snapshot()
+        for i in range(5):
+            s = self.storage.snapshot()
+            s.modifyProperties(self.root_uuid, {'count': i})
+            self.storage.commit(s)
+            self.storage.release(s)
+        self.assertEquals(old.data[self.root_uuid].properties['count'], 4)
+
+    def test_commit_merge_move(self):
+        s = self.storage.snapshot()
+        uuid = self.addChild(s, 'a')
+        dest = self.addChild(s, 'b')
+        self.storage.commit(s)
+        s1 = self.storage.snapshot()
+        s2 = self.storage.snapshot()
+        s1.move(uuid, dest, 'c')
+        s2.modifyProperties(uuid, {'title': 'foo'})
+        self.addChild(s2, 'd')
+        self.storage.commit(s1)
+        self.storage.commit(s2)
+        s3 = self.storage.snapshot()
+        self.assertEquals(s3.getPath(uuid), '/b/c')
+        self.assertEquals(s3.data[uuid].properties['title'], 'foo')
+        self.assertEquals([n for n, u in s3.data[self.root_uuid].children],
+                          ['b', 'd'])
+
+    def test_commit_conflict_move(self):
+        s = self.storage.snapshot()
+        uuid = self.addChild(s, 'a')
+        self.storage.commit(s)
+        s1 = self.storage.snapshot()
+        s2 = self.storage.snapshot()
+        s1.move(uuid, self.root_uuid, 'b')
+        s2.move(uuid, self.root_uuid, 'c')
+        self.storage.commit(s1)
+        self.assertRaises(ConflictError, self.storage.commit, s2)
+
+    def test_getPath_cache(self):
+        s = self.storage.snapshot()
+        uuid = self.addChild(s, 'a')
+        self.assertEquals(s.getPath(uuid), '/a')
+        self.storage.commit(s)
+        s1 = self.storage.snapshot()
+        self.assertEquals(s1.getPath(uuid), '/a')
+        self.assertEquals(self.storage.paths[uuid], '/a')
+        s2 = self.storage.snapshot()
+        s2.move(uuid, self.root_uuid, 'b')
+        self.assertEquals(s2.getPath(uuid), '/b')
+        self.storage.commit(s2)
+        # Older snapshots don't use the cache anymore
+        self.assertEquals(s1.getPath(uuid), '/a')
+        self.assertEquals(self.storage.snapshot().getPath(uuid), '/b')
+
+    def test_searchProperty(self):
+        s = self.storage.snapshot()
+        uuid1 = self.addChild(s, 'a')
+        uuid2 = self.addChild(s, 'b')
+        s.modifyProperties(uuid1, {'title': u'foo', 'tags': [u'x', u'y']})
+        s.modifyProperties(uuid2, {'title': u'foo', 'count': 3})
+        self.assertEquals(sorted(s.searchProperty('title', u'foo')),
+                          sorted([uuid1, uuid2]))
+        self.storage.commit(s)
+        old = self.storage.snapshot()
+        self.assertEquals(old.searchProperty('tags', u'y'), [uuid1])
+        self.assertEquals(old.searchProperty('count', '3'), [uuid2])
+        s = self.storage.snapshot()
+        s.modifyProperties(uuid1, {'title': u'bar'})
+        s.removeNode(uuid2)
+        self.storage.commit(s)
+        # The index is maintained, old snapshots see their version
+        s = self.storage.snapshot()
+        self.assertEquals(s.searchProperty('title', u'foo'), [])
+        self.assertEquals(s.searchProperty('title', u'bar'), [uuid1])
+        self.assertEquals(sorted(old.searchProperty('title', u'foo')),
+                          sorted([uuid1, uuid2]))
+        self.assertEquals(old.searchProperty('title', u'bar'), [])
+
+    def test_controller(self):
+        key = (FakeDB.database_name, FakeDB.workspace_name)
+        STORAGES[key] = self.storage
+        try:
+            controller = FakeJCRController(FakeDB())
+            controller.login(FakeDB.workspace_name)
+            map = controller.sendCommands([
+                ('add', self.root_uuid, 'a', 'nt:unstructured',
+                 {'count': 3}, 'T0'),
+                ('add', self.root_uuid, 'b', 'nt:unstructured', {}, 'T1'),
+                ], finish='commit')
+            uuid, dest = map['T0'], map['T1']
+            self.assertEquals(controller.getPath(self.root_uuid), u'/')
+            self.assertEquals(controller.getPath(uuid), u'/a')
+            self.assertEquals(controller.getPath('nosuchuuid'), None)
+            controller.move(uuid, dest, 'c')
+            controller.copy(uuid, self.root_uuid, 'd')
+            res = controller.searchProperty('count', '3')
+            self.assertEquals([path for u, path in res], ['/b/c', '/d'])
+            self.assertEquals(res[0][0], uuid)
+            controller.close()
+        finally:
+            del STORAGES[key]
+
+class FakeDB(object):
+    database_name = 'test-fakelog'
+    workspace_name = 'default'
+
+
+class StaleRecords(dict):
+    """Records giving some stale records of a node first.
+    """
+    def __init__(self, records, uuid, stale):
+        dict.__init__(self, records)
+        self.uuid = uuid
+        self.stale = stale
+
+    def get(self, key, default=None):
+        if key == self.uuid and self.stale:
+            return self.stale.pop(0)
+        return dict.get(self, key, default)
+
+
+class LogStorageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'default.log')
+        self.storage = FakeJCRLogStorage(self.path)
+        self.root_uuid = self.storage.root_uuid
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.dir)
+
+    def reopen(self):
+        self.storage.close()
+        self.storage = FakeJCRLogStorage(self.path)
+
+    def addChildren(self, count, props=None):
+        s = self.storage.snapshot()
+        uuids = []
+        for i in range(count):
+            uuid = s.newUUID()
+            s.addChild(self.root_uuid, uuid, 'n%d' % i, 'nt:unstructured',
+                       [], dict(props or {}))
+            uuids.append(uuid)
+        self.storage.commit(s)
+        self.storage.release(s)
+        return uuids
+
+    def modify(self, uuids, props):
+        s = self.storage.snapshot()
+        for uuid in uuids:
+            s.modifyProperties(uuid, props)
+        self.storage.commit(s)
+        self.storage.release(s)
+
+    def test_reopen(self):
+        uuids = self.addChildren(3, {'title': u'caf\xe9'})
+        self.modify(uuids[:1], {'title': None, 'count': 2})
+        s = self.storage.snapshot()
+        s.removeNode(uuids[2])
+        self.storage.commit(s)
+        self.storage.release(s)
+        self.reopen()
+        s = self.storage.snapshot()
+        root = s.data[self.root_uuid]
+        self.assertEquals(root.children, [('n0', uuids[0]), ('n1', uuids[1])])
+        self.assertEquals(s.data[uuids[0]].properties,
+                          {'count': 2, 'jcr:primaryType': 'nt:unstructured'})
+        self.assertEquals(s.data[uuids[1]].properties['title'], u'caf\xe9')
+        self.assert_(uuids[2] not in s.data)
+        # New uuids don't collide with the stored ones
+        self.assert_(s.newUUID() not in uuids)
+
+    def test_uncommitted_tail(self):
+        uuids = self.addChildren(2)
+        size = os.path.getsize(self.path)
+        f = open(self.path, 'ab')
+        f.write(fakelog.makeRecord('n', 'cafe-9999', 'garbage'))
+        f.write('\0\0')
+        f.close()
+        self.reopen()
+        self.assertEquals(os.path.getsize(self.path), size)
+        s = self.storage.snapshot()
+        self.assertEquals(len(s.data[self.root_uuid].children), 2)
+        self.assert_('cafe-9999' not in s.data)
+
+    def test_compact(self):
+        old_min = fakelog.COMPACT_MIN
+        fakelog.COMPACT_MIN = 5
+        try:
+            uuids = self.addChildren(3)
+            old = self.storage.snapshot()
+            for i in range(5):
+                self.modify(uuids, {'count': i})
+        finally:
+            fakelog.COMPACT_MIN = old_min
+        self.assertEquals(len(self.storage.logs), 2) # compacted
+        # The old snapshot still sees its version
+        self.assert_('count' not in old.data[uuids[0]].properties)
+        self.storage.release(old)
+        self.reopen()
+        s = self.storage.snapshot()
+        for uuid in uuids:
+            self.assertEquals(s.data[uuid].properties['count'], 4)
+
+    def test_compact_twice(self):
+        uuids = self.addChildren(2)
+        first = self.storage.logs[0]
+        stale = self.storage.records[uuids[0]]
+        self.storage.compact()
+        self.storage.compact()
+        # The log from two generations back is closed
+        self.assertEquals(len(self.storage.logs), 2)
+        self.assert_(first.file.closed)
+        self.assertRaises(ValueError, self.storage.loadNode, stale[1])
+        # A reader that got its record before the compactions finds the
+        # node in the new records
+        records = self.storage.records
+        self.storage.records = StaleRecords(records, uuids[0], [stale] * 2)
+        try:
+            node = self.storage.getNode(uuids[0], self.storage.version)
+        finally:
+            self.storage.records = records
+        self.assertEquals(node.name, 'n0')
+
+    def test_controller(self):
+        key = (FakeDB.database_name, FakeDB.workspace_name)
+        STORAGES[key] = self.storage
+        try:
+            controller = FakeJCRController(FakeDB())
+            controller.login(FakeDB.workspace_name)
+            map = controller.sendCommands([
+                ('add', self.root_uuid, 'a', 'nt:unstructured', {}, 'T0'),
+                ], finish='commit')
+            controller.close()
+        finally:
+            del STORAGES[key]
+        self.reopen()
+        s = self.storage.snapshot()
+        self.assertEquals(s.data[self.root_uuid].children,
+                          [('a', map['T0'])])
+
 
 def test_suite():
     return unittest.TestSuite((
         unittest.makeSuite(InterfaceTests),
         unittest.makeSuite(MergerTests),
+        unittest.makeSuite(StorageTests),
+        unittest.makeSuite(LogStorageTests),
         ))
 
 if __name__ == '__main__':
@@ -0,0 +1,165 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Tests for the synthetic repository generator.
+"""
+
+import unittest
+
+from nuxeo.capsule.base import Blob
+from nuxeo.jcr.schema import SchemaManager
+from nuxeo.jcr.tests.fakeserver import FakeJCR
+from nuxeo.jcr.tests.fakeserver import FakeJCRController
+from nuxeo.jcr.tests.fakeserver import STORAGES
+from nuxeo.jcr.tests.generator import Generator
+from nuxeo.jcr.tests.generator import populateFake
+from nuxeo.jcr.tests.generator import populate
+
+
+CND = """
+<nt='http://www.jcp.org/jcr/nt/1.0'>
+<mix='http://www.jcp.org/jcr/mix/1.0'>
+<ecm='http://nuxeo.org/ecm/jcr/names'>
+<ecmnt='http://nuxeo.org/ecm/jcr/types'>
+<ecmst='http://nuxeo.org/ecm/jcr/schemas'>
+<dc='http://purl.org/dc/elements/1.1/'>
+[ecmnt:base] > nt:base
+[ecmnt:schema] > ecmnt:base
+[ecmnt:document] > ecmnt:schema, mix:versionable
+[ecmnt:folder] > ecmnt:document
+[ecmst:dublincore] > ecmnt:schema
+  - dc:title
+  - dc:description
+[ecmst:name] > ecmnt:schema
+  - first (String)
+  - last (String)
+[ecmst:names] > ecmnt:schema
+  + * (ecmst:name)
+[ecmst:tripreport] > ecmnt:schema
+  - duedate (Date)
+  - cities (String) multiple
+  - days (Long)
+  - attachment (Binary)
+  + name (ecmst:name)
+  + friends (ecmst:names)
+[tripreport] > ecmnt:document, ecmst:tripreport, ecmst:dublincore
+"""
+
+_schema_manager = None
+
+def getSchemaManager():
+    global _schema_manager
+    if _schema_manager is None:
+        _schema_manager = SchemaManager()
+        _schema_manager.addCND(CND)
+    return _schema_manager
+
+
+def blobData(nodes):
+    res = []
+    for key, parent_key, name, node_type, props in nodes:
+        props = props.copy()
+        for k, v in props.items():
+            if isinstance(v, Blob):
+                props[k] = v.data
+        res.append((key, parent_key, name, node_type, props))
+    return res
+
+
+class FakeDB(object):
+    database_name = 'test-generator'
+    workspace_name = 'default'
+
+
+class GeneratorTests(unittest.TestCase):
+
+    def makeGenerator(self, **kw):
+        params = {'depth': 1, 'width': 2, 'documents': 3, 'blob_size': 100}
+        params.update(kw)
+        return Generator(getSchemaManager(), 'ecmnt:folder',
+                         ['tripreport'], **params)
+
+    def test_nodes(self):
+        nodes = list(self.makeGenerator().nodes())
+        types = [node[3] for node in nodes]
+        self.assertEquals(types.count('ecmnt:folder'), 3)
+        self.assertEquals(types.count('ecmnt:children'), 3)
+        self.assertEquals(types.count('tripreport'), 9)
+        self.assertEquals(nodes[0][:4], (1, None, u'generated',
+                                         'ecmnt:folder'))
+        # Complex properties and lists are child nodes
+        byKey = dict((node[0], node) for node in nodes)
+        doc = [node for node in nodes if node[3] == 'tripreport'][0]
+        children = dict((node[2], node[3]) for node in nodes
+                        if node[1] == doc[0])
+        self.assertEquals(children, {u'name': 'ecmst:name',
+                                     u'friends': 'ecmst:names'})
+        for node in nodes:
+            if node[3] == 'ecmst:name':
+                self.assert_(isinstance(node[4]['first'], unicode))
+                self.assert_(byKey[node[1]][3] in ('tripreport',
+                                                   'ecmst:names'))
+        props = doc[4]
+        self.assert_(isinstance(props['cities'], list))
+        self.assert_(isinstance(props['dc:title'], unicode))
+        self.assert_(isinstance(props['days'], int))
+        self.assert_(50 <= len(props['attachment'].data) <= 150)
+
+    def test_seed(self):
+        nodes = blobData(self.makeGenerator(seed=1).nodes())
+        self.assertEquals(blobData(self.makeGenerator(seed=1).nodes()),
+                          nodes)
+        self.assertNotEquals(blobData(self.makeGenerator(seed=2).nodes()),
+                             nodes)
+
+    def test_wide(self):
+        nodes = list(self.makeGenerator(depth=0, wide=50).nodes())
+        wide = [node for node in nodes if node[2] == u'wide'][0]
+        children = [node for node in nodes if node[1] == wide[0]][0]
+        docs = [node for node in nodes if node[1] == children[0]]
+        self.assertEquals(len(docs), 50)
+
+    def test_populateFake(self):
+        jcr = FakeJCR()
+        generator = self.makeGenerator()
+        uuids = populateFake(jcr, jcr.root_uuid, generator.nodes(u'gen'))
+        self.assertEquals(len(jcr.data), len(uuids))
+        top = jcr.data[uuids[1]]
+        self.assertEquals(top.name, u'gen')
+        self.assertEquals([name for name, uuid in top.children],
+                          [u'ecm:children'])
+        self.assertEquals(jcr.getPath(uuids[generator.versionable[-1]]),
+                          '/gen/ecm:children/folder1/ecm:children/doc2')
+
+    def test_populate(self):
+        key = (FakeDB.database_name, FakeDB.workspace_name)
+        STORAGES.pop(key, None)
+        controller = FakeJCRController(FakeDB())
+        root_uuid = controller.login(FakeDB.workspace_name)
+        generator = self.makeGenerator()
+        count = populate(controller, root_uuid, generator, batch_size=10)
+        self.assertEquals(count, len(list(generator.nodes())))
+        self.assertEquals(len(STORAGES[key].records), count + 1)
+        controller.close()
+        del STORAGES[key]
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(GeneratorTests),
+        ))
+
+if __name__ == '__main__':
+    unittest.TextTestRunner().run(test_suite())
@@ -0,0 +1,188 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Tests for the bulk importer.
+"""
+
+import unittest
+from StringIO import StringIO
+
+from nuxeo.jcr.archive import ArchiveWriter
+from nuxeo.jcr.importer import Importer
+from nuxeo.jcr.importer import treeNodes
+from nuxeo.jcr.tests.fakeserver import FakeJCRController
+from nuxeo.jcr.tests.fakeserver import STORAGES
+
+TREE = """\
+# comment
+/a\tecm:folder\ttitle=A
+/a/b\tecm:document\ttitle=B\tdescription=tab\\there
+/a/c\tecm:document
+
+/d\tecm:folder\ttitle=\\xc3\\xa9t\\xc3\\xa9
+"""
+
+
+class FakeDB(object):
+    database_name = 'test-importer'
+    workspace_name = 'default'
+    controller_class = FakeJCRController
+
+
+class CountingController(FakeJCRController):
+    commits = 0
+
+    def prepare(self):
+        CountingController.commits += 1
+        FakeJCRController.prepare(self)
+
+
+class CountingDB(FakeDB):
+    controller_class = CountingController
+
+
+class ImporterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDB()
+        self.controller = FakeJCRController(self.db)
+        self.root_uuid = self.controller.login('default')
+
+    def tearDown(self):
+        del STORAGES[(FakeDB.database_name, FakeDB.workspace_name)]
+
+    def getTree(self, uuid=None):
+        # Committed state, as (name, type, props, children)
+        self.controller.abort()
+        data = self.controller.storage.data
+        if uuid is None:
+            uuid = self.root_uuid
+        node = data[uuid]
+        props = node.properties.copy()
+        del props['jcr:primaryType']
+        return (node.name, node.type, props,
+                [self.getTree(cuuid) for name, cuuid in node.children])
+
+    def test_treeNodes(self):
+        nodes = list(treeNodes(StringIO(TREE)))
+        self.assertEquals(nodes, [
+            ('/a', None, u'a', 'ecm:folder', {'title': u'A'}),
+            ('/a/b', '/a', u'b', 'ecm:document',
+             {'title': u'B', 'description': u'tab\there'}),
+            ('/a/c', '/a', u'c', 'ecm:document', {}),
+            ('/d', None, u'd', 'ecm:folder', {'title': u'\xe9t\xe9'}),
+            ])
+
+    def test_treeNodes_bad(self):
+        self.assertRaises(ValueError, list, treeNodes(StringIO('a\tfoo\n')))
+        self.assertRaises(ValueError, list, treeNodes(StringIO('/a\n')))
+
+    def test_importTree(self):
+        importer = Importer(self.db, self.root_uuid, batch_size=2,
+                            commit_every=3)
+        count = importer.importTree(StringIO(TREE))
+        self.assertEquals(count, 4)
+        self.assertEquals(self.getTree()[3], [
+            (u'a', 'ecm:folder', {'title': u'A'}, [
+                (u'b', 'ecm:document',
+                 {'title': u'B', 'description': u'tab\there'}, []),
+                (u'c', 'ecm:document', {}, []),
+                ]),
+            (u'd', 'ecm:folder', {'title': u'\xe9t\xe9'}, []),
+            ])
+
+    def test_importTree_unknown_parent(self):
+        importer = Importer(self.db, self.root_uuid)
+        tree = StringIO('/a\tecm:folder\n/b/c\tecm:folder\n')
+        self.assertRaises(ValueError, importer.importTree, tree)
+        # Nothing committed
+        self.assertEquals(self.getTree()[3], [])
+
+    def test_importTree_parallel(self):
+        lines = []
+        for top in 'abc':
+            lines.append('/%s\tecm:folder' % top)
+            for i in range(3):
+                lines.append('/%s/f%d\tecm:folder' % (top, i))
+                for j in range(4):
+                    lines.append('/%s/f%d/d%d\tecm:document\ttitle=%s%d%d'
+                                 % (top, i, j, top, i, j))
+        importer = Importer(self.db, self.root_uuid, workers=2,
+                            split_depth=1, batch_size=2, commit_every=5)
+        count = importer.importTree(StringIO('\n'.join(lines)))
+        self.assertEquals(count, len(lines))
+        tree = self.getTree()[3]
+        self.assertEquals([node[0] for node in tree], [u'a', u'b', u'c'])
+        for top, folder_type, props, folders in tree:
+            self.assertEquals([node[0] for node in folders],
+                              [u'f0', u'f1', u'f2'])
+            for i, folder in enumerate(folders):
+                self.assertEquals(
+                    [(node[0], node[2]['title']) for node in folder[3]],
+                    [(u'd%d' % j, u'%s%d%d' % (top, i, j))
+                     for j in range(4)])
+
+    def test_importTree_parallel_commits(self):
+        # Workers commit every commit_every nodes, not for each node
+        # under a split level
+        lines = ['/a\tecm:folder']
+        for i in range(100):
+            lines.append('/a/d%d\tecm:document' % i)
+        CountingController.commits = 0
+        importer = Importer(CountingDB(), self.root_uuid, workers=2,
+                            split_depth=1, batch_size=10, commit_every=20)
+        count = importer.importTree(StringIO('\n'.join(lines)))
+        self.assertEquals(count, 101)
+        self.assertEquals([len(node[3]) for node in self.getTree()[3]],
+                          [100])
+        # main: the folder and the end; each worker: the end; the busy
+        # worker: its new parent and every 20 nodes
+        self.assert_(CountingController.commits <= 10,
+                     CountingController.commits)
+
+    def test_importArchive(self):
+        f = StringIO()
+        writer = ArchiveWriter(f)
+        writer.addNode('u1', u'a', 'somewhere',
+                       [('jcr:primaryType', 'ecm:folder'),
+                        ('jcr:uuid', u'u1'), ('title', u'A')])
+        writer.addNode('u2', u'b', 'u1',
+                       [('jcr:primaryType', 'ecm:document'),
+                        ('tags', [u'x', u'y'])])
+        writer.addNode('u3', u'c', 'u1',
+                       [('jcr:primaryType', 'ecm:document')])
+        writer.addNode('u4', u'd', 'u3',
+                       [('jcr:primaryType', 'ecm:document')])
+        writer.close()
+        f.seek(0)
+        importer = Importer(self.db, self.root_uuid, batch_size=1)
+        self.assertEquals(importer.importArchive(f), 4)
+        self.assertEquals(self.getTree()[3], [
+            (u'a', 'ecm:folder', {'title': u'A'}, [
+                (u'b', 'ecm:document', {'tags': [u'x', u'y']}, []),
+                (u'c', 'ecm:document', {}, [
+                    (u'd', 'ecm:document', {}, []),
+                    ]),
+                ]),
+            ])
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(ImporterTests),
+        ))
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,126 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Tests for the activity monitor.
+"""
+
+import unittest
+
+from nuxeo.jcr.controller import JCRController
+from nuxeo.jcr.interfaces import ConflictError
+from nuxeo.jcr.monitor import JCRActivityMonitor
+from nuxeo.jcr.monitor import CommandStats
+from nuxeo.jcr.tests.test_controller import FakeSocket
+
+
+class FakeDB(object):
+    server = None
+
+    def __init__(self, monitor):
+        self.monitor = monitor
+
+    def getActivityMonitor(self):
+        return self.monitor
+
+
+class FakeConnection(object):
+    def getTransferCounts(self, clear=False):
+        return 3, 2
+
+
+class MonitorTests(unittest.TestCase):
+
+    def makeOne(self, toread, monitor):
+        c = JCRController(FakeDB(monitor))
+        c._sock = FakeSocket(toread)
+        return c
+
+    def test_histogram(self):
+        stats = CommandStats()
+        for ms in (0.5, 0.7, 3, 3, 15, 7000):
+            stats.add(ms / 1000.0, 10, 100)
+        self.assertEquals(stats.count, 6)
+        self.assertEquals(stats.bytes_sent, 60)
+        self.assertEquals(stats.bytes_received, 600)
+        self.assertEquals(stats.histogram,
+                          [2, 0, 2, 0, 1, 0, 0, 0, 0, 0, 0, 0, 1])
+        self.assertEquals(stats.percentile(0.10), 1)
+        self.assertEquals(stats.percentile(0.50), 5)
+        self.assertEquals(stats.percentile(0.80), 20)
+        self.assertEquals(stats.percentile(0.99), None)
+
+    def test_commands(self):
+        monitor = JCRActivityMonitor()
+        c = self.makeOne('^root\nTfoo\n.\n.\n', monitor)
+        c.login('default')
+        c.getNodeType('abc')
+        c.sendCommands([('remove', 'abc')])
+        c.commit()
+        c.commit() # nothing to commit, not sent
+        stats = monitor.getCommandStats()
+        self.assertEquals(sorted(stats.keys()), ['L', 'M', 'T', 'c'])
+        self.assertEquals(stats['L']['count'], 1)
+        self.assertEquals(stats['L']['bytes_sent'], len('Ldefault\n'))
+        # The first read gets everything
+        self.assertEquals(stats['L']['bytes_received'], 15)
+        self.assertEquals(stats['M']['bytes_sent'], len('M\n-abc\n.\n'))
+        self.assertEquals(stats['c']['count'], 1)
+        self.assertEquals(sum(stats['T']['histogram']), 1)
+
+    def test_errors(self):
+        monitor = JCRActivityMonitor()
+        c = self.makeOne('.\nconflict\n', monitor)
+        c.startCommands([('remove', 'abc')], finish='commit')
+        self.assertRaises(ConflictError, c.finishCommands)
+        self.assertEquals(monitor.getCommandStats(clear=True)['M']['count'],
+                          1)
+        self.assertEquals(monitor.getCommandStats(), {})
+
+    def test_not_monitored(self):
+        c = self.makeOne('^root\n', None)
+        self.assertEquals(c.login('default'), 'root')
+        c = self.makeOne('.\n', None)
+        self.assertEquals(c.sendCommands([('remove', 'abc')]), {})
+
+    def test_dump(self):
+        monitor = JCRActivityMonitor()
+        monitor.commandDone('S', 0.003, 40, 1000)
+        monitor.commandDone('S', 0.001, 40, 500)
+        monitor.commandDone('c', 0.5, 2, 2)
+        lines = monitor.dump(clear=True).split('\n')
+        self.assertEquals(len(lines), 2)
+        self.assertEquals(lines[0],
+            'S count=2 avg_ms=2.00 p50_ms=1 p99_ms=5 max_ms=3.00 '
+            'sent=80 received=1500 hist=1:1,2:0,5:1,10:0,20:0,50:0,'
+            '100:0,200:0,500:0,1000:0,2000:0,5000:0,inf:0')
+        self.assert_(lines[1].startswith('c count=1 avg_ms=500.00 '))
+        self.assertEquals(monitor.dump(), '')
+
+    def test_closedConnection(self):
+        monitor = JCRActivityMonitor()
+        monitor.closedConnection(FakeConnection())
+        analysis = monitor.getActivityAnalysis(divisions=1)
+        self.assertEquals(analysis[0]['loads'], 3)
+        self.assertEquals(analysis[0]['stores'], 2)
+        self.assertEquals(analysis[0]['connections'], 1)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(MonitorTests),
+        ))
+
+if __name__ == '__main__':
+    unittest.TextTestRunner().run(test_suite())
@@ -0,0 +1,242 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Tests for the traffic recorder and the replay.
+"""
+
+import socket
+import threading
+import unittest
+from StringIO import StringIO
+
+from nuxeo.jcr.controller import JCRController
+from nuxeo.jcr.interfaces import ProtocolError
+from nuxeo.jcr.recorder import Recorder
+from nuxeo.jcr.recorder import readFrames
+from nuxeo.jcr.recorder import readSessions
+from nuxeo.jcr.recorder import OPEN
+from nuxeo.jcr.recorder import SENT
+from nuxeo.jcr.recorder import RECEIVED
+from nuxeo.jcr.recorder import CLOSE
+from nuxeo.jcr.tests.replay import Replay
+from nuxeo.jcr.tests.replay import exchanges
+from nuxeo.jcr.tests.standin import StandinServer
+from nuxeo.jcr.tests.test_controller import FakeSocket
+
+
+class Address(object):
+    family = socket.AF_INET
+
+    def __init__(self, address):
+        self.address = address
+
+
+class FakeDB(object):
+    server = None
+
+    def __init__(self, recorder, address=None):
+        self.recorder = recorder
+        if address is not None:
+            self.server = Address(address)
+
+
+class ClosableSocket(FakeSocket):
+    def close(self):
+        pass
+
+
+class EchoServer(threading.Thread):
+    """Answers 'ok' followed by each line received.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('localhost', 0))
+        self.sock.listen(5)
+        self.address = self.sock.getsockname()
+
+    def run(self):
+        while True:
+            conn, address = self.sock.accept()
+            threading.Thread(target=self.serve, args=(conn,)).start()
+
+    def serve(self, conn):
+        f = conn.makefile('rb')
+        conn.sendall('Welcome.\n')
+        while True:
+            line = f.readline()
+            if not line or line == 'q\n':
+                break
+            conn.sendall('ok ' + line)
+        f.close()
+        conn.close()
+
+
+class RecorderTests(unittest.TestCase):
+
+    def record(self, recorder, lines):
+        c = JCRController(FakeDB(recorder))
+        answers = ''.join(['ok %s\n' % line for line in lines])
+        c._sock = ClosableSocket(answers)
+        c._session = recorder.open()
+        for line in lines:
+            c._writeline(line)
+            self.assertEquals(c._readline(), 'ok ' + line)
+        c.close()
+
+    def test_record(self):
+        f = StringIO()
+        recorder = Recorder(f)
+        self.record(recorder, ['Lfoo', 'S1234'])
+        self.record(recorder, ['Lbar'])
+        frames = list(readFrames(StringIO(f.getvalue())))
+        self.assertEquals([(kind, session, data)
+                           for kind, session, elapsed, data in frames], [
+            (OPEN, 1, ''),
+            (SENT, 1, 'Lfoo\n'),
+            (RECEIVED, 1, 'ok Lfoo\nok S1234\n'),
+            (SENT, 1, 'S1234\n'),
+            (SENT, 1, 'q\n'),
+            (CLOSE, 1, ''),
+            (OPEN, 2, ''),
+            (SENT, 2, 'Lbar\n'),
+            (RECEIVED, 2, 'ok Lbar\n'),
+            (SENT, 2, 'q\n'),
+            (CLOSE, 2, ''),
+            ])
+        times = [frame[2] for frame in frames]
+        self.assertEquals(times, sorted(times))
+        recorder.close()
+        # Frames after the close are dropped
+        recorder.sent(2, 'x')
+
+    def test_not_recorded(self):
+        c = JCRController(FakeDB(None))
+        c._sock = FakeSocket('ok\n')
+        c._writeline('Lfoo')
+        self.assertEquals(c._readline(), 'ok')
+
+    def test_truncated(self):
+        f = StringIO()
+        recorder = Recorder(f)
+        recorder.sent(recorder.open(), 'Lfoo\n')
+        data = f.getvalue()
+        self.assertEquals(len(list(readFrames(StringIO(data)))), 2)
+        self.assertRaises(ValueError, list, readFrames(StringIO(data[:-1])))
+        self.assertRaises(ValueError, list, readFrames(StringIO('foo')))
+
+    def test_replay(self):
+        server = EchoServer()
+        server.start()
+        f = StringIO()
+        recorder = Recorder(f)
+        for i in range(3):
+            session = recorder.open()
+            recorder.received(session, 'Welcome.\n')
+            for line in ('Lfoo\n', 'T%d\n' % i):
+                recorder.sent(session, line)
+                recorder.received(session, 'ok ' + line)
+            recorder.sent(session, 'q\n')
+            recorder.closed(session)
+        sessions = readSessions(StringIO(f.getvalue()))
+        self.assertEquals([session for session, frames in sessions],
+                          [1, 2, 3])
+        replay = Replay(server.address, sessions, speed=0, copies=2,
+                        timeout=5)
+        threads = replay.run()
+        self.assertEquals(len(threads), 6)
+        for thread in threads:
+            self.assertEquals(thread.error, None)
+            self.assertEquals(thread.mismatches, 0)
+            self.assertEquals(len(thread.latencies), 2)
+        out = StringIO()
+        replay.report(threads, out)
+        self.assert_(out.getvalue().startswith('6 sessions, 12 exchanges'))
+
+    def test_exchanges(self):
+        # Answers are waited for whole, binaries aren't parsed as lines
+        f = StringIO()
+        recorder = Recorder(f)
+        session = recorder.open()
+        recorder.received(session, 'Welc')
+        recorder.sent(session, 'M\n/abc\nPdata\nx5\n')
+        recorder.received(session, 'ome.\n')
+        recorder.sent(session, 'a\n.\n\n\n,\nc\n')
+        recorder.received(session, '.\n.\n')
+        recorder.sent(session, 'Tabc\n')
+        recorder.received(session, 'Tfoo\n')
+        recorder.closed(session)
+        frames = readSessions(StringIO(f.getvalue()))[0][1]
+        res = [(pieces, answers) for elapsed, pieces, answers
+               in exchanges(frames)]
+        self.assertEquals(res, [
+            ([('M\n/abc\nPdata\nx5\n', False)], []),
+            ([('a\n.\n\n\n', True), (',\nc\n', False)],
+             [('', ['Welcome.'])]),
+            ([('Tabc\n', False)], [('Mc', ['.', '.'])]),
+            (None, [('Tabc', ['Tfoo'])]),
+            ])
+
+    def test_replay_standin(self):
+        # Added nodes get new uuids, used by the following commands
+        server = StandinServer(('localhost', 0))
+        address = ('localhost', server.start())
+        try:
+            f = StringIO()
+            recorder = Recorder(f)
+            c = JCRController(FakeDB(recorder, address))
+            c.connect()
+            root_uuid = c.login('default')
+            uuid = c.sendCommands([
+                ('add', root_uuid, 'a', 'nt:unstructured',
+                 {'title': u'foo'}, 'T0'),
+                ], finish='commit')['T0']
+            c.sendCommands([('modify', uuid, {'title': u'bar'})],
+                           finish='commit')
+            c.getNodeStates([uuid])
+            self.assertRaises(ProtocolError, c.sendCommands,
+                              [('remove', 'nosuchuuid')])
+            c.abort()
+            c.close()
+            sessions = readSessions(StringIO(f.getvalue()))
+            for i in range(2):
+                # Concurrent adds under the same parent would conflict
+                replay = Replay(address, sessions, speed=0, timeout=5)
+                thread = replay.run()[0]
+                self.assertEquals(thread.error, None)
+                self.assertEquals(thread.mismatches, 0)
+                self.assertEquals(len(thread.uuids), 1)
+            c = JCRController(FakeDB(None, address))
+            c.connect()
+            c.login('default')
+            children = c.getNodeStates([root_uuid])[root_uuid][2]
+            self.assertEquals(len(children), 3)
+            states = c.getNodeStates([child[1] for child in children])
+            for state in states.values():
+                self.assertEquals(dict(state[3])['title'], u'bar')
+            c.close()
+        finally:
+            server.stop()
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(RecorderTests),
+        ))
+
+if __name__ == '__main__':
+    unittest.TextTestRunner().run(test_suite())
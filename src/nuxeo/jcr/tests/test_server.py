@@ -0,0 +1,269 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Protocol tests of a JCR server.
+
+They run against the stand-in server, or against a running server.py
+if the JCR_SERVER environment variable gives its host:port. They mostly
+check the I/O of server.py, whose limits are reached with big values
+or many sessions.
+"""
+
+import os
+import time
+import socket
+import unittest
+
+from nuxeo.capsule.base import Blob
+
+from nuxeo.jcr.controller import JCRController
+from nuxeo.jcr.interfaces import ProtocolError
+from nuxeo.jcr.interfaces import EventsLostError
+from nuxeo.jcr.tests.standin import StandinServer
+
+
+class Address(object):
+    family = socket.AF_INET
+
+    def __init__(self, address):
+        self.address = address
+
+
+class FakeDB(object):
+    def __init__(self, address):
+        self.server = Address(address)
+
+
+class ServerTests(unittest.TestCase):
+
+    def setUp(self):
+        address = os.environ.get('JCR_SERVER')
+        if address:
+            host, port = address.split(':')
+            self.server = None
+        else:
+            self.server = StandinServer(('localhost', 0))
+            host, port = 'localhost', self.server.start()
+        self.db = FakeDB((host, int(port)))
+        self.controllers = []
+        self.controller = self.makeController()
+        self.added = []
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        if self.added:
+            self.controller.abort()
+            self.controller.sendCommands(
+                [('remove', uuid) for uuid in self.added], finish='commit')
+        for controller in self.controllers:
+            controller.close()
+        if self.server is not None:
+            self.server.stop()
+
+    def makeController(self):
+        controller = JCRController(self.db)
+        controller.connect()
+        self.root_uuid = controller.login('default')
+        self.controllers.append(controller)
+        return controller
+
+    def addNode(self, props, node_type='nt:unstructured'):
+        """Add and commit a node under the root, returns its uuid.
+        """
+        name = 'test%04d' % len(self.added)
+        map = self.controller.sendCommands([
+            ('add', self.root_uuid, name, node_type, props, 'T0'),
+            ], finish='commit')
+        self.added.append(map['T0'])
+        return map['T0']
+
+    def stall(self, lines):
+        """Open a session that sends lines but never reads the answers.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(self.db.server.address)
+        self.socks.append(sock)
+        sock.sendall(''.join([line + '\n' for line in lines]))
+
+    def waitPaused(self, count=1):
+        """Wait until count sessions are paused by the server.
+
+        Returns the output then buffered by the server, or None if it
+        doesn't tell (the stand-in doesn't).
+        """
+        for i in range(300):
+            stats = self.controller.getStats()
+            if 'paused' not in stats:
+                return None
+            if stats['paused'] >= count:
+                return stats['buffered']
+            time.sleep(0.1)
+        self.fail("Sessions not paused")
+
+    def stateSize(self, controller, uuid):
+        received = controller.bytes_received
+        controller.getNodeStates([uuid])
+        return controller.bytes_received - received - len('.\n')
+
+    def test_shared_state_buffer(self):
+        # A cached state of exactly the size of an output buffer is sent
+        # without copy, it must not be reused for the following output
+        buffer_size = 8192
+        uuid = self.addNode({'title': u'x' * 1000})
+        size = self.stateSize(self.controller, uuid)
+        length = buffer_size - size + 1000
+        uuid = self.addNode({'title': u'x' * length})
+        self.assertEquals(self.stateSize(self.controller, uuid), buffer_size)
+
+        first = self.makeController()
+        state = first.getNodeStates([uuid])[uuid]
+        for i in range(10):
+            self.assertEquals(first.getNodeType(uuid), 'nt:unstructured')
+        second = self.makeController()
+        self.assertEquals(second.getNodeStates([uuid])[uuid], state)
+        self.assertEquals(dict(state[3])['title'], u'x' * length)
+
+    def test_spooled_blob(self):
+        # Binaries of more than 1MB are spooled to disk by the server
+        data = ''.join(map(chr, range(256))) * 12000 + 'end'
+        uuid = self.addNode({'data': Blob(data), 'title': u'big'})
+        other = self.makeController()
+        props = dict(other.getNodeStates([uuid])[uuid][3])
+        self.assertEquals(props['title'], u'big')
+        self.assertEquals(len(props['data'].data), len(data))
+        self.assert_(props['data'].data == data)
+
+    def test_big_state_not_cached(self):
+        # A state bigger than a cache entry is streamed, its capture for
+        # the cache stops early (the stand-in has no cache)
+        data = 'x' * 600000
+        uuid = self.addNode({'data': Blob(data)})
+        before = self.controller.getStats().get('cache_bytes')
+        for i in range(2):
+            other = self.makeController()
+            props = dict(other.getNodeStates([uuid])[uuid][3])
+            self.assert_(props['data'].data == data)
+        self.assertEquals(self.controller.getStats().get('cache_bytes'),
+                          before)
+
+    def test_checkpoint_invalidates(self):
+        # A checkpoint changes the state of the node outside of a save,
+        # the cached state must not be served afterwards
+        uuid = self.addNode({'title': u'foo'}, 'ecmnt:document')
+        reader = self.makeController()
+        reader.getNodeStates([uuid])
+        self.controller.checkpoint(uuid)
+        self.controller.prepare()
+        self.controller.commit()
+        state = reader.getNodeStates([uuid])[uuid]
+        # The states of a modified session don't come from the cache
+        writer = self.makeController()
+        writer.sendCommands([('modify', uuid, {'title': u'foo'})])
+        self.assertEquals(writer.getNodeStates([uuid])[uuid], state)
+        writer.abort()
+
+    def test_states_unknown_uuid(self):
+        # Nothing is written before all the UUIDs are known, including
+        # in a modified session whose states aren't cached
+        uuid = self.addNode({'title': u'foo'})
+        other = self.makeController()
+        for modified in (False, True):
+            if modified:
+                other.sendCommands([('modify', uuid, {'title': u'bar'})])
+            self.assertRaises(ProtocolError, other.getNodeStates,
+                              [uuid, 'cafe-0000-unknown'])
+            state = other.getNodeStates([uuid, self.root_uuid])[uuid]
+            self.assertEquals(dict(state[3])['title'],
+                              modified and u'bar' or u'foo')
+        other.abort()
+
+    def test_many_savepoints(self):
+        # Write-behind batches of one transaction, whose results are
+        # only asked for at the end, must not fill both directions
+        controller = self.makeController()
+        controller._sock.settimeout(30)
+        # Small enough to be filled by the answers whatever the server
+        controller._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                    4096)
+        root_uuid = self.root_uuid
+        tokens = []
+        for i in range(2000):
+            batch = []
+            for j in range(20):
+                token = 'T%d' % len(tokens)
+                batch.append(('add', root_uuid, 'sp%d' % len(tokens),
+                              'nt:unstructured', {'title': u'x' * 50},
+                              token))
+                tokens.append(token)
+            controller.startCommands(batch)
+        uuids = {}
+        for i in range(2000):
+            uuids.update(controller.finishCommands())
+        self.assertEquals(sorted(uuids.keys()), sorted(tokens))
+        controller.abort()
+
+    def test_paused_mid_command(self):
+        # The output of a command much bigger than what the server
+        # buffers for a session stops part-way while it's not read
+        uuid = self.addNode({'title': u'x' * 200000})
+        self.stall(['Ldefault', 'S' + ' '.join([uuid] * 50)])
+        buffered = self.waitPaused()
+        if buffered is not None:
+            # HIGH_WATER and a state
+            self.assert_(buffered < 1048576 + 2 * 200000, buffered)
+
+    def test_paused_mid_binary(self):
+        # A big binary is read and queued a chunk at a time, as long as
+        # the output before it is drained
+        uuid = self.addNode({'data': Blob('x' * 8000000)})
+        self.stall(['Ldefault', 'S' + uuid])
+        buffered = self.waitPaused()
+        if buffered is not None:
+            # HIGH_WATER and a few chunks
+            self.assert_(buffered < 1048576 + 4 * 65536, buffered)
+
+    def test_changes_since_future(self):
+        # A sequence number past the journal, as kept by a client across
+        # a restart of the server, means the changes are lost
+        try:
+            last = self.controller.changesSince(0)[0]
+        except EventsLostError, e:
+            last = e.seq
+        self.assertRaises(EventsLostError, self.controller.changesSince,
+                          last + 1000000)
+
+    def test_stalled_sessions(self):
+        # Sessions whose client doesn't read must not hold the workers
+        # of the server (8 by default) while their output is pending
+        uuid = self.addNode({'title': u'x' * 200000})
+        for i in range(12):
+            self.stall(['Ldefault'] + ['S' + uuid] * 20)
+        other = self.makeController()
+        other._sock.settimeout(30)
+        for i in range(3):
+            self.assertEquals(other.getNodeType(uuid), 'nt:unstructured')
+        state = other.getNodeStates([uuid])[uuid]
+        self.assertEquals(dict(state[3])['title'], u'x' * 200000)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(ServerTests),
+        ))
+
+if __name__ == '__main__':
+    unittest.TextTestRunner().run(test_suite())
@@ -0,0 +1,161 @@
+##############################################################################
+#
+# Copyright (c) 2006 Nuxeo and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+# Author: Florent Guillaume <fg@nuxeo.com>
+# $Id$
+"""Tests of the real controller against the stand-in server.
+"""
+
+import socket
+import unittest
+
+from nuxeo.capsule.base import Blob
+
+from nuxeo.jcr.controller import JCRController
+from nuxeo.jcr.interfaces import ProtocolError
+from nuxeo.jcr.interfaces import ConflictError
+from nuxeo.jcr.tests.standin import StandinServer
+
+
+class Address(object):
+    family = socket.AF_INET
+
+    def __init__(self, address):
+        self.address = address
+
+
+class FakeDB(object):
+    def __init__(self, address):
+        self.server = Address(address)
+
+
+class StandinTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandinServer(('localhost', 0), '[foo:bar]')
+        port = self.server.start()
+        self.db = FakeDB(('localhost', port))
+        self.controllers = []
+        self.controller = self.makeController()
+        self.root_uuid = self.controller.login('default')
+
+    def tearDown(self):
+        for controller in self.controllers:
+            controller.close()
+        self.server.stop()
+
+    def makeController(self):
+        controller = JCRController(self.db)
+        controller.connect()
+        self.controllers.append(controller)
+        return controller
+
+    def addFolder(self, name, finish='commit'):
+        map = self.controller.sendCommands([
+            ('add', self.root_uuid, name, 'nt:unstructured',
+             {'title': u'Caf\xe9', 'count': 3, 'tags': [u'a', u'b'],
+              'data': Blob('x\ny')}, 'T0'),
+            ], finish=finish)
+        return map['T0']
+
+    def test_getNodeTypeDefs(self):
+        self.assertEquals(self.controller.getNodeTypeDefs(), '[foo:bar]')
+
+    def test_getNodeStates(self):
+        uuid = self.addFolder(u'f\xe9')
+        states = self.controller.getNodeStates([self.root_uuid, uuid])
+        name, parent_uuid, children, props, deferred = states[uuid]
+        self.assertEquals(name, u'f\xe9')
+        self.assertEquals(parent_uuid, self.root_uuid)
+        self.assertEquals(children, [])
+        props = dict(props)
+        self.assertEquals(props['title'], u'Caf\xe9')
+        self.assertEquals(props['count'], 3)
+        self.assertEquals(props['tags'], [u'a', u'b'])
+        self.assertEquals(props['data'].data, 'x\ny')
+        self.assertEquals(props['jcr:primaryType'], 'nt:unstructured')
+        self.assertEquals(states[self.root_uuid][2],
+                          [(u'f\xe9', uuid, 'nt:unstructured')])
+        self.assertEquals(self.controller.getNodeType(uuid),
+                          'nt:unstructured')
+        self.assertRaises(ProtocolError, self.controller.getNodeStates,
+                          [uuid, 'nosuchuuid'])
+
+    def test_isolation(self):
+        uuid = self.addFolder('a', finish=None)
+        other = self.makeController()
+        other.login('default')
+        self.assertRaises(ProtocolError, other.getNodeType, uuid)
+        self.controller.prepare()
+        self.controller.commit()
+        # A new transaction sees the committed node
+        other.sendCommands([('modify', self.root_uuid, {'x': 1})],
+                           finish='commit')
+        self.assertEquals(other.getNodeType(uuid), 'nt:unstructured')
+
+    def test_conflict(self):
+        other = self.makeController()
+        other.login('default')
+        other.sendCommands([('modify', self.root_uuid, {'x': 1})])
+        self.controller.sendCommands([('modify', self.root_uuid, {'x': 2})],
+                                     finish='commit')
+        self.assertRaises(ConflictError, other.prepare)
+
+    def test_removeSubtree(self):
+        uuid = self.addFolder('f')
+        map = self.controller.sendCommands([
+            ('add', uuid, 'g', 'nt:unstructured', {'foo': u'bar'}, 'T0'),
+            ], finish='commit')
+        self.assertEquals(self.controller.searchProperty('foo', u'bar'),
+                          [(map['T0'], u'/f/g')])
+        self.controller.sendCommands([('remove', uuid)], finish='commit')
+        self.assertEquals(self.controller.searchProperty('foo', u'bar'), [])
+        self.assertEquals(self.controller.getPath(map['T0']), None)
+
+    def test_pathMoveCopy(self):
+        uuid = self.addFolder('a')
+        dest = self.addFolder('b')
+        self.assertEquals(self.controller.getPath(uuid), u'/a')
+        self.controller.move(uuid, dest, u'c')
+        self.assertEquals(self.controller.getPath(uuid), u'/b/c')
+        self.controller.copy(uuid, self.root_uuid, u'd')
+        self.controller.prepare()
+        self.controller.commit()
+        res = self.controller.searchProperty('count', u'3')
+        self.assertEquals([r[1] for r in res],
+                          [u'/b', u'/b/c', u'/d'])
+        self.assertRaises(ProtocolError, self.controller.move,
+                          dest, uuid, u'e')
+
+    def test_checkpointRestore(self):
+        uuid = self.addFolder('a')
+        self.controller.checkpoint(uuid)
+        self.controller.sendCommands([('modify', uuid, {'count': 4})])
+        self.assertEquals(self.controller.restore(uuid), [''])
+        states = self.controller.getNodeStates([uuid])
+        self.assertEquals(dict(states[uuid][3])['count'], 3)
+
+    def test_getStats(self):
+        self.addFolder('a')
+        stats = self.controller.getStats()
+        self.assertEquals(stats['sessions'], 1)
+        self.assertEquals(stats['commits'], 1)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(StandinTests),
+        ))
+
+if __name__ == '__main__':
+    unittest.TextTestRunner().run(test_suite())
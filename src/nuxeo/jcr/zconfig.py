@@ -16,9 +16,9 @@
 """ZConfig datatypes.
 """
 
-from ZODB.ActivityMonitor import ActivityMonitor
 from Zope2.Startup.datatypes import ZopeDatabase
 from nuxeo.jcr.db import DB
+from nuxeo.jcr.monitor import JCRActivityMonitor
 
 class JCRDatabaseFactory(ZopeDatabase):
     """JCR Database factory.
@@ -26,7 +26,7 @@ class JCRDatabaseFactory(ZopeDatabase):
 
     def open(self, database_name, databases):
         db = self.createDB(database_name, databases)
-        db.setActivityMonitor(ActivityMonitor())
+        db.setActivityMonitor(JCRActivityMonitor())
         return db
 
     def createDB(self, database_name, databases):
@@ -40,4 +40,6 @@ class JCRDatabaseFactory(ZopeDatabase):
             pool_size=config.pool_size,
             server=config.jcr_server,
             workspace_name=config.jcr_workspace_name,
+            write_behind=config.write_behind,
+            record_file=config.record_file,
             )